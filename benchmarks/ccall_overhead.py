@@ -0,0 +1,126 @@
+#coding:utf8
+
+'''
+Per-call overhead of `sandboxed.ccall` next to raw ctypes calls.
+
+    python benchmarks/ccall_overhead.py [-n NUMBER]
+
+`legacy` rows use call layer as it was before fixed argtypes: generic
+`libc.syscall` with argument count assert and `from_param` generator,
+`isinstance`/`encode` in wrappers and formatted error messages.
+Failing calls need nonexistent path, they don't need root.
+'''
+
+import argparse
+import ctypes as ct
+import errno
+import os
+import os.path
+import pathlib
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sandboxed import const, lowlevel
+from sandboxed.ccall import c_path, libc
+
+MISSING = '/nonexistent/sandboxed-benchmark'
+
+def legacy_errno_check(result, func, arguments):
+    if result < 0:
+        errno_ = ct.get_errno()
+        errcode = errno.errorcode.get(errno_)
+        if errcode:
+            errcode = '{} {}'.format(errcode, os.strerror(errno_))
+        else:
+            errcode = errno_
+        raise OSError(errno_, 'Got nonzero value {} and error "{}" was set'.format(result, errcode))
+    return result
+
+legacy_libc_syscall = ct.CDLL(None, use_errno = True).syscall
+legacy_libc_syscall.restype = ct.c_int
+legacy_libc_syscall.errcheck = legacy_errno_check
+
+def legacy_syscall(sys_id, *arg_types):
+    def syscall_wrap(*args):
+        assert len(arg_types) == len(args)
+        sys_args = (atype.from_param(avalue) for atype, avalue in zip(arg_types, args))
+        return legacy_libc_syscall(sys_id, *sys_args)
+    return syscall_wrap
+
+legacy_getpid = legacy_syscall(const.SYS_getpid)
+legacy_pidfd_open = legacy_syscall(const.SYS_pidfd_open, ct.c_int, ct.c_uint)
+
+_legacy_umount2 = ct.CDLL(None, use_errno = True).umount2
+_legacy_umount2.restype = ct.c_int
+_legacy_umount2.argtypes = (ct.c_char_p, ct.c_int)
+_legacy_umount2.errcheck = legacy_errno_check
+
+def legacy_umount2(target, flags):
+    if isinstance(target, str):
+        target = target.encode()
+    return _legacy_umount2(target, flags)
+
+raw_syscall = ct.CDLL(None, use_errno = True).syscall
+raw_umount2 = ct.CDLL(None, use_errno = True).umount2
+raw_umount2.argtypes = (ct.c_char_p, ct.c_int)
+
+def failing(call, *args):
+    def run():
+        try:
+            call(*args)
+        except OSError:
+            pass
+    return run
+
+def cases():
+    missing = MISSING.encode()
+    missing_path = pathlib.Path(MISSING)
+    pid = os.getpid()
+    pidfd = lowlevel.pidfd_open(pid)
+    os.close(pidfd)
+    return [
+        ('getpid', [
+            ('os.getpid', os.getpid),
+            ('raw ctypes', lambda: raw_syscall(const.SYS_getpid)),
+            ('legacy', legacy_getpid),
+            ('lowlevel', lowlevel.getpid),
+        ]),
+        ('pidfd_open + close', [
+            ('raw ctypes', lambda: os.close(raw_syscall(const.SYS_pidfd_open, pid, 0))),
+            ('legacy', lambda: os.close(legacy_pidfd_open(pid, 0))),
+            ('lowlevel', lambda: os.close(lowlevel.pidfd_open(pid))),
+        ]),
+        ('umount2, path as bytes', [
+            ('raw ctypes', lambda: raw_umount2(missing, 0)),
+            ('legacy', failing(legacy_umount2, missing, 0)),
+            ('lowlevel', failing(lowlevel.umount2, missing, 0)),
+        ]),
+        ('umount2, path as str', [
+            ('legacy', failing(legacy_umount2, MISSING, 0)),
+            ('lowlevel', failing(lowlevel.umount2, MISSING, 0)),
+        ]),
+        ('umount2, pathlib.Path', [
+            ('lowlevel', failing(lowlevel.umount2, missing_path, 0)),
+        ]),
+        ('c_path.from_param', [
+            ('bytes', lambda: c_path.from_param(missing)),
+            ('str', lambda: c_path.from_param(MISSING)),
+        ]),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Measures per-call overhead of sandboxed.ccall')
+    parser.add_argument('-n', '--number', type = int, default = 200000)
+    parser.add_argument('-r', '--repeat', type = int, default = 5)
+    args = parser.parse_args()
+
+    for title, variants in cases():
+        print(title)
+        for name, func in variants:
+            best = min(timeit.repeat(func, number = args.number, repeat = args.repeat))
+            print('    {:<12} {:>8.0f} ns'.format(name, best / args.number * 1e9))
+
+if __name__ == '__main__':
+    main()
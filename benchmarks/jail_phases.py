@@ -0,0 +1,290 @@
+#coding:utf8
+
+'''
+Times each phase of jail setup and teardown, as done by
+`jail.InteractiveJail.run`.
+
+    python benchmarks/jail_phases.py [-i ITERATIONS] [--mounts 0,50,200]
+        [--sizes 2000,64000] [-o results.json] [--compare baseline.json]
+
+Has to be run as root. It works in its own mount namespace, so host
+mounts are left alone; `--mounts` extra tmpfs mounts are made there to
+see how setup scales with size of host mount table, `--sizes` are tmpfs
+sizes (kilobytes) of template and root.
+
+Phases:
+
+    mount_tmpfs    template tmpfs, with Python library bind recorded
+    new_root       overlay root made from sealed template, with Python
+                   library bound in it (`mount_python_lib` of old jails)
+    clone          from clone to child running in new namespaces
+    pivot_root     pivot_root and chdir
+    mount_proc
+    umount_all     unmounting old root
+    remount_ro     read-only remount of root
+    exit           from child exiting to parent reaping it
+    teardown       unmounting root and template
+    total
+
+Results (milliseconds: min, p50, p90, p99, max, mean) are printed as JSON.
+With `--compare`, p50 of each phase is compared with earlier results, and
+exit status is 1 if any got slower more than `--threshold` times.
+'''
+
+import argparse
+import distutils.sysconfig
+import json
+import math
+import os
+import os.path
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sandboxed import const
+from sandboxed.lowlevel import mount, pivot_root, unshare
+from sandboxed.rootfs import RootfsTemplate, remount_readonly
+from sandboxed.utils import clone_child, detach, mount_proc, mount_tmpfs, umount_all
+
+PHASES = (
+    'mount_tmpfs',
+    'new_root',
+    'clone',
+    'pivot_root',
+    'mount_proc',
+    'umount_all',
+    'remount_ro',
+    'exit',
+    'teardown',
+    'total',
+)
+
+CLONE_FLAGS = (
+    const.CLONE_NEWNS |
+    const.CLONE_NEWPID |
+    const.CLONE_NEWUTS |
+    const.CLONE_NEWNET |
+    const.CLONE_NEWIPC
+)
+
+# Not 'root' like in jails, Python library could be under /root
+PUT_OLD = '.old_root'
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of sorted `values`
+    '''
+    index = max(0, math.ceil(fraction * len(values)) - 1)
+    return values[index]
+
+def summarize(samples):
+    samples = sorted(samples)
+    return dict(
+        min = samples[0],
+        p50 = percentile(samples, 0.5),
+        p90 = percentile(samples, 0.9),
+        p99 = percentile(samples, 0.99),
+        max = samples[-1],
+        mean = sum(samples) / len(samples),
+    )
+
+def jailed(root, pylib, timings_w, cloned):
+    '''
+    Child side of one iteration: same steps as jailed REPL does before
+    it starts. Sends times of its phases to `timings_w` pipe.
+    '''
+    timings = dict(clone = time.monotonic() - cloned)
+    start = time.monotonic()
+    pivot_root(root, os.path.join(root, PUT_OLD))
+    os.chdir('/')
+    timings['pivot_root'] = time.monotonic() - start
+
+    start = time.monotonic()
+    mount_proc()
+    timings['mount_proc'] = time.monotonic() - start
+
+    start = time.monotonic()
+    umount_all(['/', '/proc', pylib])
+    os.rmdir('/' + PUT_OLD)
+    timings['umount_all'] = time.monotonic() - start
+
+    start = time.monotonic()
+    remount_readonly('/')
+    timings['remount_ro'] = time.monotonic() - start
+
+    # Parent measures `exit` from here
+    timings['exiting'] = time.monotonic()
+    os.write(timings_w, json.dumps(timings).encode())
+
+def iteration(size, pylib):
+    '''
+    Returns dict of times (seconds) of phases of one jail
+    '''
+    timings = {}
+    started = time.monotonic()
+
+    template = RootfsTemplate(size)
+    template.mkdir(PUT_OLD)
+    template.bind(pylib, pylib)
+    timings['mount_tmpfs'] = time.monotonic() - started
+
+    start = time.monotonic()
+    root = template.new_root(size)
+    timings['new_root'] = time.monotonic() - start
+
+    timings_r, timings_w = os.pipe()
+    try:
+        cloned = time.monotonic()
+        pid, pidfd = clone_child(CLONE_FLAGS)
+        if not pid:
+            status = 1
+            try:
+                os.close(timings_r)
+                jailed(root.path, pylib, timings_w, cloned)
+                status = 0
+            except:
+                sys.excepthook(*sys.exc_info())
+            finally:
+                os._exit(status)
+        os.close(pidfd)
+        os.close(timings_w)
+        timings_w = None
+
+        data = b''
+        while True:
+            chunk = os.read(timings_r, 4096)
+            if not chunk:
+                break
+            data += chunk
+        _, status = os.waitpid(pid, 0)
+        reaped = time.monotonic()
+        if status:
+            raise EnvironmentError('Jailed child failed with status {}'.format(status))
+        timings.update(json.loads(data.decode()))
+        timings['exit'] = reaped - timings.pop('exiting')
+    finally:
+        os.close(timings_r)
+        if timings_w is not None:
+            os.close(timings_w)
+
+    start = time.monotonic()
+    root.discard()
+    template.close()
+    timings['teardown'] = time.monotonic() - start
+
+    timings['total'] = time.monotonic() - started
+    return timings
+
+def host_mounts(count):
+    '''
+    Makes `count` small tmpfs mounts, returns their parent directory
+    '''
+    path = tempfile.mkdtemp()
+    mount_tmpfs(64, path)
+    for index in range(count):
+        target = os.path.join(path, str(index))
+        os.mkdir(target)
+        mount_tmpfs(16, target)
+    return path
+
+def run(iterations, mounts, sizes):
+    pylib = os.path.realpath(distutils.sysconfig.get_python_lib(standard_lib = True))
+    results = []
+    for count in mounts:
+        extra = host_mounts(count)
+        try:
+            for size in sizes:
+                # Warm up caches, first jail is always slower
+                iteration(size, pylib)
+                samples = dict((phase, []) for phase in PHASES)
+                for _ in range(iterations):
+                    for phase, seconds in iteration(size, pylib).items():
+                        samples[phase].append(seconds * 1000)
+                results.append(dict(
+                    mounts = count,
+                    tmpfs_kb = size,
+                    phases = dict(
+                        (phase, summarize(values))
+                        for phase, values in samples.items()
+                    ),
+                ))
+        finally:
+            detach(extra)
+            os.rmdir(extra)
+    return results
+
+def compare(baseline, current, threshold):
+    '''
+    Prints p50 of each phase next to baseline. Returns list of
+    regressions, slower more than `threshold` times.
+    '''
+    regressions = []
+    old = dict(
+        ((result['mounts'], result['tmpfs_kb']), result['phases'])
+        for result in baseline['results']
+    )
+    for result in current['results']:
+        key = (result['mounts'], result['tmpfs_kb'])
+        if key not in old:
+            continue
+        print('mounts={} tmpfs_kb={}'.format(*key), file = sys.stderr)
+        for phase in PHASES:
+            before = old[key].get(phase, {}).get('p50')
+            after = result['phases'][phase]['p50']
+            if not before:
+                continue
+            ratio = after / before
+            marker = ''
+            if ratio > threshold:
+                marker = '  REGRESSION'
+                regressions.append((key, phase, ratio))
+            print('    {:<12} {:>9.3f} -> {:>9.3f} ms  x{:.2f}{}'.format(phase, before, after, ratio, marker), file = sys.stderr)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Times phases of jail setup and teardown')
+    parser.add_argument('-i', '--iterations', type = int, default = 100)
+    parser.add_argument('--mounts', default = '0,50,200', help = 'comma separated counts of extra host mounts')
+    parser.add_argument('--sizes', default = '2000,64000', help = 'comma separated tmpfs sizes, in kilobytes')
+    parser.add_argument('-o', '--output', help = 'write JSON there instead of stdout')
+    parser.add_argument('--compare', help = 'JSON of earlier run to compare with')
+    parser.add_argument('--threshold', type = float, default = 1.25)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error('has to be run as root')
+
+    # Own mount namespace, so nothing we do is seen by host
+    unshare(const.CLONE_NEWNS)
+    mount(None, '/', None, const.MS_REC | const.MS_PRIVATE)
+
+    results = run(
+        args.iterations,
+        [int(count) for count in args.mounts.split(',')],
+        [int(size) for size in args.sizes.split(',')],
+    )
+    report = dict(
+        kernel = platform.release(),
+        python = platform.python_version(),
+        iterations = args.iterations,
+        results = results,
+    )
+
+    data = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(data + '\n')
+    else:
+        print(data)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ Example jailed Python REPL
 '''
 
 from code import interact
+import distutils.sysconfig
 import errno
 import grp
 import os
@@ -13,29 +14,29 @@ import pwd
 import resource
 import signal
 import sys
-import tempfile
 
 from sandboxed import const
 from sandboxed.lowlevel import (
-    clone,
     getpid,
     pivot_root,
     sethostname,
-    umount,
 )
+from sandboxed.rootfs import RootfsTemplate, remount_readonly
 from sandboxed.utils import (
-    mount_bind,
+    clone_child,
     mount_cgroup,
     mount_simple_dev,
     mount_proc,
-    mount_python_lib,
-    mount_tmpfs,
     umount_all,
 )
 
 
 class InteractiveJail:
-    def __init__(self, fs_size=2000, gname=None, uname=None, hostname=None, ignore_mounts=None, remount_ro=True, mount_cgroup=False, mount_dev=False):
+    def __init__(self, fs_size=2000, gname=None, uname=None, hostname=None, ignore_mounts=None, remount_ro=True, mount_cgroup=False, mount_dev=False, namespaces=None):
+        '''
+        `namespaces` is optional `sandboxed.namespaces.NamespacePool`,
+        jail enters namespaces taken from it instead of creating them.
+        '''
         self.fs_size = fs_size
         self.gname = gname
         self.uname = uname
@@ -44,20 +45,22 @@ class InteractiveJail:
         self.remount_ro = remount_ro
         self.mount_cgroup = mount_cgroup
         self.mount_dev = mount_dev
+        self.namespaces = namespaces
         
-    def setup_fs(self, path):
+    def setup_fs(self, template):
         '''
-        Setup filesystem before entering jail
+        Setup filesystem before entering jail, `template` is
+        `sandboxed.rootfs.RootfsTemplate` of jail root
         '''
-        pylib, pylib_mount = mount_python_lib(path)
-        self.pylib_mount = pylib_mount
+        pylib = distutils.sysconfig.get_python_lib(standard_lib=True)
+        pylib = os.path.realpath(pylib)
+        template.bind(pylib, pylib)
         self.ignore_mounts.append(pylib)
 
-    def teardown_fs(self, path):
+    def teardown_fs(self, template):
         '''
         If needed, unload/unmount/remove anything that was set up in setup_fs
         '''
-        umount(self.pylib_mount)
 
     def prisoner(self):
         '''
@@ -79,29 +82,36 @@ class InteractiveJail:
         if self.uname:
             uid = pwd.getpwnam(self.uname).pw_uid
 
-        # Create temporary mountpoint for tmpfs
-        tmp = tempfile.mkdtemp()
+        # Template of root, with directory for old root
+        template = RootfsTemplate(self.fs_size)
+        put_old = 'root'
+        template.mkdir(put_old)
 
-        # Mount tmpfs for our use
-        mount_tmpfs(self.fs_size, tmp)
+        # Copy stuff to template
+        self.setup_fs(template)
 
-        # Create directory for old root
-        put_old = 'root'
+        # Writable root made of template
+        root = template.new_root(self.fs_size)
+        tmp = root.path
         old_root = os.path.join(tmp, put_old)
-        os.mkdir(old_root)
 
-        # Copy stuff to tmpfs
-        self.setup_fs(tmp)
+        # Prepared namespaces, if we have them
+        namespaces = self.namespaces.take() if self.namespaces else None
 
         # Clone and create new namespaces. Note CLONE_NEWUSER is not used (yet?)
-        pid = clone(
+        flags = (
             const.CLONE_NEWNS |
             const.CLONE_NEWPID |
             const.CLONE_NEWUTS |
             const.CLONE_NEWNET |
             const.CLONE_NEWIPC
         )
-        assert pid is not None
+        if namespaces:
+            flags &= ~namespaces.flags
+        # Not raw clone: namespace pool may run a thread, see `clone_child`
+        pid, pidfd = clone_child(flags, exit_signal = 0)
+        if pidfd is not None:
+            os.close(pidfd)
         if pid:
             try:
                 while True:
@@ -122,11 +132,13 @@ class InteractiveJail:
                         if pid2 == pid:
                             break
             finally:
-                self.teardown_fs(tmp)
+                self.teardown_fs(template)
 
-                # Umount tmpfs and remove mountpoint
-                umount(tmp)
-                os.rmdir(tmp)
+                # Umount root and template
+                root.discard()
+                template.close()
+                if namespaces:
+                    namespaces.discard()
             
             #print('Child {} exited with status {}'.format(pid, status))
             sys.exit(status)
@@ -135,6 +147,10 @@ class InteractiveJail:
             # Note we use syscall getpid instead of stdlib getpid
             assert getpid() == 1
 
+            # Enter prepared namespaces before anything is done in them
+            if namespaces:
+                namespaces.enter()
+
             # Set desired hostname
             if self.hostname:
                 sethostname(self.hostname)
@@ -164,9 +180,9 @@ class InteractiveJail:
 
             os.environ.clear()
 
-            # Remount tmpfs r/o
+            # Remount root r/o
             if self.remount_ro:
-                mount_tmpfs(self.fs_size, '/', const.MS_REMOUNT | const.MS_RDONLY)
+                remount_readonly('/')
 
             # Set to desired gid/uid
             if gid:
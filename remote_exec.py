@@ -4,16 +4,21 @@
 Python executor by socket
 '''
 
+import collections
 import errno
 import fcntl
 import io
+import json
+import math
 import os
 import os.path
 import resource
 import select
 import signal
 import socket
+import struct
 import sys
+import tempfile
 import time
 import traceback
 import errno
@@ -23,24 +28,31 @@ import os.path
 import pwd
 import signal
 import sys
-import tempfile
 
-from sandboxed import const
+from sandboxed import const, protocol, trace, zygote
+from sandboxed.cgroup import CgroupTree
+from sandboxed.image import mount_image
 from sandboxed.lowlevel import (
+    clock_getcpuclockid,
+    memfd_create,
+    mount,
     pivot_root,
     sethostname,
-    umount,
+    signalfd,
+    splice,
+    unshare,
 )
+from sandboxed.rootfs import RootfsTemplate, remount_readonly
 from sandboxed.utils import (
+    ChildWatcher,
     clone_and_wait,
-    mount_bind,
+    clone_child,
+    detach,
     mount_proc,
-    mount_tmpfs,
-    patient_terminate,
-    try_kill,
-    try_mkdir,
+    read_signals,
+    recv_fds,
+    send_fds,
     umount_all,
-    wait_for_pid,
 )
 
 # Preload stuff
@@ -48,43 +60,690 @@ from sandboxed.utils import (
 # to preload modules
 'abc'.encode('ANSI_X3.4-1968').decode('ANSI_X3.4-1968')
 
-try:
-    PIPE_BUF = select.PIPE_BUF
-except AttributeError:
-    PIPE_BUF = 512
+# Limit of address space of executed script
+MEM_BYTES = 1024*1024*100
+
+# Default limits of per-execution cgroup, see `Cgroup.set_limits`
+CGROUP_LIMITS = dict(
+    memory_max = MEM_BYTES,
+    pids_max = 1,
+)
+
+# Executed by prisoners, or its bytecode (see `Jail.find_main_script`)
+MAIN_SCRIPT = '/usr/bin/main.py'
+
+# Where old root is put by pivot_root
+PUT_OLD = 'root'
+# Where worker roots mount their layer, and see the template
+LAYER_DIR = '.layer'
+TEMPLATE_DIR = '.template'
+
+# Default limit of execution time, in seconds
+TIME_LIMIT = 6
+TIMEOUT_MESSAGE = 'Time limit of {} ms passed, giving up'
+# What legacy clients always got, kept for them while limit is default
+LEGACY_TIMEOUT_MESSAGE = 'Six seconds of execution passed, giving up'
+CPU_LIMIT_MESSAGE = 'CPU time limit of {} ms exceeded, giving up'
+# How long legacy client can stall after time limit, before worker quits
+TIME_GRACE = 1
+# Least interval of checking prisoner's CPU time, in seconds
+CPU_CHECK_INTERVAL = 0.001
+
+# How much we read at once from connection or prisoner's stdout
+BUF_SIZE = 64 * 1024
+
+# Sent after output cut at its limit, in the same stream
+TRUNCATED_MESSAGE = '\n[{} truncated after {} bytes]\n'
+# Limit of each output spooled in worker's memory, unless set lower
+SPOOL_LIMIT = 16 * 1024 * 1024
+
+# Signals master receives through signalfd
+MASTER_SIGNALS = (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT)
+
+# How often master appends spans to trace file, in seconds
+TRACE_INTERVAL = 1.0
+
+# Sent to clients whose connections admission control rejects
+OVERLOADED_MESSAGE = 'Server overloaded, try again later'
+QUEUE_TIMEOUT_MESSAGE = 'No worker was free for {} ms, giving up'
+SHUTDOWN_MESSAGE = 'Server is shutting down'
+# How many buffers of input of rejected connection we read at most
+REJECT_DRAIN = 16
+# How long rejected connection waits for client's first bytes, which
+# tell if it speaks framed protocol, in seconds
+REJECT_WAIT = 0.5
+
+# struct ucred: pid, uid and gid of peer
+PEERCRED = struct.Struct('=iII')
 
 _old_sigterm = signal.getsignal(signal.SIGTERM)
 _old_sigint = signal.getsignal(signal.SIGINT)
 def reset_signals():
     signal.signal(signal.SIGTERM, _old_sigterm)
     signal.signal(signal.SIGINT, _old_sigint)
+    # Blocked signals are inherited by children of master
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+
+def peer_uid(connection):
+    '''
+    Returns uid of process which connected unix socket `connection`
+    '''
+    _, uid, _ = PEERCRED.unpack(connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size))
+    return uid
+
+def peek_framing(connection):
+    '''
+    Returns True if client of `connection` started with `protocol.MAGIC`,
+    False if with anything else (or if it disconnected), None if it's not
+    known yet. Nothing is consumed, and we don't wait.
+    '''
+    size = len(protocol.MAGIC)
+    try:
+        data = connection.recv(size, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return None
+    if not data:
+        return False
+    if len(data) < size and protocol.MAGIC.startswith(data):
+        # Magic was split between writes
+        return None
+    return data == protocol.MAGIC
+
+def _rusage_dict(usage):
+    '''
+    Converts `lowlevel.rusage` into dict like the one zygote sends
+    '''
+    return dict(
+        utime = usage.ru_utime.tv_sec + usage.ru_utime.tv_usec / 1000000,
+        stime = usage.ru_stime.tv_sec + usage.ru_stime.tv_usec / 1000000,
+        maxrss = usage.ru_maxrss,
+        nvcsw = usage.ru_nvcsw,
+        nivcsw = usage.ru_nivcsw,
+    )
+
+class Prisoner:
+    '''
+    Jailed child executing main.py, as seen by worker.
+
+    It is either our own child, or child of zygote - then we learn about
+    its exit from zygote socket instead of waitid. In both cases we
+    signal it through pidfd held by `watcher`.
+
+    `fileno()` becomes readable when prisoner may have exited, so it can
+    be watched together with other descriptors; `poll()` tells for sure.
+
+    `stdin`, `stdout` and `stderr` are our ends of its pipes, None once
+    closed. `cgroup` is cgroup created for this execution, if any.
+
+    Once it exits, `rusage` is dict of its resource usage (None if we
+    couldn't get it), see `usage`.
+    '''
+    def __init__(self, watcher, stdin, stdout, stderr, zygote_sock=None, cgroup=None):
+        self.watcher = watcher
+        self.pid = watcher.pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.zygote_sock = zygote_sock
+        self.cgroup = cgroup
+        self.status = None
+        self.rusage = None
+        # Set by worker: when connection was handed to prisoner, how
+        # many bytes went from client to prisoner and back, and if we
+        # killed it for running too long
+        self.started = time.monotonic()
+        self.finished = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timed_out = False
+        # Limits of current execution, in seconds (`cpu_limit` can be
+        # None), see `Jail.set_limits`
+        self.time_limit = None
+        self.cpu_limit = None
+        self.cpu_exceeded = False
+        # CPU time used before execution started, and clock measuring it
+        self.cpu_start = 0
+        self.cpu_clock = None
+        # When first output came, for tracing
+        self.first_output = None
+        # Names of outputs cut at their limit
+        self.truncated = []
+        # Output as sent to client, if relay was asked to keep it
+        self.captured = None
+
+    @property
+    def deadline(self):
+        '''
+        Monotonic time when current execution runs out of time
+        '''
+        if self.time_limit is None:
+            return None
+        return self.started + self.time_limit
+
+    def fileno(self):
+        if self.zygote_sock:
+            return self.zygote_sock.fileno()
+        return self.watcher.fileno()
+
+    def poll(self):
+        '''
+        Returns True if prisoner exited. Never blocks.
+        '''
+        if self.status is not None:
+            return True
+        if not self.zygote_sock:
+            if not self.watcher.poll():
+                return False
+            self.status = self.watcher.status
+            if self.watcher.rusage:
+                self.rusage = _rusage_dict(self.watcher.rusage)
+        else:
+            try:
+                msg = self.zygote_sock.recv(64, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return False
+            if msg:
+                _, self.status, self.rusage = zygote.unpack_exited(msg)
+            else:
+                # Zygote died and took the child with it
+                self.status = -1
+        self.finished = time.monotonic()
+        return True
+
+    def wait(self, timeout = None):
+        '''
+        Waits at most `timeout` seconds (forever if None) for prisoner
+        to exit. Returns True if it did.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.poll():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+            select.select([self], [], [], remaining)
+        return True
+
+    def kill(self):
+        '''
+        Kills prisoner and anything it left in its cgroup. Doesn't wait.
+        '''
+        self.watcher.kill(signal.SIGKILL)
+        if self.cgroup:
+            self.cgroup.kill()
+
+    def terminate(self):
+        '''
+        Gives prisoner a moment to quit, then sends SIGTERM and SIGKILL
+        '''
+        if self.wait(0.1):
+            return
+        self.watcher.kill(signal.SIGTERM)
+        if self.wait(1):
+            return
+        self.watcher.kill(signal.SIGKILL)
+        self.wait()
+
+    def cpu_time(self):
+        '''
+        Returns CPU time used by prisoner so far (by its cgroup, if it
+        has one), in seconds, or None if prisoner is gone
+        '''
+        try:
+            if self.cgroup:
+                return self.cgroup.cpu_stat()['usage_usec'] / 1000000
+            if self.cpu_clock is None:
+                self.cpu_clock = clock_getcpuclockid(self.pid)
+            return time.clock_gettime(self.cpu_clock)
+        except (OSError, KeyError):
+            return None
+
+    def start_cpu_limit(self):
+        '''
+        Starts counting CPU time against `cpu_limit`, see `relay`.
+        Spawning doesn't count. In case worker doesn't kill prisoner in
+        time, RLIMIT_CPU makes kernel do it a second or two later.
+        '''
+        self.cpu_start = self.cpu_time() or 0
+        hard = math.ceil(self.cpu_start + self.cpu_limit) + 1
+        try:
+            resource.prlimit(self.pid, resource.RLIMIT_CPU, (hard, hard))
+        except OSError:
+            # Already gone
+            pass
+
+    def limit_error(self, legacy = False):
+        '''
+        Returns message telling which limit was exceeded, or None.
+        With `legacy`, it's for legacy protocol client.
+        '''
+        if self.timed_out:
+            if legacy and self.time_limit == TIME_LIMIT:
+                return LEGACY_TIMEOUT_MESSAGE
+            return TIMEOUT_MESSAGE.format(round(self.time_limit * 1000))
+        if self.cpu_exceeded:
+            return CPU_LIMIT_MESSAGE.format(round(self.cpu_limit * 1000))
+        return None
+
+    def usage(self):
+        '''
+        Returns report of exit status and resource usage, once prisoner
+        exited. Times are in seconds, `maxrss` and `memory_peak` in KiB
+        and bytes. Unknown values are None.
+        '''
+        report = dict(
+            exit_code = None,
+            signal = None,
+            timed_out = self.timed_out,
+            cpu_exceeded = self.cpu_exceeded,
+            wall_time = None,
+            bytes_in = self.bytes_in,
+            bytes_out = self.bytes_out,
+            truncated = list(self.truncated),
+        )
+        if self.finished is not None:
+            report['wall_time'] = round(self.finished - self.started, 6)
+        if self.status is not None and self.status >= 0:
+            if os.WIFSIGNALED(self.status):
+                report['signal'] = os.WTERMSIG(self.status)
+            else:
+                report['exit_code'] = os.WEXITSTATUS(self.status)
+        for key in ('utime', 'stime', 'maxrss', 'nvcsw', 'nivcsw'):
+            report[key] = self.rusage[key] if self.rusage else None
+        if self.cgroup:
+            report['memory_peak'] = self.cgroup.memory_peak()
+            try:
+                report['cpu_usec'] = self.cgroup.cpu_stat().get('usage_usec')
+            except OSError:
+                report['cpu_usec'] = None
+        return report
+
+    def cleanup(self):
+        '''
+        Closes our ends of pipes and pidfd, and removes prisoner's
+        cgroup, killing anything left in it
+        '''
+        for name in ('stdin', 'stdout', 'stderr'):
+            fd = getattr(self, name)
+            if fd is not None:
+                os.close(fd)
+                setattr(self, name, None)
+        self.watcher.close()
+        if self.cgroup:
+            self.cgroup.remove()
+            self.cgroup = None
 
 class Jail:
-    def __init__(self, socket_file, fs_size=2000, gname=None, uname=None, hostname=None, usr_path=None):
+    def __init__(
+        self, socket_file, fs_size=2000, gname=None, uname=None, hostname=None, usr_path=None,
+        use_zygote=False, preload=(), entry='main', use_splice=True,
+        pool_size=5, backlog=128, cgroup_path=None, cgroup_limits=None,
+        report_usage=False, idle_timeout=5, worker_roots=False, root_size=1000,
+        tracer=None, trace_file=None,
+        stdout_limit=None, stderr_limit=None, spool_output=False, cache=None,
+        acceptors=1, acceptor_cpus=None, worker_cpus=None,
+        time_limit=TIME_LIMIT, cpu_limit=None,
+        queue_size=None, queue_per_peer=None, queue_timeout=None,
+    ):
+        '''
+        Jail serving executions of main.py on unix socket `socket_file`.
+        Prisoners run as `uname` and `gname`, in jail named `hostname`
+        whose root template has `fs_size` kilobytes. Other options:
+
+            usr_path        Python distribution mounted as `/usr`: directory
+                            or image file made by `sandboxed.image`
+            pool_size       prespawned workers, also limit of concurrent
+                            executions; `backlog` is passed to `listen`
+            use_zygote      fork prisoners from zygote which imported
+                            `preload` modules and main.py, and call its
+                            `entry` function, see `sandboxed.zygote`
+            use_splice      move output to clients by splice(2)
+            cgroup_path     cgroup v2 tree with cgroup of each execution,
+                            limited by `cgroup_limits` (CGROUP_LIMITS)
+                            instead of rlimits, see `sandboxed.cgroup`
+            report_usage    send JSON usage report after legacy output,
+                            see `Prisoner.usage`
+            idle_timeout    seconds framed connection can wait for next
+                            request, see `sandboxed.protocol`
+            worker_roots    own writable root for each worker, with
+                            `root_size` kilobytes, see `sandboxed.rootfs`;
+                            not with `use_zygote`
+            tracer          `sandboxed.trace.Tracer` of jail lifecycle;
+                            spans are appended to `trace_file` as JSON
+                            lines every TRACE_INTERVAL seconds
+            stdout_limit    bytes of output sent to client, rest is cut,
+            stderr_limit    see `relay`
+            spool_output    collect output in memfd, send it once
+                            prisoner closed its outputs, see `relay`
+            cache           `sandboxed.cache.ResultCache` of results, see
+                            `cached_result`
+            acceptors       processes accepting connections, pinned to
+                            `acceptor_cpus`, with their workers pinned to
+                            `worker_cpus`, see `cpu_plan`; at most
+                            `pool_size`, which is split between them
+            time_limit      wall clock and CPU time of each execution, in
+            cpu_limit       seconds; framed clients can lower them
+            queue_size      admission queue of connections waiting for
+                            worker, at most `queue_per_peer` from each
+                            peer uid, for `queue_timeout` seconds, see
+                            `setup_workers`; each acceptor has its own
+                            queue, and peers take turns only in it
+        '''
+        if worker_roots and use_zygote:
+            raise ValueError('worker_roots can not be used with use_zygote')
+        if acceptors > pool_size:
+            raise ValueError('acceptors can not outnumber pool_size')
+
         self.fs_size = fs_size
         self.gid = grp.getgrnam(gname).gr_gid
         self.uid = pwd.getpwnam(uname).pw_uid
         self.hostname = hostname
         self.usr_path = usr_path
+        # Where usr_path is, or where it's mounted if it's image file
+        self.usr_dir = usr_path
+        self.use_zygote = use_zygote
+        self.preload = preload
+        self.entry = entry
+        self.use_splice = use_splice
+        self.pool_size = pool_size
+        self.cgroup_path = cgroup_path
+        self.cgroup_limits = CGROUP_LIMITS if cgroup_limits is None else cgroup_limits
+        self.report_usage = report_usage
+        self.idle_timeout = idle_timeout
+        self.worker_roots = worker_roots
+        self.root_size = root_size
+        if tracer is None:
+            tracer = trace.Tracer() if trace_file else trace.NullTracer()
+        self.tracer = tracer
+        self.trace_file = trace_file
+        self.trace_fd = None
+        if spool_output:
+            if stdout_limit is None or stdout_limit > SPOOL_LIMIT:
+                stdout_limit = SPOOL_LIMIT
+            if stderr_limit is None or stderr_limit > SPOOL_LIMIT:
+                stderr_limit = SPOOL_LIMIT
+        self.stdout_limit = stdout_limit
+        self.stderr_limit = stderr_limit
+        self.spool_output = spool_output
+        self.cache = cache
+        self.acceptors = acceptors
+        self.time_limit = time_limit
+        self.cpu_limit = cpu_limit
+        self.acceptor_cpus = acceptor_cpus
+        self.worker_cpus = worker_cpus
+        self.queue_size = queue_size
+        self.queue_per_peer = queue_size if queue_per_peer is None else queue_per_peer
+        self.queue_timeout = queue_timeout
+        # Computed in `start`, cache keys depend on it
+        self.fingerprint = None
+        # Path in jail of what prisoners execute, see `find_main_script`
+        self.main_script = MAIN_SCRIPT
+        # Template of worker roots, as seen from inside of jail
+        self.template = None
+        # Created in `start`, before we lose access to cgroup filesystem
+        self.cgroups = None
 
         if os.path.exists(socket_file):
             os.remove(socket_file)
 
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         sock.bind(socket_file)
-        sock.listen(1)
+        sock.listen(backlog)
         fd = sock.fileno()
         os.chmod(socket_file, 0o666)
 
         self.sock_info = sock, fd
 
-    def setup_workers(self):
+    def cpu_plan(self):
+        '''
+        Returns list of 2tuples, one for each acceptor: set of CPUs it's
+        pinned to, and set of CPUs its workers are pinned to. Either is
+        None if it's not pinned.
+
+        Worker CPUs are split into contiguous shards, shared by
+        acceptors only if there are fewer CPUs than acceptors.
+        '''
+        acceptor_cpus = sorted(self.acceptor_cpus) if self.acceptor_cpus else None
+        worker_cpus = self.worker_cpus
+        if worker_cpus is None and acceptor_cpus:
+            worker_cpus = os.sched_getaffinity(0) - set(acceptor_cpus)
+        worker_cpus = sorted(worker_cpus) if worker_cpus else None
+
+        plan = []
+        for index in range(self.acceptors):
+            own = shard = None
+            if acceptor_cpus:
+                own = {acceptor_cpus[index % len(acceptor_cpus)]}
+            if worker_cpus:
+                count = len(worker_cpus)
+                if count >= self.acceptors:
+                    shard = set(worker_cpus[index * count // self.acceptors:(index + 1) * count // self.acceptors])
+                else:
+                    shard = {worker_cpus[index % count]}
+            plan.append((own, shard))
+        return plan
+
+    def run_acceptors(self):
+        '''
+        Runs `acceptors` processes, each with `setup_workers` and its part
+        of the pool, pinned according to `cpu_plan`. With just one, it's
+        us. Otherwise we restart them when they die, until SIGTERM or
+        SIGINT; then they are told to quit and waited for.
+        '''
+        plan = self.cpu_plan()
+        sizes = [
+            self.pool_size // self.acceptors + (index < self.pool_size % self.acceptors)
+            for index in range(self.acceptors)
+        ]
+        if self.acceptors == 1:
+            own, worker_cpus = plan[0]
+            if own:
+                os.sched_setaffinity(0, own)
+            self.setup_workers(self.pool_size, worker_cpus)
+            return
+
+        tracer = self.tracer
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        sig_fd = signalfd(MASTER_SIGNALS, flags = const.SFD_NONBLOCK | const.SFD_CLOEXEC)
+        # Acceptors start with no spans of ours
+        self.export_trace()
+        # pid => acceptor index
+        acceptors = {}
+        running = True
+
+        def spawn(index):
+            pid = os.fork()
+            if not pid:
+                status = 1
+                try:
+                    os.close(sig_fd)
+                    tracer.drain()
+                    own, worker_cpus = plan[index]
+                    if own:
+                        os.sched_setaffinity(0, own)
+                    self.setup_workers(sizes[index], worker_cpus)
+                    status = 0
+                except:
+                    sys.excepthook(*sys.exc_info())
+                finally:
+                    os._exit(status)
+            acceptors[pid] = index
+            tracer.event('acceptor.spawn', pid = pid, index = index)
+
+        def wait_for_pids():
+            # Orphans of whole jail end up with us
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if not pid:
+                    break
+                if pid in acceptors:
+                    index = acceptors.pop(pid)
+                    tracer.event('acceptor.exit', pid = pid, index = index, status = status)
+                    if running:
+                        spawn(index)
+
+        try:
+            for index in range(self.acceptors):
+                spawn(index)
+            while running:
+                select.select([sig_fd], [], [])
+                for signum in read_signals(sig_fd):
+                    if signum != signal.SIGCHLD:
+                        running = False
+                wait_for_pids()
+                self.export_trace()
+        finally:
+            running = False
+            for pid in acceptors:
+                os.kill(pid, signal.SIGTERM)
+            while acceptors:
+                select.select([sig_fd], [], [])
+                read_signals(sig_fd)
+                wait_for_pids()
+            os.close(sig_fd)
+            if self.cgroups:
+                self.cgroups.clear()
+            self.export_trace()
+
+    def setup_workers(self, pool_size, worker_cpus=None):
+        '''
+        Keeps a pool of `pool_size` prespawned workers and hands each
+        accepted connection to an idle one over its control socket
+        (SCM_RIGHTS). Workers serve one connection and quit, pool is
+        refilled on exit. Workers (and zygote) are pinned to
+        `worker_cpus`, if given.
+
+        We sleep in epoll until there is a connection to accept (and idle
+        worker for it) or a signal arrives through signalfd. Other
+        acceptors may wait for the same socket, so only one of us is
+        woken up for a connection (EPOLLEXCLUSIVE).
+
+        With admission queue (`queue_size`), we always accept, and wake
+        up also when the oldest queued connection is due to be rejected.
+        Rejected connection is watched until its client sends enough to
+        tell which protocol it speaks, for `REJECT_WAIT` at most.
+        '''
         sock, fd = self.sock_info
+        sock.setblocking(False)
+
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        sig_fd = signalfd(MASTER_SIGNALS, flags = const.SFD_NONBLOCK | const.SFD_CLOEXEC)
+        epoll = select.epoll()
+        epoll.register(sig_fd, select.EPOLLIN)
+        # EPOLLEXCLUSIVE can't be modified, so socket is registered only
+        # while we accept
+        accept_events = select.EPOLLIN
+        if self.acceptors > 1:
+            accept_events |= select.EPOLLEXCLUSIVE
+        accepting = False
+        # Workers send their spans to us
+        tracer = self.tracer
+        tracer.listen()
+        trace_fd = tracer.fileno()
+        if trace_fd is not None:
+            epoll.register(trace_fd, select.EPOLLIN)
 
-        pids = set()
+        # pid => control socket, None after connection was handed off
+        workers = {}
+        idle = collections.deque()
         running = True
+        # pid and control socket of zygote
+        zygote_info = None
+        # Admission queue: peer uid => deque of (connection, when it was
+        # accepted), peers in order of their turns
+        admission = self.queue_size is not None
+        queue = collections.OrderedDict()
+        queued = 0
+        # Rejected connections whose clients didn't send anything yet:
+        # fd => (connection, reason, message, deadline)
+        rejecting = {}
+
+        def accept(enabled):
+            nonlocal accepting
+            if enabled == accepting:
+                return
+            if enabled:
+                epoll.register(fd, accept_events)
+            else:
+                epoll.unregister(fd)
+            accepting = enabled
+
+        def spawn_zygote():
+            control, zygote_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            pid = os.fork()
+            if not pid:
+                try:
+                    if worker_cpus:
+                        os.sched_setaffinity(0, worker_cpus)
+                    reset_signals()
+                    sock.close()
+                    control.close()
+                    fd = zygote_control.fileno()
+                    os.set_inheritable(fd, True)
+                    os.execv('/usr/bin/python', (
+                        '/usr/bin/python', '/zygote.py',
+                        '--control-fd', str(fd),
+                        '--uid', str(self.uid),
+                        '--gid', str(self.gid),
+                        '--mem-bytes', str(MEM_BYTES),
+                        '--preload', ','.join(self.preload),
+                        '--entry', self.entry,
+                        self.main_script,
+                    ))
+                except:
+                    sys.excepthook(*sys.exc_info())
+                    os._exit(1)
+            zygote_control.close()
+            tracer.event('zygote.spawn', pid = pid)
+            return pid, control
+
+        def spawn_worker():
+            control, worker_control = socket.socketpair()
+            zygote_sock = None
+            if zygote_info:
+                zygote_sock, zygote_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                try:
+                    send_fds(zygote_info[1], [zygote_end.fileno()])
+                except OSError:
+                    # Zygote just died, this worker will exec main.py itself
+                    zygote_sock.close()
+                    zygote_sock = None
+                finally:
+                    zygote_end.close()
+            pid = os.fork()
+            if not pid:
+                sock.close()
+                epoll.close()
+                # Or their clients wait for EOF as long as this worker lives
+                for waiting in queue.values():
+                    for connection, _ in waiting:
+                        connection.close()
+                for connection, *_ in rejecting.values():
+                    connection.close()
+                os.close(sig_fd)
+                control.close()
+                for other in workers.values():
+                    if other:
+                        other.close()
+                if zygote_info:
+                    zygote_info[1].close()
+                tracer.forked()
+                if worker_cpus:
+                    os.sched_setaffinity(0, worker_cpus)
+                self.worker(worker_control, zygote_sock)
+            worker_control.close()
+            if zygote_sock:
+                zygote_sock.close()
+            workers[pid] = control
+            idle.append(pid)
+            tracer.event('worker.spawn', pid = pid, workers = len(workers))
 
         def wait_for_pids():
+            nonlocal zygote_info
             while True:
                 try:
                     pid, status = os.waitpid(0, os.WNOHANG)
@@ -92,71 +751,353 @@ class Jail:
                     if exc.errno == errno.ECHILD:
                         break
                     raise
-                if pid in pids:
-                    pids.remove(pid)
-                    print('removing pid: {} status: {} workers: {}'.format(pid, status, len(pids)))
+                if not pid:
+                    break
+                if pid in workers:
+                    control = workers.pop(pid)
+                    if control:
+                        control.close()
+                        idle.remove(pid)
+                    tracer.event('worker.exit', pid = pid, status = status, workers = len(workers))
+                elif zygote_info and pid == zygote_info[0]:
+                    zygote_info[1].close()
+                    zygote_info = None
+                    tracer.event('zygote.exit', pid = pid, status = status)
+            if running and self.use_zygote and not zygote_info:
+                zygote_info = spawn_zygote()
+            while running and len(workers) < pool_size:
+                spawn_worker()
 
-        def handle_signal(signum, frame):
-            nonlocal running, pids
-            running = False
-            for pid in pids:
-                print('SIGTERM pid: {}'.format(pid))
-                os.kill(pid, signal.SIGTERM)
-            time.sleep(0.2)
+        def hand_off(conn):
+            while idle:
+                pid = idle.popleft()
+                control = workers[pid]
+                workers[pid] = None
+                try:
+                    send_fds(control, [conn.fileno()])
+                    return pid
+                except OSError:
+                    # Worker died before it got reaped, try next one
+                    continue
+                finally:
+                    control.close()
+            return None
+
+        def reject(conn, reason, message, uid, started):
+            '''
+            Rejects connection once we know which protocol its client
+            speaks, see `finish_reject`
+            '''
+            tracer.add('reject', started, reason = reason, uid = uid)
+            framed = peek_framing(conn)
+            if framed is None and running:
+                rejecting[conn.fileno()] = (conn, reason, message, time.monotonic() + REJECT_WAIT)
+                # Edge triggered, see `detect_framing`
+                epoll.register(conn, select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLET)
+                return
+            self.reject(conn, reason, message, bool(framed))
+
+        def finish_reject(fd, force = False):
+            '''
+            Rejects waiting connection if its client sent enough to tell
+            its protocol, or disconnected. With `force`, legacy protocol
+            is assumed if it's still not known.
+            '''
+            conn, reason, message, _ = rejecting[fd]
+            framed = peek_framing(conn)
+            if framed is None and not force:
+                return
+            del rejecting[fd]
+            epoll.unregister(fd)
+            self.reject(conn, reason, message, bool(framed))
+
+        def expire_rejects(now):
+            '''
+            Rejects connections which waited `REJECT_WAIT` for their
+            clients. Returns seconds until next one is due, or None.
+            '''
+            due = None
+            for fd, (_, _, _, deadline) in list(rejecting.items()):
+                if deadline <= now:
+                    finish_reject(fd, force = True)
+                elif due is None or deadline - now < due:
+                    due = deadline - now
+            return due
+
+        def admit(conn, started):
+            '''
+            Queues accepted connection, or rejects it if there's no room
+            '''
+            nonlocal queued
+            uid = peer_uid(conn)
+            waiting = queue.get(uid, ())
+            # Queue is empty if any worker is idle
+            if not idle and (queued >= self.queue_size or len(waiting) >= self.queue_per_peer):
+                reject(conn, 'overloaded', OVERLOADED_MESSAGE, uid, started)
+                return
+            if not waiting:
+                waiting = queue[uid] = collections.deque()
+            waiting.append((conn, started))
+            queued += 1
+
+        def dispatch():
+            '''
+            Hands off queued connections to idle workers, one of each
+            peer in turn
+            '''
+            nonlocal queued
+            while idle and queue:
+                uid, waiting = next(iter(queue.items()))
+                conn, started = waiting.popleft()
+                queued -= 1
+                if waiting:
+                    queue.move_to_end(uid)
+                else:
+                    del queue[uid]
+                try:
+                    worker = hand_off(conn)
+                finally:
+                    conn.close()
+                tracer.add('accept', started, worker = worker, uid = uid, queued = queued)
+
+        def expire(now):
+            '''
+            Rejects connections queued longer than `queue_timeout`.
+            Returns seconds until next one is due, or None.
+            '''
+            nonlocal queued
+            if self.queue_timeout is None:
+                return None
+            message = QUEUE_TIMEOUT_MESSAGE.format(int(self.queue_timeout * 1000))
+            due = None
+            for uid in list(queue):
+                waiting = queue[uid]
+                # Oldest connection of each peer is first
+                while waiting and waiting[0][1] + self.queue_timeout <= now:
+                    conn, started = waiting.popleft()
+                    queued -= 1
+                    reject(conn, 'queue_timeout', message, uid, started)
+                if not waiting:
+                    del queue[uid]
+                    continue
+                remaining = waiting[0][1] + self.queue_timeout - now
+                if due is None or remaining < due:
+                    due = remaining
+            return due
+
+        def accept_connections():
+            while idle or admission:
+                started = time.monotonic()
+                try:
+                    conn, _ = sock.accept()
+                except BlockingIOError:
+                    return
+                if admission:
+                    admit(conn, started)
+                    dispatch()
+                    continue
+                try:
+                    worker = hand_off(conn)
+                finally:
+                    # Worker has its own copy now
+                    conn.close()
+                # Worker is None if connection was dropped
+                tracer.add('accept', started, worker = worker)
+
+        def wait_for_workers(timeout):
+            '''
+            Reaps children until all workers quit or `timeout` passes
+            '''
+            deadline = time.monotonic() + timeout
             wait_for_pids()
-            if pids:
-                for pid in pids:
-                    print('SIGKILL pid: {}'.format(pid))
-                    os.kill(pid, signal.SIGKILL)
-                time.sleep(0.2)
+            while workers:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                if epoll.poll(remaining):
+                    read_signals(sig_fd)
                 wait_for_pids()
 
-        signal.signal(signal.SIGTERM, handle_signal)
-        signal.signal(signal.SIGINT, handle_signal)
+        def shutdown():
+            nonlocal queued
+            # Only SIGCHLD can wake us up now
+            accept(False)
+            while queue:
+                uid, waiting = queue.popitem(last = False)
+                for conn, started in waiting:
+                    reject(conn, 'shutdown', SHUTDOWN_MESSAGE, uid, started)
+            queued = 0
+            for fd in list(rejecting):
+                finish_reject(fd, force = True)
+            if zygote_info:
+                os.kill(zygote_info[0], signal.SIGTERM)
+            for pid in workers:
+                tracer.event('worker.kill', pid = pid, signal = signal.SIGTERM)
+                os.kill(pid, signal.SIGTERM)
+            wait_for_workers(0.2)
+            if workers:
+                for pid in workers:
+                    tracer.event('worker.kill', pid = pid, signal = signal.SIGKILL)
+                    os.kill(pid, signal.SIGKILL)
+                wait_for_workers(0.2)
+            if self.cgroups and self.acceptors == 1:
+                # Killed workers leave their cgroups behind, other
+                # acceptors' are cleared by init once all quit
+                self.cgroups.clear()
 
+        next_export = time.monotonic() + TRACE_INTERVAL
         try:
             while running:
                 wait_for_pids()
+                dispatch()
+                # Don't wake up for connections we can't hand off, unless
+                # we queue them
+                accept(bool(idle) or admission)
 
-                try:
-                    if len(pids) < 5 and select.select([fd], [], [], 0.02)[0]:
-                        conn, _ = sock.accept()
-                        pid = os.fork()
-                        if pid:
-                            pids.add(pid)
-                            print('adding pid: {} workers: {}'.format(pid, len(pids)))
-                        else:
-                            self.process_connection(conn)
+                timeouts = []
+                if self.trace_fd is not None and tracer.spans:
+                    timeouts.append(max(next_export - time.monotonic(), 0))
+                now = time.monotonic()
+                for due in (expire(now), expire_rejects(now)):
+                    if due is not None:
+                        timeouts.append(due)
+                for event_fd, _ in epoll.poll(min(timeouts) if timeouts else -1):
+                    if event_fd == sig_fd:
+                        for signum in read_signals(sig_fd):
+                            if signum != signal.SIGCHLD:
+                                running = False
+                    elif event_fd == trace_fd:
+                        tracer.receive()
+                    elif event_fd in rejecting:
+                        finish_reject(event_fd)
                     else:
-                        time.sleep(0.02)
-                except select.error as exc:
-                    if exc.args[0] == errno.EINTR:
-                        break
-                    raise
+                        accept_connections()
+                if self.trace_fd is not None and time.monotonic() >= next_export:
+                    self.export_trace()
+                    next_export = time.monotonic() + TRACE_INTERVAL
         finally:
+            running = False
+            shutdown()
             sock.close()
+            epoll.close()
+            os.close(sig_fd)
+            self.export_trace()
 
-    def process_connection(self, connection):
-        pid = None
-
-        def exit(status):
-            if pid:
-                patient_terminate(pid)
-            connection.send(b'\0')
+    def reject(self, connection, reason, message, framed):
+        '''
+        Tells client that its connection won't be served, and closes it,
+        without blocking. `framed` client (see `peek_framing`) gets STATUS
+        frame with `error` message and `rejected` reason, others get
+        legacy answer (message, nullchar and usage report, if enabled).
+        '''
+        report = dict(error = message, rejected = reason)
+        try:
+            connection.setblocking(False)
+            if framed:
+                data = protocol.MAGIC + protocol.pack_status(report)
+            else:
+                data = message.encode() + b'\0'
+                if self.report_usage:
+                    data += json.dumps(report, sort_keys = True).encode() + b'\n'
+            # Small enough for empty socket buffer
+            connection.send(data)
+            # Closing socket with unread data would make client's reads
+            # fail with ECONNRESET, instead of returning what we sent.
+            # Only what's already there is read, client can't hold us.
+            for _ in range(REJECT_DRAIN):
+                if not connection.recv(BUF_SIZE):
+                    break
+        except OSError:
+            # Client is gone
+            pass
+        finally:
             connection.close()
-            os._exit(status)
 
+    def export_trace(self):
+        '''
+        Appends spans recorded so far to `trace_file`, if we have one
+        '''
+        if self.trace_fd is not None:
+            self.tracer.export(self.trace_fd)
+
+    def worker(self, control, zygote_sock=None):
+        '''
+        Pool worker: spawns jailed interpreter right away, so it starts while
+        we are still idle, then waits for connection from master.
+        Never returns.
+        '''
         try:
             reset_signals()
+            if self.template:
+                self.enter_worker_root()
+            prisoner = self.new_prisoner(zygote_sock)
+            _, fds = recv_fds(control)
+            control.close()
+            if not fds:
+                # Master is gone, nothing to do
+                prisoner.watcher.kill(signal.SIGKILL)
+                prisoner.wait()
+                prisoner.cleanup()
+                os._exit(0)
+            connection = socket.fromfd(fds[0], socket.AF_UNIX, socket.SOCK_STREAM)
+            os.close(fds[0])
+            self.process_connection(connection, prisoner, zygote_sock)
+        except:
+            sys.excepthook(*sys.exc_info())
+        os._exit(1)
 
-            running = True
+    def enter_worker_root(self):
+        '''
+        Moves worker to its own mount namespace with new writable root.
+        It's gone with the namespace, when worker and its prisoners quit.
+        '''
+        unshare(const.CLONE_NEWNS)
+        mount(None, '/', None, const.MS_REC | const.MS_PRIVATE)
+        root = self.template.new_root(self.root_size, '/' + LAYER_DIR)
+        pivot_root(root.path, os.path.join(root.path, PUT_OLD))
+        os.chdir('/')
+        mount_proc()
+        detach('/' + PUT_OLD)
+        os.rmdir('/' + PUT_OLD)
 
-            in_r_pipe, in_w_pipe = os.pipe()
-            out_r_pipe, out_w_pipe = os.pipe()
-            sock_fd = connection.fileno()
+    def new_prisoner(self, zygote_sock=None):
+        '''
+        Creates cgroup for next execution, if we use them, and spawns
+        prisoner by ourselves or by zygote.
+        '''
+        with self.tracer.span('fork', zygote = bool(zygote_sock), cgroup = bool(self.cgroups)) as span:
+            cgroup = None
+            if self.cgroups:
+                cgroup = self.cgroups.create('run-{}'.format(os.getpid()), **self.cgroup_limits)
+            if zygote_sock:
+                prisoner = self.fork_prisoner(zygote_sock, cgroup)
+            else:
+                prisoner = self.spawn_prisoner(cgroup)
+            span.set(pid = prisoner.pid)
+        return prisoner
 
-            pid = os.fork()
-            if not pid:
+    def spawn_prisoner(self, cgroup=None):
+        '''
+        Forks child which drops privileges, sets limits and executes
+        `/usr/bin/main.py` (or `main.pyc`, see `find_main_script`).
+        Child starts right in `cgroup`, see `clone_child`.
+
+        When tracing, we wait until child executes Python: exec closes
+        its end of close-on-exec pipe.
+        '''
+        in_r_pipe, in_w_pipe = os.pipe()
+        out_r_pipe, out_w_pipe = os.pipe()
+        err_r_pipe, err_w_pipe = os.pipe()
+        exec_r_pipe = exec_w_pipe = None
+        if self.tracer.enabled:
+            exec_r_pipe, exec_w_pipe = os.pipe()
+
+        started = time.monotonic()
+        pid, pidfd = clone_child(cgroup_fd = cgroup.fileno() if cgroup else None)
+        if not pid:
+            try:
+                if exec_r_pipe is not None:
+                    os.close(exec_r_pipe)
                 os.setgid(self.gid)
                 os.setuid(self.uid)
 
@@ -165,104 +1106,865 @@ class Jail:
 
                 os.close(out_r_pipe)
                 os.dup2(out_w_pipe, sys.stdout.fileno())
-                os.dup2(out_w_pipe, sys.stderr.fileno())
+                os.close(err_r_pipe)
+                os.dup2(err_w_pipe, sys.stderr.fileno())
 
-                mem_bytes = 1024*1024*100
-                resource.setrlimit(resource.RLIMIT_AS, (mem_bytes, mem_bytes))
-                resource.setrlimit(resource.RLIMIT_NPROC, (1,1))
+                if not cgroup:
+                    resource.setrlimit(resource.RLIMIT_AS, (MEM_BYTES, MEM_BYTES))
+                    resource.setrlimit(resource.RLIMIT_NPROC, (1,1))
 
-                try:
-                    os.execv('/usr/bin/python', ('/usr/bin/python', '/usr/bin/main.py'))
-                except:
-                    sys.excepthook(*sys.exc_info())
-                    os._exit(1)
+                os.execv('/usr/bin/python', ('/usr/bin/python', self.main_script))
+            except:
+                sys.excepthook(*sys.exc_info())
+                os._exit(1)
+
+        os.close(err_w_pipe)
+        os.close(out_w_pipe)
+        os.close(in_r_pipe)
+        if exec_r_pipe is not None:
+            os.close(exec_w_pipe)
+            try:
+                os.read(exec_r_pipe, 1)
+            finally:
+                os.close(exec_r_pipe)
+            self.tracer.add('exec', started, pid = pid)
+        return Prisoner(ChildWatcher(pid, pidfd = pidfd), in_w_pipe, out_r_pipe, err_r_pipe, cgroup = cgroup)
 
+    def fork_prisoner(self, zygote_sock, cgroup=None):
+        '''
+        Asks zygote to fork child with our pipes as its stdio.
+        Child drops privileges and sets limits by itself, and moves
+        itself to `cgroup`, which we send as directory descriptor.
+        '''
+        in_r_pipe, in_w_pipe = os.pipe()
+        out_r_pipe, out_w_pipe = os.pipe()
+        err_r_pipe, err_w_pipe = os.pipe()
+        fds = [in_r_pipe, out_w_pipe, err_w_pipe]
+        if cgroup:
+            fds.append(cgroup.fileno())
+        try:
+            send_fds(zygote_sock, fds, zygote.FORK)
+        finally:
+            os.close(err_w_pipe)
             os.close(out_w_pipe)
             os.close(in_r_pipe)
+        msg, fds = recv_fds(zygote_sock, 1, 64)
+        if not msg:
+            raise EnvironmentError('Zygote is gone')
+        pid = zygote.unpack_started(msg)
+        # Zygote sends pidfd if its Python can open it, otherwise there is
+        # a tiny window in which pid could be reused before we open it
+        watcher = ChildWatcher(pid, pidfd = fds[0] if fds else None)
+        return Prisoner(watcher, in_w_pipe, out_r_pipe, err_r_pipe, zygote_sock, cgroup)
+
+    def detect_framing(self, connection, deadline=None):
+        '''
+        Returns True if client starts with `protocol.MAGIC`, consuming it.
+        Anything else is left in socket for legacy protocol, and so is
+        beginning of magic whose rest doesn't come until `deadline`.
+        '''
+        framed = peek_framing(connection)
+        if framed is None:
+            # Socket stays readable while it has data we only peek at, so
+            # epoll is edge triggered: it wakes us up when more comes
+            poller = select.epoll()
+            try:
+                poller.register(connection, select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLET)
+                while framed is None:
+                    timeout = -1
+                    if deadline is not None:
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    poller.poll(timeout)
+                    framed = peek_framing(connection)
+            finally:
+                poller.close()
+        if framed:
+            connection.recv(len(protocol.MAGIC))
+        return bool(framed)
+
+    def process_connection(self, connection, prisoner, zygote_sock=None):
+        '''
+        Serves connection. Clients of framed protocol are passed to
+        `process_frames`, others get one execution with legacy protocol.
+        Never returns.
+        '''
+        prisoner.started = time.monotonic()
+        # Input read ahead for cache, its key and stored result
+        received = key = cached = None
+        relayed = False
 
+        def exit(status, message = None):
+            teardown = time.monotonic()
+            if cached is None:
+                prisoner.terminate()
+                report = prisoner.usage()
+                if relayed:
+                    self.cache_result(key, prisoner, report)
+                if self.cache:
+                    report['cached'] = False
+            else:
+                # Prisoner has nothing to do
+                prisoner.kill()
+                prisoner.wait()
+                output, report = cached
+            try:
+                connection.setblocking(True)
+                if cached is not None:
+                    connection.sendall(output)
+                if message:
+                    connection.sendall(message)
+                connection.sendall(b'\0')
+                if self.report_usage:
+                    connection.sendall(json.dumps(report, sort_keys = True).encode() + b'\n')
+                connection.close()
+            except OSError:
+                # Client is gone
+                pass
+            prisoner.cleanup()
+            if cached is None:
+                self.trace_execution(prisoner, teardown, framed = False)
+            else:
+                self.trace_cached(prisoner.started, received[0], output, framed = False)
+            os._exit(status)
+
+        try:
             def handle_signal(signum, frame):
                 if signum == signal.SIGALRM:
-                    connection.send(b'Six seconds of execution passed, giving up')
-                else:
-                    connection.send(b'Signal received')
-                exit(1)
+                    prisoner.timed_out = True
+                    exit(1, prisoner.limit_error(legacy = True).encode())
+                exit(1, b'Signal received')
 
             signal.signal(signal.SIGALRM, handle_signal)
             signal.signal(signal.SIGTERM, handle_signal)
             signal.signal(signal.SIGINT, handle_signal)
 
-            signal.alarm(6)
-            continue_reading = True
-            continue_writing = True
+            self.set_limits(prisoner)
+            # Prisoner is killed by relay at its deadline, this is for
+            # client stalling before or after that
+            signal.setitimer(signal.ITIMER_REAL, prisoner.time_limit + TIME_GRACE)
             try:
-                while running:
-                    if wait_for_pid(pid, 1):
-                        running = False
+                if self.detect_framing(connection, prisoner.deadline):
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+                    self.process_frames(connection, prisoner, zygote_sock)
+                if self.cache:
+                    received = self.receive_input(connection, deadline = prisoner.deadline)
+                    key = self.cache_key(received, framed = False)
+                    cached = self.cached_result(key, prisoner)
+                if cached is None:
+                    relayed = self.relay(connection, prisoner, received = received, capture = key is not None)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            error = prisoner.limit_error(legacy = True)
+            if error:
+                # Also if relay gave up on client stalling after prisoner
+                # was killed, it's still told why
+                exit(1, error.encode())
+            if cached is None and not relayed:
+                # Socket disconnected, give up
+                exit(1)
+        except:
+            sys.excepthook(*sys.exc_info())
+        finally:
+            exit(0)
 
-                    while continue_writing:
-                        try:
-                            cr, cw, _ = select.select([connection], [in_w_pipe], [], 0.02)
-                        except select.error as exc:
-                            if exc.args[0] == errno.EINTR:
-                                break
-                            raise
-                        if not (cr and cw):
-                            break
+    def process_frames(self, connection, prisoner, zygote_sock=None):
+        '''
+        Serves connection with framed protocol (see `sandboxed.protocol`):
+        runs executions one by one, each in new prisoner, until client
+        disconnects or stays idle for `idle_timeout`. Never returns.
+        '''
+        frames = protocol.FrameReader()
 
-                        data = connection.recv(PIPE_BUF)
-                        if not data:
-                            # Socket disconnected, give up
-                            exit(1)
+        def exit(status):
+            teardown = time.monotonic()
+            prisoner.terminate()
+            prisoner.cleanup()
+            connection.close()
+            self.trace_execution(prisoner, teardown, framed = True)
+            os._exit(status)
+
+        try:
+            def handle_signal(signum, frame):
+                exit(1)
+
+            signal.signal(signal.SIGTERM, handle_signal)
+            signal.signal(signal.SIGINT, handle_signal)
+
+            connection.settimeout(self.idle_timeout)
+            connection.sendall(protocol.MAGIC)
+            while self.wait_for_frame(connection, frames):
+                prisoner.started = time.monotonic()
+                self.set_limits(prisoner, *self.read_limits(frames))
+                received = key = None
+                if self.cache:
+                    received = self.receive_input(connection, frames, prisoner.deadline)
+                    key = self.cache_key(received, framed = True)
+                    cached = self.cached_result(key, prisoner)
+                    if cached is not None:
+                        # Prisoner stays for next request
+                        output, report = cached
+                        connection.settimeout(self.idle_timeout)
+                        connection.sendall(output + protocol.pack_status(report))
+                        self.trace_cached(prisoner.started, received[0], output, framed = True)
+                        continue
+                relayed = self.relay(connection, prisoner, frames, received, capture = key is not None)
+                error = prisoner.limit_error()
+                if not relayed and not error:
+                    # Socket disconnected, give up
+                    exit(1)
+                teardown = time.monotonic()
+                prisoner.terminate()
+                report = prisoner.usage()
+                if relayed:
+                    self.cache_result(key, prisoner, report)
+                if error:
+                    report['error'] = error
+                if self.cache:
+                    report['cached'] = False
+                prisoner.cleanup()
+
+                connection.settimeout(self.idle_timeout)
+                connection.sendall(protocol.pack_status(report))
+                if not relayed:
+                    # Client stalled after prisoner was killed, rest of
+                    # its input would be taken for next request
+                    exit(1)
+                self.trace_execution(prisoner, teardown, framed = True)
+                prisoner = self.new_prisoner(zygote_sock)
+        except (OSError, protocol.ProtocolError):
+            # Client is gone or talks nonsense
+            exit(1)
+        except:
+            sys.excepthook(*sys.exc_info())
+            exit(1)
+        exit(0)
+
+    def trace_execution(self, prisoner, teardown, framed):
+        '''
+        Records spans of finished execution: from connection (or
+        request) to first output, prisoner's exit, `teardown` (from
+        given time until now) and whole request.
+        '''
+        tracer = self.tracer
+        if not tracer.enabled:
+            return
+        if prisoner.first_output is not None:
+            tracer.add('first_output', prisoner.started, prisoner.first_output, pid = prisoner.pid)
+        if prisoner.finished is not None:
+            tracer.add('child_exit', prisoner.finished, prisoner.finished, pid = prisoner.pid, status = prisoner.status)
+        tracer.add('teardown', teardown, pid = prisoner.pid)
+        tracer.add('request', prisoner.started,
+            pid = prisoner.pid,
+            framed = framed,
+            timed_out = prisoner.timed_out,
+            bytes_in = prisoner.bytes_in,
+            bytes_out = prisoner.bytes_out,
+        )
+
+    def read_limits(self, frames):
+        '''
+        Returns time and CPU limits (milliseconds, or None) requested by
+        LIMITS frame, if it's next in `frames`
+        '''
+        header = frames.header()
+        if header is None or header[0] != protocol.LIMITS:
+            return None, None
+        _, payload = frames.next_frame()
+        return protocol.unpack_limits(payload)
 
-                        zeropos = data.find(b'\0')
-                        if zeropos > -1:
-                            data = data[:zeropos]
-                            continue_writing = False
+    def set_limits(self, prisoner, time_ms=None, cpu_ms=None):
+        '''
+        Sets limits of prisoner's next execution: ours, or lower ones
+        requested by client
+        '''
+        prisoner.time_limit = self.time_limit
+        if time_ms is not None:
+            prisoner.time_limit = min(time_ms / 1000, self.time_limit)
+        prisoner.cpu_limit = self.cpu_limit
+        if cpu_ms is not None:
+            prisoner.cpu_limit = cpu_ms / 1000
+            if self.cpu_limit is not None:
+                prisoner.cpu_limit = min(prisoner.cpu_limit, self.cpu_limit)
 
-                        os.write(in_w_pipe, data)
-                        if not continue_writing:
-                            os.close(in_w_pipe)
+    def trace_cached(self, started, data, output, framed):
+        '''
+        Records span of request answered from cache
+        '''
+        self.tracer.add('request', started,
+            framed = framed,
+            cached = True,
+            bytes_in = len(data),
+            bytes_out = len(output),
+        )
 
-                    while continue_reading:
+    def receive_input(self, connection, frames=None, deadline=None):
+        '''
+        Reads input of one execution ahead of prisoner, for cache lookup:
+        until nullchar (or EOF frame, if `frames` are given), at most
+        `cache.max_input` bytes. Stops early if `deadline` passes or
+        client disconnects, relay finds out then.
+
+        Returns 2tuple of input and True if it's complete.
+        '''
+        chunks = []
+        size = 0
+        while size <= self.cache.max_input:
+            if frames is not None:
+                frame = frames.next_frame()
+                if frame is not None:
+                    kind, payload = frame
+                    if kind == protocol.EOF:
+                        return b''.join(chunks), True
+                    if kind != protocol.STDIN:
+                        raise protocol.ProtocolError('Unexpected frame {}'.format(kind))
+                    chunks.append(payload)
+                    size += len(payload)
+                    continue
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                connection.settimeout(remaining)
+            try:
+                data = connection.recv(BUF_SIZE)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            if frames is not None:
+                frames.feed(data)
+                continue
+            zeropos = data.find(b'\0')
+            if zeropos > -1:
+                chunks.append(data[:zeropos])
+                return b''.join(chunks), True
+            chunks.append(data)
+            size += len(data)
+        return b''.join(chunks), False
+
+    def cache_key(self, received, framed):
+        '''
+        Returns cache key of input `received` by `receive_input`, or None
+        if it's not complete
+        '''
+        data, complete = received
+        if not complete:
+            return None
+        return self.cache.key(self.fingerprint, b'framed' if framed else b'legacy', data)
+
+    def cached_result(self, key, prisoner):
+        '''
+        Returns 2tuple of output (as it was sent to client) and usage
+        report stored under `key`, or None. Result which wouldn't fit in
+        limits of `prisoner`'s execution is not used.
+        '''
+        if key is None:
+            return None
+        with self.tracer.span('cache') as span:
+            value = self.cache.get(key)
+            span.set(hit = value is not None)
+        if value is None:
+            return None
+        report, _, output = value.partition(b'\n')
+        report = json.loads(report.decode())
+        if (report['wall_time'] or 0) > prisoner.time_limit:
+            return None
+        if prisoner.cpu_limit is not None:
+            if report.get('cpu_usec') is not None:
+                cpu_time = report['cpu_usec'] / 1000000
+            else:
+                cpu_time = (report['utime'] or 0) + (report['stime'] or 0)
+            if cpu_time > prisoner.cpu_limit:
+                return None
+        report['cached'] = True
+        return output, report
+
+    def cache_result(self, key, prisoner, report):
+        '''
+        Stores output and usage `report` of finished execution under
+        `key`, if it can be reused: prisoner exited by itself and whole
+        output was captured
+        '''
+        if key is None or prisoner.captured is None or prisoner.limit_error():
+            return
+        if prisoner.status is None or prisoner.status < 0 or not os.WIFEXITED(prisoner.status):
+            return
+        report = json.dumps(report, sort_keys = True).encode()
+        self.cache.put(key, report + b'\n' + bytes(prisoner.captured))
+
+    def wait_for_frame(self, connection, frames):
+        '''
+        Waits at most `idle_timeout` until whole frame is buffered in
+        `frames`. Returns False if it didn't come, or client disconnected.
+        '''
+        deadline = time.monotonic() + self.idle_timeout
+        while not frames.ready():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            connection.settimeout(remaining)
+            try:
+                data = connection.recv(BUF_SIZE)
+            except socket.timeout:
+                return False
+            if not data:
+                return False
+            frames.feed(data)
+        return True
+
+    def relay(self, connection, prisoner, frames=None, received=None, capture=False):
+        '''
+        Pipes data from connection to prisoner's stdin, and from its
+        stdout and stderr back to connection, until EOF. All directions
+        are handled by one epoll loop, together with prisoner's exit.
+
+        In legacy protocol (`frames` is None) input ends with nullchar
+        and output is sent as is, stdout and stderr mixed.
+        Otherwise `frames` is `protocol.FrameReader` of connection, input
+        ends with EOF frame and output is sent in STDOUT and STDERR frames.
+        Frames after EOF are left in `frames`, for next execution.
+
+        We read from one side only after everything read before was
+        written to the other, so slow reader applies backpressure
+        instead of filling our memory.
+
+        With `use_splice`, legacy output is moved to connection by
+        splice(2), without copying it through our buffers. Input has to
+        be scanned for nullchar or frames, so it's always copied. If
+        splice is not supported, we fall back to copying.
+
+        Output over `stdout_limit` or `stderr_limit` is cut, see `Jail`.
+        With `spool_output`, output goes to memfd instead of connection
+        (spliced there in legacy protocol), and is sent all at once by
+        sendfile(2) when prisoner closed both outputs.
+
+        If prisoner's `deadline` passes, it's killed and marked as timed
+        out. If it has `cpu_limit`, we check its CPU time whenever it
+        could have run out (single thread can't use it faster than wall
+        clock goes), and kill it and mark `cpu_exceeded` once it did.
+
+        `received` is input already read by `receive_input`. With
+        `capture`, output sent to connection is also kept in
+        `prisoner.captured`, unless it's longer than `cache.max_entry`.
+
+        Returns False if client disconnected before sending whole input,
+        or didn't send it even after prisoner was killed.
+        '''
+        sock_fd = connection.fileno()
+        in_fd = prisoner.stdin
+        # output fd => frame type
+        outputs = {
+            prisoner.stdout: protocol.STDOUT,
+            prisoner.stderr: protocol.STDERR,
+        }
+        # output fd => bytes it can still send, None if unlimited
+        remaining = {
+            prisoner.stdout: self.stdout_limit,
+            prisoner.stderr: self.stderr_limit,
+        }
+        names = {
+            prisoner.stdout: 'stdout',
+            prisoner.stderr: 'stderr',
+        }
+        exit_fd = prisoner.fileno()
+        deadline = prisoner.deadline
+        # When to check prisoner's CPU time
+        cpu_check = None
+        if prisoner.cpu_limit is not None:
+            prisoner.start_cpu_limit()
+            cpu_check = time.monotonic()
+
+        connection.setblocking(False)
+        os.set_blocking(in_fd, False)
+        for fd in outputs:
+            os.set_blocking(fd, False)
+
+        # Read from connection, to be written to stdin
+        in_buf = b''
+        # Read from outputs, to be sent to connection
+        out_buf = b''
+        reading_input = True
+        splice_output = self.use_splice and frames is None and not capture
+        prisoner.captured = bytearray() if capture else None
+        # Output which has data we couldn't splice, because connection
+        # was full
+        out_pending = None
+        # Output collected while prisoner runs, and how much of it was
+        # sent
+        spool = None
+        spool_size = 0
+        spool_sent = 0
+        if self.spool_output:
+            spool = memfd_create('output', const.MFD_CLOEXEC)
+
+        epoll = select.epoll()
+        # fd => currently registered events
+        watched = {}
+
+        def watch(fd, events):
+            old = watched.get(fd, 0)
+            if events == old:
+                return
+            if not old:
+                epoll.register(fd, events)
+            elif not events:
+                epoll.unregister(fd)
+            else:
+                epoll.modify(fd, events)
+            watched[fd] = events
+
+        def close_stdin():
+            nonlocal in_fd, in_buf
+            watch(in_fd, 0)
+            os.close(in_fd)
+            prisoner.stdin = in_fd = None
+            in_buf = b''
+
+        def close_output(fd):
+            watch(fd, 0)
+            del outputs[fd]
+
+        def emit(fd, data):
+            '''
+            Queues `data` of output `fd` for connection, or spools it
+            '''
+            nonlocal out_buf, spool_size
+            if frames is not None:
+                data = protocol.pack_frame(outputs[fd], data)
+            if prisoner.captured is not None:
+                if len(prisoner.captured) + len(data) > self.cache.max_entry:
+                    # Too long to be cached
+                    prisoner.captured = None
+                else:
+                    prisoner.captured += data
+            if spool is None:
+                out_buf += data
+                return
+            view = memoryview(data)
+            while view:
+                view = view[os.write(spool, view):]
+            spool_size += len(data)
+
+        def take_output(fd, data):
+            '''
+            Handles `data` read from output `fd`, cutting it at its limit
+            '''
+            left = remaining[fd]
+            if left is not None and len(data) > left:
+                data = data[:left]
+                if data:
+                    emit(fd, data)
+                emit(fd, TRUNCATED_MESSAGE.format(names[fd], getattr(self, names[fd] + '_limit')).encode())
+                prisoner.truncated.append(names[fd])
+                close_output(fd)
+                # Prisoner gets EPIPE if it writes more
+                os.close(fd)
+                setattr(prisoner, names[fd], None)
+            else:
+                emit(fd, data)
+            if left is not None:
+                remaining[fd] = max(left - len(data), 0)
+            prisoner.bytes_out += len(data)
+
+        def take_input(data):
+            '''
+            Handles data received from connection
+            '''
+            nonlocal in_buf, reading_input
+            if frames is not None:
+                frames.feed(data)
+                take_frames()
+                return
+            zeropos = data.find(b'\0')
+            if zeropos > -1:
+                data = data[:zeropos]
+                reading_input = False
+            prisoner.bytes_in += len(data)
+            if in_fd is not None:
+                in_buf = data
+                if not (in_buf or reading_input):
+                    close_stdin()
+
+        def take_frames():
+            '''
+            Takes buffered frames until there is something to write to
+            stdin, or EOF
+            '''
+            nonlocal in_buf, reading_input
+            while reading_input and not in_buf:
+                frame = frames.next_frame()
+                if frame is None:
+                    return
+                kind, payload = frame
+                if kind == protocol.EOF:
+                    reading_input = False
+                elif kind == protocol.STDIN:
+                    prisoner.bytes_in += len(payload)
+                    if in_fd is not None:
+                        in_buf = payload
+                else:
+                    raise protocol.ProtocolError('Unexpected frame {}'.format(kind))
+            if in_fd is not None and not (in_buf or reading_input):
+                close_stdin()
+
+        def check_cpu(now):
+            '''
+            Kills prisoner if it used up its CPU time. Returns when to
+            check again, or None.
+            '''
+            if prisoner.status is not None:
+                return None
+            used = prisoner.cpu_time()
+            if used is None:
+                return None
+            left = prisoner.cpu_limit - (used - prisoner.cpu_start)
+            if left <= 0:
+                prisoner.cpu_exceeded = True
+                prisoner.kill()
+                return None
+            return now + max(left, CPU_CHECK_INTERVAL)
+
+        def splice_from(fd):
+            '''
+            Returns False if splice can't be used for our descriptors.
+            '''
+            nonlocal out_pending, spool_size
+            length = BUF_SIZE
+            if remaining[fd] is not None:
+                length = min(length, remaining[fd])
+            try:
+                moved = splice(fd, None, sock_fd if spool is None else spool, None, length, const.SPLICE_F_MOVE | const.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                if spool is None:
+                    # Output was readable, so it's connection that is full
+                    out_pending = fd
+                return True
+            except OSError as exc:
+                if exc.errno in (errno.EINVAL, errno.ENOSYS):
+                    return False
+                raise
+            out_pending = None
+            if not moved:
+                close_output(fd)
+                return True
+            if prisoner.first_output is None:
+                prisoner.first_output = time.monotonic()
+            if remaining[fd] is not None:
+                remaining[fd] -= moved
+            if spool is not None:
+                spool_size += moved
+            prisoner.bytes_out += moved
+            return True
+
+        try:
+            watch(exit_fd, select.EPOLLIN)
+            if received is not None:
+                data, complete = received
+                prisoner.bytes_in += len(data)
+                reading_input = not complete
+                if in_fd is not None:
+                    in_buf = data
+                    if not (in_buf or reading_input):
+                        close_stdin()
+            if frames is not None:
+                take_frames()
+            while outputs or out_buf or spool_sent < spool_size or (frames is not None and reading_input):
+                sock_events = 0
+                if reading_input and not in_buf:
+                    sock_events |= select.EPOLLIN
+                if out_buf or out_pending or (not outputs and spool_sent < spool_size):
+                    sock_events |= select.EPOLLOUT
+                watch(sock_fd, sock_events)
+                if in_fd is not None:
+                    watch(in_fd, select.EPOLLOUT if in_buf else 0)
+                for fd in outputs:
+                    watch(fd, select.EPOLLIN if not (out_buf or out_pending) else 0)
+
+                timeout = -1
+                wakeup = [when for when in (deadline, cpu_check) if when is not None]
+                if wakeup:
+                    timeout = max(min(wakeup) - time.monotonic(), 0)
+                events = epoll.poll(timeout)
+                now = time.monotonic()
+                if cpu_check is not None and now >= cpu_check:
+                    cpu_check = check_cpu(now)
+                if deadline is not None and now >= deadline:
+                    if prisoner.timed_out:
+                        # Killed it long ago, and we are still here
+                        return False
+                    prisoner.timed_out = True
+                    prisoner.kill()
+                    # Give client a moment to finish its input
+                    deadline += TIME_GRACE
+
+                for fd, events in events:
+                    if fd == exit_fd:
+                        if prisoner.poll():
+                            watch(exit_fd, 0)
+
+                    elif fd == in_fd:
                         try:
-                            cr, cw, _ = select.select([out_r_pipe], [connection], [], 0.02)
-                        except select.error as exc:
-                            if exc.args[0] == errno.EINTR:
-                                break
-                            raise
-                        if not (cr and cw):
-                            break
+                            written = os.write(in_fd, in_buf)
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            # Prisoner doesn't want more input, but we
+                            # still have to read it all
+                            close_stdin()
+                            if frames is not None:
+                                take_frames()
+                            else:
+                                reading_input = False
+                            continue
+                        in_buf = in_buf[written:]
+                        if not in_buf:
+                            if frames is not None:
+                                take_frames()
+                            elif not reading_input:
+                                close_stdin()
 
-                        data = os.read(out_r_pipe, PIPE_BUF)
+                    elif fd in outputs:
+                        if out_buf or out_pending:
+                            # Other output was faster in this round
+                            continue
+                        # Output at its limit is read, to see if there is more
+                        if splice_output and remaining[fd] != 0:
+                            if splice_from(fd):
+                                continue
+                            splice_output = False
+                        try:
+                            data = os.read(fd, BUF_SIZE)
+                        except BlockingIOError:
+                            continue
                         if not data:
-                            continue_reading = False
-                            break
+                            close_output(fd)
+                            continue
+                        if prisoner.first_output is None:
+                            prisoner.first_output = time.monotonic()
+                        take_output(fd, data)
 
-                        connection.send(data)
-            finally:
-                signal.alarm(0)
-        except:
-            sys.excepthook(*sys.exc_info())
+                    elif fd == sock_fd:
+                        try:
+                            if out_pending and events & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                                splice_from(out_pending)
+                            if out_buf and events & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                                out_buf = out_buf[connection.send(out_buf):]
+                            if not outputs and spool_sent < spool_size and events & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                                spool_sent += os.sendfile(sock_fd, spool, spool_sent, spool_size - spool_sent)
+                            if reading_input and not in_buf and events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                                data = connection.recv(BUF_SIZE)
+                                if not data:
+                                    return False
+                                take_input(data)
+                        except BlockingIOError:
+                            pass
+            return True
+        except ConnectionError:
+            return False
         finally:
-            exit(0)
+            epoll.close()
+            if spool is not None:
+                os.close(spool)
+            if in_fd is not None:
+                os.close(in_fd)
+                prisoner.stdin = None
+
+    def image_fingerprint(self):
+        '''
+        Returns digest of what results depend on besides input: main.py,
+        Python binary and memory and output limits (results are checked
+        against time limits when they are taken). Changes of other files in `usr_path`
+        are not noticed, clear the cache after them.
+        '''
+        settings = dict(
+            entry = self.entry,
+            preload = list(self.preload),
+            use_zygote = self.use_zygote,
+            cgroup_limits = self.cgroup_limits if self.cgroup_path else None,
+            mem_bytes = MEM_BYTES,
+            stdout_limit = self.stdout_limit,
+            stderr_limit = self.stderr_limit,
+        )
+        with open(os.path.join(self.usr_dir, 'bin', 'main.py'), 'rb') as fp:
+            script = fp.read()
+        python = os.stat(os.path.join(self.usr_dir, 'bin', 'python'))
+        return self.cache.key(
+            json.dumps(settings, sort_keys = True, default = str).encode(),
+            script,
+            '{} {} {}'.format(python.st_ino, python.st_size, python.st_mtime_ns).encode(),
+        )
+
+    def find_main_script(self):
+        '''
+        Returns path in jail of main script: `main.pyc` compiled by
+        `sandboxed.bytecode`, unless it's missing or older than main.py
+        '''
+        source = os.path.join(self.usr_dir, 'bin', 'main.py')
+        try:
+            if os.stat(source + 'c').st_mtime_ns >= os.stat(source).st_mtime_ns:
+                return MAIN_SCRIPT + 'c'
+        except FileNotFoundError:
+            pass
+        return MAIN_SCRIPT
 
     def start(self):
-        tmp = tempfile.mkdtemp()
-        mount_tmpfs(self.fs_size, tmp)
+        if not os.path.isfile(self.usr_path):
+            return self.start_jail()
+        # Image made by `sandboxed.image`, mounted once for all roots
+        self.usr_dir = tempfile.mkdtemp()
+        try:
+            with self.tracer.span('mount_image'):
+                mount_image(self.usr_path, self.usr_dir)
+            try:
+                return self.start_jail()
+            finally:
+                detach(self.usr_dir)
+        finally:
+            os.rmdir(self.usr_dir)
+            self.usr_dir = self.usr_path
 
-        put_old = 'root'
-        old_root = os.path.join(tmp, put_old)
-        os.mkdir(old_root)
+    def start_jail(self):
+        tracer = self.tracer
+        # Jail won't see usr_path where it is now
+        self.main_script = self.find_main_script()
+        if self.cache:
+            self.fingerprint = self.image_fingerprint()
+        if self.trace_file:
+            # Jail won't see host filesystem
+            self.trace_fd = os.open(self.trace_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644)
 
-        usr_mount = os.path.join(tmp, 'usr')
-        try_mkdir(usr_mount)
-        flags = const.MS_NODEV | const.MS_NOSUID | const.MS_NOATIME
-        mount_bind(self.usr_path, usr_mount, flags)
-        flags |= const.MS_REMOUNT | const.MS_RDONLY
-        mount_bind(self.usr_path, usr_mount, flags)
-        ignore_mounts = ['/', '/proc', '/usr']
+        with tracer.span('template'):
+            template = RootfsTemplate(self.fs_size)
+            template.bind(self.usr_dir, 'usr')
+            template.symlink('/usr/lib', 'lib')
+            template.symlink('/usr/lib', 'lib64')
+            template.mkdir(PUT_OLD)
+            template.mkdir('proc')
+            if self.use_zygote:
+                template.copy(zygote.__file__, 'zygote.py')
+            ignore_mounts = ['/', '/proc', '/usr']
+            if self.worker_roots:
+                template.mkdir(LAYER_DIR)
+                template.expose(TEMPLATE_DIR)
+                ignore_mounts.append('/' + TEMPLATE_DIR)
+
+        if self.cgroup_path:
+            with tracer.span('cgroups'):
+                self.cgroups = CgroupTree(self.cgroup_path)
+                self.cgroups.clear()
+
+        with tracer.span('new_root'):
+            root = template.new_root(self.fs_size)
+        # Jail exports spans recorded so far, we keep only ours
+        pending = tracer.drain()
+        cloned = time.monotonic()
 
         def jail():
+            tracer.extend(pending)
+            tracer.add('clone', cloned)
+
             os.environ.clear()
             os.environ.update(
                 PATH = '/usr/bin',
@@ -272,19 +1974,22 @@ class Jail:
             if self.hostname:
                 sethostname(self.hostname)
 
-            pivot_root(tmp, old_root)
-            os.chdir('/')
+            with tracer.span('pivot_root'):
+                pivot_root(root.path, os.path.join(root.path, PUT_OLD))
+                os.chdir('/')
 
-            mount_proc()
-            umount_all(ignore_mounts)
-            os.rmdir('/' + put_old)
-            
-            os.symlink('/usr/lib', '/lib')
-            os.symlink('/usr/lib', '/lib64')
+            with tracer.span('mount_proc'):
+                mount_proc()
+            with tracer.span('umount_all'):
+                umount_all(ignore_mounts)
+                os.rmdir('/' + PUT_OLD)
 
-            mount_tmpfs(self.fs_size, '/', const.MS_REMOUNT | const.MS_RDONLY)
+            with tracer.span('remount_ro'):
+                remount_readonly('/')
+            if self.worker_roots:
+                self.template = template.inside()
 
-            self.setup_workers()
+            self.run_acceptors()
 
         try:
             pid = clone_and_wait(
@@ -296,9 +2001,13 @@ class Jail:
                 const.CLONE_NEWIPC
             )
         finally:
-            umount(usr_mount)
-            umount(tmp)
-            os.rmdir(tmp)
+            with tracer.span('jail_teardown'):
+                root.discard()
+                template.close()
+            self.export_trace()
+            if self.trace_fd is not None:
+                os.close(self.trace_fd)
+                self.trace_fd = None
 
 if __name__ == '__main__':
     Jail('socket', 2000, 'fluxid', 'fluxid', 'lolnope', '/home/fluxid/main/py32mod').start()
@@ -1,6 +1,8 @@
 #coding:utf8
 
-from . import const
+from . import const, protocol
 from .ccall import *
+from .cgroup import *
 from .lowlevel import *
+from .namespaces import *
 from .utils import *
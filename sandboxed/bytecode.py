@@ -0,0 +1,284 @@
+#coding:utf8
+
+'''
+Precompiled bytecode of jail images.
+
+Jail root and Python distribution in it are read-only, so jailed Python
+can't write `.pyc` files: whatever has no up-to-date bytecode in the image
+is compiled from source by every execution. `prepare_image` compiles it
+ahead of time:
+
+    compile     every `.py` in directories of `sys.path` of jailed Python,
+                by `compileall`, into hash-based pycs (they don't depend
+                on mtimes, which change when image is copied)
+    main        `bin/main.py` into `bin/main.pyc`, which `remote_exec.Jail`
+                executes instead while it's newer than `main.py`
+    zip         optionally, pycs of standard library into zip on
+                `sys.path` of jailed Python (`lib/pythonXY.zip`), so it's
+                imported by `zipimport` from one file. Packages which
+                read files next to them are left out, see EXCLUDE.
+
+Bytecode has to be made by Python which uses it, and with paths it will
+see, so the work is done by this file run as a script by jailed Python,
+chrooted in root like jail's. That's why this module depends on standard
+library only, besides `prepare_image`.
+
+`prepare_image` also measures time of starting jailed Python (and
+importing given modules) in read-only root, without bytecode, with it, and
+with zip, and returns it in its report. Run as script on host:
+
+    python -m sandboxed.bytecode prepare USR_PATH [--zip] [--unchecked]
+        [--imports json,decimal] [--runs 20]
+'''
+
+import argparse
+import compileall
+import contextlib
+import importlib.util
+import json
+import os
+import os.path
+import py_compile
+import re
+import statistics
+import subprocess
+import sys
+import time
+import zipfile
+
+__all__ = (
+    'prepare_image',
+)
+
+# Directories not compiled nor zipped: tests (which contain files with
+# bad syntax on purpose), installed packages, extensions, and packages
+# which read data files next to them
+EXCLUDE = (
+    '__pycache__',
+    'dist-packages',
+    'ensurepip',
+    'idlelib',
+    'lib-dynload',
+    'lib2to3',
+    'pydoc_data',
+    'site-packages',
+    'test',
+    'tests',
+    'tkinter',
+    'turtledemo',
+    'venv',
+)
+# Only tests and compiled files are skipped when compiling
+COMPILE_EXCLUDE = re.compile(r'/(test|tests|__pycache__)/')
+
+# Where script is copied in root, and where image is mounted
+SCRIPT = '/bytecode.py'
+MAIN = '/usr/bin/main.py'
+
+def _invalidation_mode(unchecked):
+    '''
+    Returns mode of hash-based pycs, or None if jailed Python (older than
+    3.7) has only timestamp-based ones
+    '''
+    modes = getattr(py_compile, 'PycInvalidationMode', None)
+    if modes is None:
+        return None
+    return modes.UNCHECKED_HASH if unchecked else modes.CHECKED_HASH
+
+def _compile(args):
+    mode = _invalidation_mode(args.unchecked)
+    extra = {} if mode is None else dict(invalidation_mode = mode)
+    ok = True
+    # First entry is directory of this script
+    for path in sys.path[1:]:
+        if os.path.isdir(path):
+            ok &= bool(compileall.compile_dir(path, quiet = 2, force = True, rx = COMPILE_EXCLUDE, **extra))
+    main = None
+    if os.path.exists(MAIN):
+        main = MAIN + 'c'
+        py_compile.compile(MAIN, cfile = main, dfile = MAIN, doraise = True, **extra)
+    return dict(
+        python = sys.version.split()[0],
+        hash_based = mode is not None,
+        ok = ok,
+        main = main,
+    )
+
+def _stdlib_zip():
+    '''
+    Returns path of zip which jailed Python looks for standard library in
+    '''
+    for path in sys.path:
+        if path.endswith('.zip'):
+            return path
+    return None
+
+def _zip(args):
+    path = _stdlib_zip()
+    if path is None:
+        return dict(zip = None, zipped = 0)
+    if args.remove:
+        if os.path.exists(path):
+            os.remove(path)
+        return dict(zip = None, zipped = 0)
+    stdlib = os.path.dirname(os.__file__)
+    count = 0
+    temp = path + '.tmp'
+    # Pycs are taken from __pycache__, as compiled by `_compile`. Sources
+    # aren't needed: code of pycs refers to them in stdlib directory.
+    with zipfile.ZipFile(temp, 'w', zipfile.ZIP_STORED) as archive:
+        for directory, dirs, files in os.walk(stdlib):
+            dirs[:] = sorted(name for name in dirs if name not in EXCLUDE and not name.startswith('config-'))
+            for name in sorted(files):
+                if not name.endswith('.py'):
+                    continue
+                source = os.path.join(directory, name)
+                cached = importlib.util.cache_from_source(source)
+                if not os.path.exists(cached):
+                    continue
+                archive.write(cached, os.path.relpath(source, stdlib) + 'c')
+                count += 1
+    os.chmod(temp, 0o644)
+    os.replace(temp, path)
+    return dict(zip = path, zipped = count)
+
+def _chrooted(root):
+    def preexec():
+        os.chroot(root)
+        os.chdir('/')
+    return preexec
+
+def _run_in_root(root, args, env = None, capture = True):
+    '''
+    Runs jailed Python chrooted in `root` with `args`, returns its output
+    '''
+    return subprocess.run(
+        ('/usr/bin/python',) + tuple(args),
+        env = dict(PATH = '/usr/bin', HOME = '/', **(env or {})),
+        preexec_fn = _chrooted(root),
+        stdin = subprocess.DEVNULL,
+        stdout = subprocess.PIPE if capture else subprocess.DEVNULL,
+        check = True,
+    ).stdout
+
+def _run_script(root, *args):
+    return json.loads(_run_in_root(root, (SCRIPT,) + args).decode())
+
+@contextlib.contextmanager
+def _image_root(usr_path, readonly, fs_size):
+    '''
+    Yields path of root like jail's, with this script in it
+    '''
+    # Jailed Python runs this file as a script, outside of the package
+    from .rootfs import RootfsTemplate
+
+    template = RootfsTemplate(fs_size)
+    try:
+        template.copy(os.path.abspath(__file__), SCRIPT)
+        template.symlink('/usr/lib', 'lib')
+        template.symlink('/usr/lib', 'lib64')
+        template.bind(usr_path, 'usr', readonly = readonly)
+        root = template.new_root(fs_size)
+        try:
+            yield root.path
+        finally:
+            root.discard()
+    finally:
+        template.close()
+
+def _measure(root, imports, runs, source = False):
+    '''
+    Returns median of wall time of starting jailed Python and importing
+    `imports`, in milliseconds. With `source`, bytecode in __pycache__ is
+    not used (zip still is). Returns None if `runs` is 0.
+    '''
+    if not runs:
+        return None
+    args = ('-c', 'import ' + ', '.join(imports) if imports else 'pass')
+    env = None
+    if source:
+        # Pycs are looked for in directory which doesn't exist, and
+        # nothing is written there
+        args = ('-B',) + args
+        env = dict(PYTHONPYCACHEPREFIX = '/nonexistent')
+    samples = []
+    # First run warms up page cache
+    for _ in range(runs + 1):
+        start = time.monotonic()
+        _run_in_root(root, args, env, capture = False)
+        samples.append((time.monotonic() - start) * 1000)
+    return round(statistics.median(samples[1:]), 3)
+
+def prepare_image(usr_path, zip_stdlib = False, unchecked = False, imports = (), runs = 20, fs_size = 2000):
+    '''
+    Compiles Python distribution in `usr_path` (mounted as `/usr` in jail)
+    and its `bin/main.py`, see module documentation. Has to be run as
+    root.
+
+    With `zip_stdlib`, standard library is zipped too (zip is left alone
+    otherwise, even if it's outdated). With `unchecked`, pycs are not
+    checked against sources when imported, which is faster, but then
+    image has to be prepared again after any change of it.
+
+    Returns dict describing what was done, with `import_ms`: median
+    times (of `runs` runs) of starting jailed Python which imports
+    `imports`, in read-only root: from `source` (pycs in image ignored),
+    with `bytecode`, and with `zip`. They're None if `runs` is 0.
+    '''
+    usr_path = os.path.realpath(usr_path)
+    report = dict(usr_path = usr_path, unchecked = unchecked, imports = list(imports))
+    import_ms = report['import_ms'] = {}
+
+    # Compiled in writable root, measured in read-only one, like jail's
+    with _image_root(usr_path, False, fs_size) as writable, _image_root(usr_path, True, fs_size) as readonly:
+        if zip_stdlib:
+            # Old zip would be measured as source
+            _run_script(writable, 'zip', '--remove')
+        import_ms['source'] = _measure(readonly, imports, runs, source = True)
+
+        start = time.monotonic()
+        report.update(_run_script(writable, 'compile', *(('--unchecked',) if unchecked else ())))
+        report['seconds'] = round(time.monotonic() - start, 3)
+        import_ms['bytecode'] = _measure(readonly, imports, runs)
+
+        if zip_stdlib:
+            report.update(_run_script(writable, 'zip'))
+            import_ms['zip'] = _measure(readonly, imports, runs)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Precompiles bytecode of jail image')
+    commands = parser.add_subparsers(dest = 'command')
+
+    prepare = commands.add_parser('prepare', help = 'prepare image in USR_PATH, run on host')
+    prepare.add_argument('usr_path')
+    prepare.add_argument('--zip', action = 'store_true', help = 'zip standard library')
+    prepare.add_argument('--unchecked', action = 'store_true', help = 'make pycs not checked against sources')
+    prepare.add_argument('--imports', default = '', help = 'comma separated modules imported while measuring')
+    prepare.add_argument('--runs', type = int, default = 20)
+
+    # Run by jailed Python
+    compile_ = commands.add_parser('compile')
+    compile_.add_argument('--unchecked', action = 'store_true')
+    zip_ = commands.add_parser('zip')
+    zip_.add_argument('--remove', action = 'store_true')
+
+    args = parser.parse_args()
+    if args.command == 'prepare':
+        report = prepare_image(
+            args.usr_path,
+            zip_stdlib = args.zip,
+            unchecked = args.unchecked,
+            imports = [name for name in args.imports.split(',') if name],
+            runs = args.runs,
+        )
+        print(json.dumps(report, indent = 2, sort_keys = True))
+    elif args.command == 'compile':
+        print(json.dumps(_compile(args)))
+    elif args.command == 'zip':
+        print(json.dumps(_zip(args)))
+    else:
+        parser.error('command is required')
+
+if __name__ == '__main__':
+    main()
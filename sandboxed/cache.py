@@ -0,0 +1,226 @@
+#coding:utf8
+
+'''
+Cache of execution results, shared by processes.
+
+`ResultCache` maps keys (SHA-256 digests of whatever identifies a result,
+see `ResultCache.key`) to byte strings. Everything is kept in one shared
+memory mapping, so processes forked after the cache was created (workers)
+see each other's results:
+
+    header      magic, layout, LRU clock and counters
+    index       `slots` entries: key, offset and length of value, and
+                clock value of its last use (0 for free entry)
+    data        `size` bytes for values
+
+With `path`, mapping is backed by that file and survives restarts,
+otherwise by memfd. Processes serialize access by lockf(3) lock of the
+whole file.
+
+Value is stored in first gap of data big enough for it; least recently
+used entries are evicted until there is one, and a free index entry.
+Keys are found by searching the index for their digest, in C.
+
+Counters of hits, misses, stores and evictions are shared too, see
+`stats`.
+'''
+
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+from . import const
+from .lowlevel import memfd_create
+
+__all__ = (
+    'ResultCache',
+)
+
+MAGIC = b'SBXCACHE'
+VERSION = 1
+
+# magic, version, slots, data size, clock, hits, misses, stores, evictions
+HEADER = struct.Struct('=8sIIQQQQQQ')
+# key, offset, length, last use
+ENTRY = struct.Struct('=32sQQQ')
+
+COUNTERS = ('hits', 'misses', 'stores', 'evictions')
+
+class ResultCache:
+    '''
+    Cache of up to `slots` values in `size` bytes, in file `path` if given.
+    Values longer than `max_entry` are not stored. `max_input` is for
+    users deciding whether input is worth reading ahead to compute key.
+
+    File is reused if it has the same layout, otherwise it's cleared.
+    Create the cache before forking processes which share it.
+    '''
+    def __init__(self, size = 64 * 1024 * 1024, path = None, slots = 4096, max_entry = 1024 * 1024, max_input = 1024 * 1024):
+        self.size = size
+        self.path = path
+        self.slots = slots
+        self.max_entry = min(max_entry, size)
+        self.max_input = max_input
+        self.index_start = HEADER.size
+        self.data_start = self.index_start + slots * ENTRY.size
+        length = self.data_start + size
+
+        if path is None:
+            self.fd = memfd_create('result-cache', const.MFD_CLOEXEC)
+        else:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            with self.locked():
+                if os.fstat(self.fd).st_size != length:
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, length)
+                self.map = mmap.mmap(self.fd, length, mmap.MAP_SHARED)
+                magic, version, slots_, size_ = HEADER.unpack_from(self.map)[:4]
+                if (magic, version, slots_, size_) != (MAGIC, VERSION, slots, size):
+                    self._clear()
+        except:
+            os.close(self.fd)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def key(*parts):
+        '''
+        Returns key made of byte string `parts`
+        '''
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(struct.pack('=Q', len(part)))
+            digest.update(part)
+        return digest.digest()
+
+    @contextlib.contextmanager
+    def locked(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def get(self, key):
+        '''
+        Returns value of `key`, or None
+        '''
+        with self.locked():
+            header = list(HEADER.unpack_from(self.map))
+            slot = self._find(key)
+            if slot is None:
+                header[6] += 1
+                HEADER.pack_into(self.map, 0, *header)
+                return None
+            position = self.index_start + slot * ENTRY.size
+            _, offset, length, _ = ENTRY.unpack_from(self.map, position)
+            header[4] += 1
+            header[5] += 1
+            HEADER.pack_into(self.map, 0, *header)
+            ENTRY.pack_into(self.map, position, key, offset, length, header[4])
+            start = self.data_start + offset
+            return self.map[start:start + length]
+
+    def put(self, key, value):
+        '''
+        Stores `value` of `key`, evicting least recently used values if
+        needed. Returns False if value is too long to be cached.
+        '''
+        if len(value) > self.max_entry:
+            return False
+        with self.locked():
+            header = list(HEADER.unpack_from(self.map))
+            if self._find(key) is not None:
+                return True
+            while True:
+                entries = []
+                free = None
+                for slot, (_, offset, length, used) in enumerate(ENTRY.iter_unpack(self.map[self.index_start:self.data_start])):
+                    if used:
+                        entries.append((offset, length, used, slot))
+                    elif free is None:
+                        free = slot
+                offset = self._gap(entries, len(value)) if free is not None else None
+                if offset is not None:
+                    break
+                # Nothing fits, or all entries are taken
+                _, _, _, slot = min(entries, key = lambda entry: entry[2])
+                self._free(slot)
+                header[8] += 1
+
+            start = self.data_start + offset
+            self.map[start:start + len(value)] = value
+            header[4] += 1
+            header[7] += 1
+            # Entry goes last, so crash in the middle leaves no broken value
+            ENTRY.pack_into(self.map, self.index_start + free * ENTRY.size, key, offset, len(value), header[4])
+            HEADER.pack_into(self.map, 0, *header)
+            return True
+
+    def stats(self):
+        '''
+        Returns dict of counters, number of entries and bytes they take
+        '''
+        with self.locked():
+            header = HEADER.unpack_from(self.map)
+            entries = [
+                length
+                for _, _, length, used in ENTRY.iter_unpack(self.map[self.index_start:self.data_start])
+                if used
+            ]
+        stats = dict(zip(COUNTERS, header[5:]))
+        stats.update(entries = len(entries), bytes = sum(entries))
+        return stats
+
+    def clear(self):
+        '''
+        Removes all values and resets counters
+        '''
+        with self.locked():
+            self._clear()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def _clear(self):
+        self.map[:self.data_start] = bytes(self.data_start)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.slots, self.size, 0, 0, 0, 0, 0)
+
+    def _find(self, key):
+        '''
+        Returns index slot of `key`, or None
+        '''
+        position = self.map.find(key, self.index_start, self.data_start)
+        while position >= 0:
+            slot, misaligned = divmod(position - self.index_start, ENTRY.size)
+            # Digest can also match across entries, or in their numbers
+            if not misaligned and ENTRY.unpack_from(self.map, position)[3]:
+                return slot
+            position = self.map.find(key, position + 1, self.data_start)
+        return None
+
+    def _free(self, slot):
+        ENTRY.pack_into(self.map, self.index_start + slot * ENTRY.size, bytes(32), 0, 0, 0)
+
+    def _gap(self, entries, length):
+        '''
+        Returns offset of first free space of `length` bytes in data
+        '''
+        end = 0
+        for offset, size, _, _ in sorted(entries):
+            if offset - end >= length:
+                return end
+            end = max(end, offset + size)
+        if self.size - end >= length:
+            return end
+        return None
@@ -2,35 +2,55 @@
 
 '''
 Convenience utilities to create ctypes funcptrs
+
+Arguments are converted by ctypes itself, according to fixed `argtypes`,
+so calls don't go through any Python code but `errno_check`. Use `c_path`
+for paths and other strings, it takes bytes, str and path-like objects.
 '''
 
-import errno
 import ctypes as ct
 from ctypes.util import find_library
+import functools
 import os
 
 __all__ = (
+    'c_path',
     'ccall',
+    'pysyscall',
     'syscall',
 )
 libc = ct.CDLL(find_library('c'), use_errno = True)
+# Its functions hold the GIL while they run, see `pysyscall`
+pylibc = ct.PyDLL(find_library('c'), use_errno = True)
+
+class c_path(ct.c_char_p):
+    '''
+    `c_char_p` which also takes str and path-like objects,
+    encoded with filesystem encoding. None is NULL.
+    '''
+    @classmethod
+    def from_param(cls, value):
+        if value is None or value.__class__ is bytes:
+            return value
+        return os.fsencode(value)
 
 def errno_check(result, func, arguments):
     '''
-    Raises OSError with errno on nonzero ccall return value.
+    Raises OSError with errno on negative ccall return value.
 
-    For use in ccalls which return nonzero value and set errno on error.
+    For use in ccalls which return negative value and set errno on error.
     '''
     if result < 0:
-        errno_ = ct.get_errno()
-        errcode = errno.errorcode.get(errno_)
-        if errcode:
-            errcode = '{} {}'.format(errcode, os.strerror(errno_))
-        else:
-            errcode = errno_
-        raise OSError(errno_, 'Got nonzero value {} and error "{}" was set'.format(result, errcode))
+        raise errno_error(ct.get_errno())
     return result
 
+def errno_error(errno_):
+    '''
+    Returns OSError for `errno_`, of the same subclass `os` functions
+    raise (eg. FileNotFoundError for ENOENT)
+    '''
+    return OSError(errno_, os.strerror(errno_))
+
 def ccall(name, raise_errno, return_type=None, *arg_types):
     '''
     Create a libc function call
@@ -44,16 +64,26 @@ def ccall(name, raise_errno, return_type=None, *arg_types):
 
 def syscall(sys_id, *arg_types):
     '''
-    Make a syscall. 
-    '''
-    def syscall_wrap(*args):
-        assert len(arg_types) == len(args)
-        sys_args = (atype.from_param(avalue) for atype, avalue in zip(arg_types, args))
-        return _syscall(sys_id, *sys_args)
-    return syscall_wrap
+    Make a syscall. Returns function taking its arguments, of `arg_types`.
 
-# We don't use ccall in this case
-_syscall = libc.syscall
-_syscall.restype = ct.c_int
-_syscall.errcheck = errno_check
+    Each syscall gets its own prototype of libc `syscall`, so arguments
+    are checked and converted like in `ccall`.
+    '''
+    prototype = ct.CFUNCTYPE(ct.c_long, ct.c_long, *arg_types, use_errno = True)
+    call = prototype(('syscall', libc))
+    call.errcheck = errno_check
+    return functools.partial(call, sys_id)
 
+def pysyscall(sys_id, *arg_types):
+    '''
+    Like `syscall`, but the call holds the GIL, like functions of
+    `ctypes.pythonapi`. For syscalls which fork: if GIL was released
+    around them, other thread could take it right then, and child
+    would inherit it locked, forever.
+    '''
+    # Indexing, unlike attribute access, gives new function every time
+    call = pylibc['syscall']
+    call.restype = ct.c_long
+    call.argtypes = (ct.c_long,) + arg_types
+    call.errcheck = errno_check
+    return functools.partial(call, sys_id)
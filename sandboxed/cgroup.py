@@ -0,0 +1,248 @@
+#coding:utf8
+
+'''
+Resource control with cgroup v2.
+
+`CgroupTree` is a cgroup dedicated to jailed processes, with one leaf
+`Cgroup` created per execution. All operations use directory descriptors
+opened when tree is created, so they keep working after `pivot_root`, when
+cgroup filesystem is no longer visible.
+
+Tree can't contain processes by itself (cgroup v2 doesn't allow processes
+in cgroups which distribute resources to children), so it has to be a new
+cgroup, not the one we are running in.
+'''
+
+import errno
+import os
+import select
+import signal
+import time
+
+__all__ = (
+    'Cgroup',
+    'CgroupTree',
+)
+
+CGROUP2_PATH = '/sys/fs/cgroup'
+
+# How long `Cgroup.remove` waits for killed processes, and how many times
+# it kills them, before it gives up
+KILL_WAIT = 0.5
+KILL_TRIES = 3
+
+def _write(dir_fd, name, value):
+    fd = os.open(name, os.O_WRONLY, dir_fd = dir_fd)
+    try:
+        os.write(fd, str(value).encode())
+    finally:
+        os.close(fd)
+
+def _read(dir_fd, name):
+    fd = os.open(name, os.O_RDONLY, dir_fd = dir_fd)
+    try:
+        return os.read(fd, 64 * 1024).decode()
+    finally:
+        os.close(fd)
+
+class CgroupTree:
+    '''
+    Parent cgroup of all per-execution cgroups.
+
+    `path` is created if needed, and `controllers` are enabled for it and
+    its children. Its parent has to be cgroup v2 directory, otherwise
+    OSError (ENOTSUP) is raised.
+    '''
+    def __init__(self, path = os.path.join(CGROUP2_PATH, 'sandboxed'), controllers = ('cpu', 'memory', 'pids')):
+        self.path = path
+        parent = os.path.dirname(path)
+        # Every cgroup v2 directory has it. mkdir would succeed anywhere
+        # else too, and writes would fail later.
+        if not os.path.exists(os.path.join(parent, 'cgroup.controllers')):
+            raise OSError(errno.ENOTSUP, 'Not a cgroup v2 directory', parent)
+        try:
+            os.mkdir(path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        self.dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+        try:
+            if controllers:
+                enable = ' '.join('+' + name for name in controllers)
+                parent_fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    _write(parent_fd, 'cgroup.subtree_control', enable)
+                finally:
+                    os.close(parent_fd)
+                _write(self.dir_fd, 'cgroup.subtree_control', enable)
+        except:
+            self.close()
+            raise
+
+    def create(self, name, memory_max = None, memory_high = None, cpu_max = None, pids_max = None):
+        '''
+        Creates leaf cgroup with given limits, see `Cgroup.set_limits`.
+        Leftover cgroup of the same name is removed first.
+        '''
+        try:
+            os.mkdir(name, dir_fd = self.dir_fd)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            Cgroup(self, name).remove()
+            os.mkdir(name, dir_fd = self.dir_fd)
+        cgroup = Cgroup(self, name)
+        cgroup.set_limits(memory_max, memory_high, cpu_max, pids_max)
+        return cgroup
+
+    def clear(self):
+        '''
+        Removes all leaf cgroups, killing processes left in them. Raises
+        first error once it tried all of them.
+        '''
+        error = None
+        for entry in os.scandir(self.dir_fd):
+            if entry.is_dir():
+                try:
+                    Cgroup(self, entry.name).remove()
+                except OSError as exc:
+                    error = error or exc
+        if error:
+            raise error
+
+    def close(self):
+        os.close(self.dir_fd)
+
+class Cgroup:
+    '''
+    Leaf cgroup for one execution.
+    '''
+    def __init__(self, tree, name):
+        self.tree = tree
+        self.name = name
+        self.dir_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd = tree.dir_fd)
+
+    def fileno(self):
+        return self.dir_fd
+
+    def set(self, name, value):
+        _write(self.dir_fd, name, value)
+
+    def read(self, name):
+        return _read(self.dir_fd, name)
+
+    def set_limits(self, memory_max = None, memory_high = None, cpu_max = None, pids_max = None):
+        '''
+        `memory_max` and `memory_high` are in bytes, `cpu_max` is number
+        of CPUs (may be fractional), `pids_max` is number of processes
+        and threads. None leaves limit unchanged.
+        '''
+        if memory_max is not None:
+            self.set('memory.max', memory_max)
+        if memory_high is not None:
+            self.set('memory.high', memory_high)
+        if cpu_max is not None:
+            period = 100000
+            self.set('cpu.max', '{} {}'.format(int(cpu_max * period), period))
+        if pids_max is not None:
+            self.set('pids.max', pids_max)
+
+    def attach(self, pid = 0):
+        '''
+        Moves process to this cgroup, 0 means calling process.
+        '''
+        self.set('cgroup.procs', pid)
+
+    def memory_peak(self):
+        '''
+        Returns peak memory usage in bytes, or None if kernel doesn't
+        report it (memory.peak is there since Linux 5.19).
+        '''
+        try:
+            return int(self.read('memory.peak'))
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+    def cpu_stat(self):
+        '''
+        Returns dict of cpu.stat fields, eg. usage_usec, user_usec,
+        system_usec, nr_throttled.
+        '''
+        stat = {}
+        for line in self.read('cpu.stat').splitlines():
+            key, _, value = line.partition(' ')
+            stat[key] = int(value)
+        return stat
+
+    def populated(self):
+        for line in self.read('cgroup.events').splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'populated':
+                return value == '1'
+        return False
+
+    def kill(self):
+        '''
+        Kills all processes in cgroup. Uses cgroup.kill if kernel has it
+        (Linux 5.14), otherwise signals processes one by one.
+        '''
+        try:
+            self.set('cgroup.kill', 1)
+            return
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        for pid in self.read('cgroup.procs').split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except OSError as exc:
+                if exc.errno != errno.ESRCH:
+                    raise
+
+    def wait_empty(self, timeout = None):
+        '''
+        Waits until there are no processes in cgroup. Kernel notifies
+        about changes of cgroup.events with POLLPRI.
+        Returns True if cgroup is empty.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        fd = os.open('cgroup.events', os.O_RDONLY, dir_fd = self.dir_fd)
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLPRI)
+            while self.populated():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    remaining = int(remaining * 1000) + 1
+                poller.poll(remaining)
+            return True
+        finally:
+            os.close(fd)
+
+    def remove(self):
+        '''
+        Kills whatever is left in cgroup and removes it. Processes still
+        there after `KILL_WAIT` (forked meanwhile, or stuck in kernel)
+        are killed again, and if they don't go after `KILL_TRIES` kills,
+        OSError (EBUSY) is raised.
+        '''
+        try:
+            for _ in range(KILL_TRIES):
+                if not self.populated():
+                    break
+                self.kill()
+                self.wait_empty(KILL_WAIT)
+            os.rmdir(self.name, dir_fd = self.tree.dir_fd)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.dir_fd is not None:
+            os.close(self.dir_fd)
+            self.dir_fd = None
@@ -0,0 +1,12 @@
+#coding:utf8
+
+'''
+Clients of `remote_exec.Jail`, speaking framed protocol (see
+`sandboxed.protocol`) over pooled, persistent connections.
+
+`Client` is blocking, `AsyncClient` is for asyncio.
+'''
+
+from .common import *
+from .sync import *
+from .aio import *
@@ -0,0 +1,201 @@
+#coding:utf8
+
+'''
+Asyncio client
+'''
+
+import asyncio
+import collections
+import time
+
+from .. import protocol
+from .common import BUF_SIZE, Response, Result, encode_request
+
+__all__ = (
+    'AsyncClient',
+    'Stream',
+)
+
+class AsyncClient:
+    '''
+    Asyncio client of `remote_exec.Jail`, using framed protocol.
+
+    At most `pool_size` executions run at once, each over its own
+    connection; others wait for a free one. Connections are kept open
+    between calls for up to `max_idle` seconds (keep it below server's
+    `idle_timeout`).
+
+    `timeout` is default limit of whole call, in seconds.
+    '''
+    def __init__(self, path, pool_size = 8, timeout = None, max_idle = 4.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        # (reader, writer, time it was returned)
+        self.idle = collections.deque()
+        self.slots = asyncio.Semaphore(pool_size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        while self.idle:
+            _, writer, _ = self.idle.pop()
+            writer.close()
+            await writer.wait_closed()
+
+    def stream(self, data, timeout = None, time_limit = None, cpu_limit = None):
+        '''
+        Executes script with `data` (bytes or str) as its stdin. Returns
+        `Stream`, async iterator of chunks of its stdout.
+        '''
+        return Stream(self, data, self.timeout if timeout is None else timeout, time_limit, cpu_limit)
+
+    async def run(self, data, timeout = None, time_limit = None, cpu_limit = None):
+        '''
+        Executes script with `data` (bytes or str) as its stdin.
+        Returns `Result`. Raises TimeoutError if it takes more than
+        `timeout` seconds, OSError if connection fails.
+
+        `time_limit` and `cpu_limit` (seconds) lower server's limits of
+        this execution; script exceeding them is killed, see `Result`.
+        '''
+        stream = self.stream(data, timeout, time_limit, cpu_limit)
+        stdout = []
+        async for chunk in stream:
+            stdout.append(chunk)
+        stream.result.stdout = b''.join(stdout)
+        return stream.result
+
+    async def map(self, inputs, concurrency = None, timeout = None, return_exceptions = False, time_limit = None, cpu_limit = None):
+        '''
+        Executes script for each of `inputs`, at most `concurrency`
+        (`pool_size` by default) at once. Returns list of `Result` in
+        order of `inputs`. With `return_exceptions`, failed executions
+        give exceptions instead of failing whole call.
+        '''
+        limit = asyncio.Semaphore(concurrency or self.pool_size)
+
+        async def run_one(data):
+            async with limit:
+                return await self.run(data, timeout, time_limit, cpu_limit)
+
+        return await asyncio.gather(
+            *(run_one(data) for data in inputs),
+            return_exceptions = return_exceptions
+        )
+
+    def take(self):
+        '''
+        Returns idle connection, or None if there is no fresh one.
+        '''
+        while self.idle:
+            reader, writer, since = self.idle.pop()
+            if time.monotonic() - since < self.max_idle and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def give_back(self, reader, writer):
+        if len(self.idle) < self.pool_size:
+            self.idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+class Stream:
+    '''
+    Async iterator of stdout chunks of one execution, see
+    `AsyncClient.stream`.
+
+    Once it's exhausted, `result` is `Result` with stderr and status (but
+    empty stdout, which was already given away). Leaving it earlier
+    closes the connection.
+    '''
+    def __init__(self, client, data, timeout, time_limit = None, cpu_limit = None):
+        self.client = client
+        self.data = data
+        self.timeout = timeout
+        self.time_limit = time_limit
+        self.cpu_limit = cpu_limit
+        self.result = None
+
+    def __aiter__(self):
+        return self.chunks()
+
+    async def chunks(self):
+        client = self.client
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError('Execution took too long')
+            return left
+
+        async with client.slots:
+            while True:
+                connection = client.take()
+                reused = connection is not None
+                if not reused:
+                    try:
+                        connection = await asyncio.wait_for(
+                            asyncio.open_unix_connection(client.path),
+                            remaining(),
+                        )
+                    except asyncio.TimeoutError:
+                        raise TimeoutError('Timed out connecting to {}'.format(client.path))
+                reader, writer = connection
+                response = Response(magic = not reused)
+                stderr = []
+                # Send request while we read, so neither side blocks when
+                # script writes before it reads all its input
+                writer.write(encode_request(self.data, not reused, self.time_limit, self.cpu_limit))
+                sending = asyncio.ensure_future(writer.drain())
+                try:
+                    while not response.done:
+                        try:
+                            data = await asyncio.wait_for(reader.read(BUF_SIZE), remaining())
+                        except asyncio.TimeoutError:
+                            raise TimeoutError('Execution took too long')
+                        if not data:
+                            raise ConnectionResetError('Server closed connection')
+                        for kind, payload in response.feed(data):
+                            if kind == protocol.STDOUT:
+                                yield payload
+                            else:
+                                stderr.append(payload)
+                    try:
+                        await sending
+                    except OSError:
+                        # Server which rejected request doesn't read rest
+                        # of it
+                        if not response.status.get('rejected'):
+                            raise
+                except TimeoutError:
+                    sending.cancel()
+                    writer.close()
+                    raise
+                except OSError:
+                    sending.cancel()
+                    writer.close()
+                    # Server could close idle connection just before we
+                    # sent request. It never saw it, so we can try again.
+                    if reused and not response.received:
+                        continue
+                    raise
+                except BaseException:
+                    sending.cancel()
+                    writer.close()
+                    raise
+                if response.status.get('rejected'):
+                    writer.close()
+                else:
+                    client.give_back(reader, writer)
+                self.result = Result(b'', b''.join(stderr), response.status)
+                return
@@ -0,0 +1,131 @@
+#coding:utf8
+
+'''
+Parts shared by blocking and asyncio clients
+'''
+
+from .. import protocol
+
+__all__ = (
+    'Result',
+    'encode_request',
+)
+
+# How much we read from socket at once
+BUF_SIZE = 64 * 1024
+
+def encode_request(data, magic = False, time_limit = None, cpu_limit = None):
+    '''
+    Returns frames sending `data` (bytes or str) as stdin of one
+    execution. With `magic`, they are preceded by `protocol.MAGIC`,
+    as first request on new connection.
+
+    `time_limit` and `cpu_limit` (seconds) ask server to kill script
+    sooner than its own limits would.
+    '''
+    if isinstance(data, str):
+        data = data.encode()
+    chunks = [protocol.MAGIC] if magic else []
+    if time_limit is not None or cpu_limit is not None:
+        chunks.append(protocol.pack_limits(_to_ms(time_limit), _to_ms(cpu_limit)))
+    for pos in range(0, len(data), protocol.MAX_PAYLOAD):
+        chunks.append(protocol.pack_frame(protocol.STDIN, data[pos:pos + protocol.MAX_PAYLOAD]))
+    chunks.append(protocol.pack_frame(protocol.EOF))
+    return b''.join(chunks)
+
+def _to_ms(seconds):
+    if seconds is None:
+        return None
+    return max(int(round(seconds * 1000)), 1)
+
+class Result:
+    '''
+    Outcome of one execution.
+
+    `status` is report sent by server: exit code or signal, times, memory
+    and bytes transferred, see `remote_exec.Prisoner.usage`.
+    '''
+    def __init__(self, stdout, stderr, status):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.status = status
+
+    @property
+    def exit_code(self):
+        return self.status.get('exit_code')
+
+    @property
+    def signal(self):
+        return self.status.get('signal')
+
+    @property
+    def timed_out(self):
+        return bool(self.status.get('timed_out'))
+
+    @property
+    def cpu_exceeded(self):
+        return bool(self.status.get('cpu_exceeded'))
+
+    @property
+    def error(self):
+        return self.status.get('error')
+
+    @property
+    def rejected(self):
+        '''
+        Why server didn't run the script (`overloaded`, `queue_timeout`
+        or `shutdown`), or None
+        '''
+        return self.status.get('rejected')
+
+    @property
+    def ok(self):
+        return self.exit_code == 0 and not (self.timed_out or self.cpu_exceeded)
+
+    def __repr__(self):
+        return '<Result exit_code={} signal={} stdout={} bytes stderr={} bytes>'.format(
+            self.exit_code, self.signal, len(self.stdout), len(self.stderr),
+        )
+
+class Response:
+    '''
+    Parses server's answer to one request.
+
+    `feed` takes received bytes and returns list of STDOUT and STDERR
+    frames (type and payload). `done` becomes True once STATUS arrives.
+    '''
+    def __init__(self, magic = False):
+        # New connection starts with server's magic
+        self.magic = protocol.MAGIC if magic else b''
+        self.frames = protocol.FrameReader()
+        self.status = None
+        self.received = False
+
+    @property
+    def done(self):
+        return self.status is not None
+
+    def feed(self, data):
+        self.received = True
+        if self.magic:
+            head, data = data[:len(self.magic)], data[len(self.magic):]
+            if not self.magic.startswith(head):
+                raise protocol.ProtocolError('Server does not speak framed protocol')
+            self.magic = self.magic[len(head):]
+        self.frames.feed(data)
+
+        output = []
+        while not self.done:
+            frame = self.frames.next_frame()
+            if frame is None:
+                break
+            kind, payload = frame
+            if kind == protocol.STATUS:
+                self.status = protocol.unpack_status(payload)
+            elif kind in (protocol.STDOUT, protocol.STDERR):
+                output.append(frame)
+            else:
+                raise protocol.ProtocolError('Unexpected frame {}'.format(kind))
+        if self.done and self.frames.buf:
+            raise protocol.ProtocolError('Data after status')
+        return output
@@ -0,0 +1,163 @@
+#coding:utf8
+
+'''
+Blocking client
+'''
+
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from .. import protocol
+from .common import BUF_SIZE, Response, Result, encode_request
+
+__all__ = (
+    'Client',
+)
+
+class Client:
+    '''
+    Blocking client of `remote_exec.Jail`, using framed protocol.
+
+    Connections are kept open between calls, at most `pool_size` of them,
+    for up to `max_idle` seconds (keep it below server's `idle_timeout`).
+    Client can be shared between threads.
+
+    `timeout` is default limit of whole call, in seconds.
+    '''
+    def __init__(self, path, pool_size = 4, timeout = None, max_idle = 4.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        # (socket, time it was returned)
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop()[0].close()
+
+    def run(self, data, timeout = None, time_limit = None, cpu_limit = None):
+        '''
+        Executes script with `data` (bytes or str) as its stdin.
+        Returns `Result`. Raises TimeoutError if it takes more than
+        `timeout` seconds, OSError if connection fails. Overloaded server
+        can reject the call, see `Result.rejected`.
+
+        `time_limit` and `cpu_limit` (seconds) lower server's limits of
+        this execution; script exceeding them is killed, see `Result`.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            sock = self.take()
+            reused = sock is not None
+            if not reused:
+                sock = self.connect(deadline)
+            response = Response(magic = not reused)
+            try:
+                result = self.execute(sock, encode_request(data, not reused, time_limit, cpu_limit), response, deadline)
+            except TimeoutError:
+                sock.close()
+                raise
+            except OSError:
+                sock.close()
+                # Server could close idle connection just before we sent
+                # request. It never saw it, so we can try again.
+                if reused and not response.received:
+                    continue
+                raise
+            except:
+                sock.close()
+                raise
+            if result.rejected:
+                # Server closed connection after rejecting it
+                sock.close()
+            else:
+                self.give_back(sock)
+            return result
+
+    def take(self):
+        '''
+        Returns idle connection, or None if there is no fresh one.
+        '''
+        with self.lock:
+            while self.idle:
+                sock, since = self.idle.pop()
+                if time.monotonic() - since < self.max_idle:
+                    return sock
+                sock.close()
+        return None
+
+    def give_back(self, sock):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def connect(self, deadline = None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if deadline is not None:
+                sock.settimeout(max(deadline - time.monotonic(), 0))
+            sock.connect(self.path)
+        except socket.timeout:
+            sock.close()
+            raise TimeoutError('Timed out connecting to {}'.format(self.path))
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def execute(self, sock, request, response, deadline):
+        '''
+        Sends request and receives response at the same time, so neither
+        side blocks when script writes before it reads all its input.
+        '''
+        stdout = []
+        stderr = []
+        request = memoryview(request)
+        sock.setblocking(False)
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            while not response.done:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError('Execution took too long')
+                for _, events in selector.select(remaining):
+                    if events & selectors.EVENT_WRITE and request:
+                        try:
+                            request = request[sock.send(request):]
+                        except BlockingIOError:
+                            pass
+                        except (BrokenPipeError, ConnectionResetError):
+                            # Server stopped reading, it could have
+                            # rejected request; its answer is still there
+                            request = request[:0]
+                        if not request:
+                            selector.modify(sock, selectors.EVENT_READ)
+                    if events & selectors.EVENT_READ:
+                        try:
+                            data = sock.recv(BUF_SIZE)
+                        except BlockingIOError:
+                            continue
+                        if not data:
+                            raise ConnectionResetError('Server closed connection')
+                        for kind, payload in response.feed(data):
+                            (stdout if kind == protocol.STDOUT else stderr).append(payload)
+        return Result(b''.join(stdout), b''.join(stderr), response.status)
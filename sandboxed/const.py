@@ -15,14 +15,29 @@ if machine in ('x86_64', 'i386', 'i686'):
         SYS_clone = 56
         SYS_getpid = 39
         SYS_getppid = 110
+        SYS_waitid = 247
     else:
         # arch/x86/include/asm/unistd_32.h
         SYS_clone = 120
         SYS_getpid = 20
         SYS_getppid = 64
+        SYS_waitid = 284
 else:
     raise EnvironmentError('Machine "{}" is not supported'.format(machine))
 
+# Syscalls added since Linux 5.1 have the same ids on all architectures
+# include/uapi/asm-generic/unistd.h
+SYS_pidfd_send_signal = 424
+SYS_open_tree = 428
+SYS_move_mount = 429
+SYS_fsopen = 430
+SYS_fsconfig = 431
+SYS_fsmount = 432
+SYS_fspick = 433
+SYS_pidfd_open = 434
+SYS_clone3 = 435
+SYS_mount_setattr = 442
+
 # bits/sched.h
 
 CSIGNAL = 0x000000ff
@@ -31,6 +46,7 @@ CLONE_FS = 0x00000200
 CLONE_FILES = 0x00000400
 CLONE_SIGHAND = 0x00000800
 CLONE_PTRACE = 0x00002000
+CLONE_PIDFD = 0x00001000
 CLONE_VFORK = 0x00004000
 CLONE_PARENT = 0x00008000
 CLONE_THREAD = 0x00010000
@@ -42,12 +58,16 @@ CLONE_CHILD_CLEARTID = 0x00200000
 CLONE_DETACHED = 0x00400000
 CLONE_UNTRACED = 0x00800000
 CLONE_CHILD_SETTID = 0x01000000
+CLONE_NEWCGROUP = 0x02000000
 CLONE_NEWUTS = 0x04000000
 CLONE_NEWIPC = 0x08000000
 CLONE_NEWUSER = 0x10000000
 CLONE_NEWPID = 0x20000000
 CLONE_NEWNET = 0x40000000
 CLONE_IO = 0x80000000
+# Only clone3 takes these
+CLONE_CLEAR_SIGHAND = 0x100000000
+CLONE_INTO_CGROUP = 0x200000000
 
 # sys/mount.h
 
@@ -82,7 +102,110 @@ MNT_DETACH = 2
 MNT_EXPIRE = 4
 UMOUNT_NOFOLLOW = 8
 
+# linux/mount.h, new mount API (Linux 5.2, mount_setattr since 5.12)
+
+OPEN_TREE_CLONE = 1
+OPEN_TREE_CLOEXEC = 0o2000000
+
+MOVE_MOUNT_F_SYMLINKS = 0x01
+MOVE_MOUNT_F_AUTOMOUNTS = 0x02
+MOVE_MOUNT_F_EMPTY_PATH = 0x04
+MOVE_MOUNT_T_SYMLINKS = 0x10
+MOVE_MOUNT_T_AUTOMOUNTS = 0x20
+MOVE_MOUNT_T_EMPTY_PATH = 0x40
+
+FSOPEN_CLOEXEC = 1
+
+FSPICK_CLOEXEC = 1
+FSPICK_SYMLINK_NOFOLLOW = 2
+FSPICK_NO_AUTOMOUNT = 4
+FSPICK_EMPTY_PATH = 8
+
+FSCONFIG_SET_FLAG = 0
+FSCONFIG_SET_STRING = 1
+FSCONFIG_SET_BINARY = 2
+FSCONFIG_SET_PATH = 3
+FSCONFIG_SET_PATH_EMPTY = 4
+FSCONFIG_SET_FD = 5
+FSCONFIG_CMD_CREATE = 6
+FSCONFIG_CMD_RECONFIGURE = 7
+
+FSMOUNT_CLOEXEC = 1
+
+MOUNT_ATTR_RDONLY = 0x00000001
+MOUNT_ATTR_NOSUID = 0x00000002
+MOUNT_ATTR_NODEV = 0x00000004
+MOUNT_ATTR_NOEXEC = 0x00000008
+MOUNT_ATTR__ATIME = 0x00000070
+MOUNT_ATTR_RELATIME = 0x00000000
+MOUNT_ATTR_NOATIME = 0x00000010
+MOUNT_ATTR_STRICTATIME = 0x00000020
+MOUNT_ATTR_NODIRATIME = 0x00000080
+MOUNT_ATTR_IDMAP = 0x00100000
+MOUNT_ATTR_NOSYMFOLLOW = 0x00200000
+
+# linux/loop.h
+
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+
+# linux/fcntl.h
+
+AT_FDCWD = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_NO_AUTOMOUNT = 0x800
+AT_EMPTY_PATH = 0x1000
+AT_RECURSIVE = 0x8000
+
+# bits/fcntl-linux.h
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+SPLICE_F_GIFT = 8
+
+# bits/mman-shared.h
+
+MFD_CLOEXEC = 1
+MFD_ALLOW_SEALING = 2
+
+# sys/signalfd.h
+
+SFD_CLOEXEC = 0o2000000
+SFD_NONBLOCK = 0o4000
+
 # bits/waitflags.h
 
+WNOHANG = 1
+WSTOPPED = 2
+WEXITED = 4
+WCONTINUED = 8
+WNOWAIT = 0x01000000
 WALL = 0x40000000
 
+# bits/waitflags.h, idtype_t
+
+P_ALL = 0
+P_PID = 1
+P_PGID = 2
+P_PIDFD = 3
+
+# bits/siginfo-consts.h, si_code for SIGCHLD
+
+CLD_EXITED = 1
+CLD_KILLED = 2
+CLD_DUMPED = 3
+CLD_TRAPPED = 4
+CLD_STOPPED = 5
+CLD_CONTINUED = 6
+
+# linux/pidfd.h
+
+PIDFD_NONBLOCK = 0o4000
+
@@ -0,0 +1,576 @@
+#coding:utf8
+
+'''
+Minimal images of Python distribution for jails.
+
+`remote_exec.Jail` mounts its `usr_path` as `/usr` of jail, with `/lib`
+and `/lib64` linking to `/usr/lib`. Instead of copying whole distribution
+there, `ImageBuilder` puts together only what Python needs:
+
+    bin/python      interpreter
+    lib/pythonX.Y   standard library (relative to prefix of Python), with
+                    extension modules, without tests, GUI and packaging
+                    tools (see EXCLUDE)
+    ...             modules and packages given in allowlist
+    lib/...         shared libraries needed by interpreter and extension
+                    modules (ELF `DT_NEEDED`, recursively) and dynamic
+                    loader, where loader will look for them in jail
+    bin/main.py     main script, if given
+
+Libraries are found like dynamic loader finds them (RPATH, RUNPATH,
+ld.so.conf, default directories), see `LibraryResolver`. Libraries loaded
+by `dlopen` aren't listed anywhere, give them in `libraries`.
+
+Image is directory, or single squashfs or erofs file made of it by
+`mksquashfs` or `mkfs.erofs`, which `Jail` mounts at once, see
+`mount_image`. Such file is shared by all mounts of it in page cache, and
+erofs can be mounted without loop device. Run as script:
+
+    python -m sandboxed.image OUTPUT [--python PATH] [--modules a,b]
+        [--libraries libgcc_s.so.1] [--main main.py] [--fs-type erofs]
+        [--compile]
+'''
+
+import argparse
+import collections
+import errno
+import fcntl
+import fnmatch
+import glob
+import json
+import mmap
+import os
+import os.path
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+from . import const
+from . import lowlevel
+from .utils import mount_bind_tree
+
+__all__ = (
+    'Elf',
+    'ImageBuilder',
+    'LibraryResolver',
+    'attach_loop',
+    'image_fs_type',
+    'mount_image',
+    'read_elf',
+)
+
+# Names of files and directories left out of standard library
+EXCLUDE = (
+    '*.exe',
+    '_test*',
+    '_tkinter.*',
+    '_xxtest*',
+    'config-*',
+    'dist-packages',
+    'ensurepip',
+    'idle_test',
+    'idlelib',
+    'lib2to3',
+    'site-packages',
+    'test',
+    'tests',
+    'tkinter',
+    'turtle.py',
+    'turtledemo',
+    'venv',
+    'xxlimited*',
+)
+
+# Searched by dynamic loader after ld.so.conf
+DEFAULT_LIBRARY_DIRS = ('/lib64', '/usr/lib64', '/lib', '/usr/lib')
+
+# Commands making image file of `tree`
+MKFS = dict(
+    erofs = ('mkfs.erofs', '--all-root', '{image}', '{tree}'),
+    squashfs = ('mksquashfs', '{tree}', '{image}', '-noappend', '-all-root', '-quiet'),
+)
+
+SQUASHFS_MAGIC = b'hsqs'
+EROFS_MAGIC = struct.pack('<I', 0xE0F5E1E2)
+EROFS_MAGIC_OFFSET = 1024
+
+IMAGE_FLAGS = const.MS_RDONLY | const.MS_NODEV | const.MS_NOSUID | const.MS_NOATIME
+
+# elf.h
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# linux/loop.h, struct loop_info64 and struct loop_config
+LOOP_INFO = struct.Struct('=QQQQQIIII64s64s32s16s')
+LOOP_CONFIG = struct.Struct('=II{}s64s'.format(LOOP_INFO.size))
+
+# Run by Python image is made of, prints what builder needs to know
+QUERY = '''
+import importlib.util, json, os, sys, sysconfig
+modules = {}
+for name in sys.argv[1:]:
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.origin in ('built-in', 'frozen'):
+        modules[name] = [] if spec else None
+    else:
+        modules[name] = list(spec.submodule_search_locations or [spec.origin])
+print(json.dumps(dict(
+    prefix = sys.base_prefix,
+    executable = os.path.realpath(sys.executable),
+    version = '%d.%d' % sys.version_info[:2],
+    stdlib = sysconfig.get_path('stdlib'),
+    path = [entry for entry in sys.path[1:] if os.path.isdir(entry)],
+    modules = modules,
+)))
+'''
+
+Elf = collections.namedtuple('Elf', ('path', 'elf_class', 'machine', 'interp', 'needed', 'rpath', 'runpath'))
+
+def read_elf(path):
+    '''
+    Returns `Elf` describing dynamic linking of ELF file in `path`: class,
+    machine, interpreter (dynamic loader), needed libraries and RPATH and
+    RUNPATH (lists of directories). Returns None if it's not ELF file.
+    '''
+    with open(path, 'rb') as fp:
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return None
+    with data:
+        if data[:4] != ELF_MAGIC:
+            return None
+        elf_class = data[4]
+        order = '<' if data[5] == ELFDATA2LSB else '>'
+        if elf_class == ELFCLASS64:
+            header = struct.Struct(order + 'HHIQQQIHHH')
+            segment = struct.Struct(order + 'IIQQQQ')
+            dynamic = struct.Struct(order + 'qQ')
+        else:
+            header = struct.Struct(order + 'HHIIIIIHHH')
+            segment = struct.Struct(order + 'IIIIII')
+            dynamic = struct.Struct(order + 'iI')
+        _, machine, _, _, phoff, _, _, _, phentsize, phnum = header.unpack_from(data, 16)
+
+        # (type, offset in file, address, size in file)
+        segments = []
+        for index in range(phnum):
+            fields = segment.unpack_from(data, phoff + index * phentsize)
+            if elf_class == ELFCLASS64:
+                p_type, _, offset, address, _, size = fields
+            else:
+                p_type, offset, address, _, size, _ = fields
+            segments.append((p_type, offset, address, size))
+
+        def string(offset):
+            return os.fsdecode(data[offset:data.find(b'\0', offset)])
+
+        interp = None
+        entries = []
+        for p_type, offset, address, size in segments:
+            if p_type == PT_INTERP:
+                interp = string(offset)
+            elif p_type == PT_DYNAMIC:
+                for position in range(offset, offset + size, dynamic.size):
+                    tag, value = dynamic.unpack_from(data, position)
+                    if tag == DT_NULL:
+                        break
+                    entries.append((tag, value))
+
+        needed = []
+        rpath = []
+        runpath = []
+        strtab = [value for tag, value in entries if tag == DT_STRTAB]
+        if strtab:
+            # Dynamic section has address of string table, not offset
+            for p_type, offset, address, size in segments:
+                if p_type == PT_LOAD and address <= strtab[0] < address + size:
+                    strtab = strtab[0] - address + offset
+                    break
+            else:
+                raise ValueError('String table of {} not found'.format(path))
+            for tag, value in entries:
+                if tag == DT_NEEDED:
+                    needed.append(string(strtab + value))
+                elif tag == DT_RPATH:
+                    rpath.extend(string(strtab + value).split(':'))
+                elif tag == DT_RUNPATH:
+                    runpath.extend(string(strtab + value).split(':'))
+    return Elf(path, elf_class, machine, interp, needed, rpath, runpath)
+
+def read_ld_conf(path = '/etc/ld.so.conf'):
+    '''
+    Returns directories listed in ld.so.conf, with included files
+    '''
+    dirs = []
+    try:
+        with open(path) as fp:
+            lines = fp.read().splitlines()
+    except FileNotFoundError:
+        return dirs
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line or line.startswith('hwcap '):
+            continue
+        if line.startswith('include '):
+            pattern = os.path.join(os.path.dirname(path), line.split(None, 1)[1])
+            for included in sorted(glob.glob(pattern)):
+                dirs.extend(read_ld_conf(included))
+        else:
+            dirs.append(line)
+    return dirs
+
+class LibraryResolver:
+    '''
+    Finds libraries like dynamic loader does: in RPATH of object which
+    needs them (unless it has RUNPATH), RUNPATH, then `dirs` (directories
+    of ld.so.conf and DEFAULT_LIBRARY_DIRS by default). `$ORIGIN` is
+    directory of that object. Libraries of other class or machine are
+    skipped.
+    '''
+    def __init__(self, dirs = None):
+        if dirs is None:
+            dirs = read_ld_conf() + list(DEFAULT_LIBRARY_DIRS)
+        self.dirs = dirs
+
+    def find(self, name, needed_by):
+        '''
+        Returns `Elf` of library `name` needed by `needed_by` (`Elf`)
+        '''
+        if '/' in name:
+            dirs = ['']
+        else:
+            origin = os.path.dirname(needed_by.path)
+            dirs = [] if needed_by.runpath else list(needed_by.rpath)
+            dirs += needed_by.runpath
+            dirs = [
+                directory.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+                for directory in dirs
+            ] + self.dirs
+        for directory in dirs:
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            library = read_elf(path)
+            if library and (library.elf_class, library.machine) == (needed_by.elf_class, needed_by.machine):
+                return library
+        raise FileNotFoundError(errno.ENOENT, 'Library {} needed by {} not found'.format(name, needed_by.path))
+
+def jail_path(path):
+    '''
+    Returns where in image has to be file which is in `path` in jail,
+    which sees image as `/usr`, and `/lib` and `/lib64` as `/usr/lib`.
+    Returns None if jail can't see it.
+    '''
+    parts = os.path.normpath(path).lstrip('/').split('/')
+    if parts[0] == 'usr':
+        parts = parts[1:]
+    elif parts[0] in ('lib', 'lib64'):
+        parts[0] = 'lib'
+    else:
+        return None
+    return '/'.join(parts)
+
+def _is_shared(name):
+    return name.endswith('.so') or '.so.' in name
+
+class ImageBuilder:
+    '''
+    Builds minimal image of Python distribution of interpreter `python`
+    (this one by default), see module documentation.
+
+    `modules` is allowlist of modules and packages (importable by that
+    Python) copied besides standard library, with their libraries;
+    `exclude` are fnmatch patterns of names left out of standard library.
+    `libraries` are names of libraries added, besides those needed by
+    ELF files. `main` is path of main script.
+    '''
+    def __init__(self, python = None, modules = (), exclude = EXCLUDE, libraries = (), main = None, resolver = None):
+        self.python = python or sys.executable
+        self.modules = modules
+        self.exclude = exclude
+        self.libraries = libraries
+        self.main = main
+        self.resolver = resolver or LibraryResolver()
+        # Path in image -> path of file on host
+        self.files = {}
+
+    def excluded(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.exclude)
+
+    def query(self):
+        '''
+        Returns dict of paths of Python, see QUERY
+        '''
+        output = subprocess.run(
+            (self.python, '-c', QUERY) + tuple(self.modules),
+            stdout = subprocess.PIPE,
+            check = True,
+        ).stdout
+        return json.loads(output.decode())
+
+    def add_tree(self, source, target, exclude = True):
+        '''
+        Adds files of `source` directory in `target` of image
+        '''
+        for directory, dirs, files in os.walk(source):
+            if exclude:
+                dirs[:] = [name for name in dirs if not self.excluded(name)]
+            relative = os.path.relpath(directory, source)
+            for name in files:
+                if exclude and self.excluded(name):
+                    continue
+                if os.path.basename(directory) == '__pycache__':
+                    # Bytecode of excluded or missing module, or optimized
+                    module = name.split('.')[0] + '.py'
+                    if '.opt-' in name or (exclude and self.excluded(module)) or not os.path.exists(os.path.join(directory, '..', module)):
+                        continue
+                path = os.path.join(directory, name)
+                if os.path.exists(path):
+                    self.files[os.path.normpath(os.path.join(target, relative, name))] = path
+
+    def add_library(self, library):
+        directory = jail_path(os.path.dirname(library.path))
+        if directory is None:
+            # Found where jail can't see it, like RUNPATH of Python
+            # installed in its own prefix, which becomes /usr
+            directory = 'lib'
+        self.files[os.path.join(directory, os.path.basename(library.path))] = os.path.realpath(library.path)
+
+    def add_libraries(self, python):
+        '''
+        Adds dynamic loader and libraries needed by added ELF files,
+        `python` is `Elf` of interpreter
+        '''
+        queue = [python]
+        for target, path in list(self.files.items()):
+            if _is_shared(target):
+                elf = read_elf(path)
+                if elf:
+                    queue.append(elf)
+        for name in self.libraries:
+            queue.append(self.resolver.find(name, python))
+            self.add_library(queue[-1])
+
+        found = set()
+        while queue:
+            elf = queue.pop()
+            if elf.interp:
+                target = jail_path(elf.interp)
+                if target is None:
+                    raise ValueError('Dynamic loader {} of {} is out of /usr, /lib and /lib64'.format(elf.interp, elf.path))
+                self.files[target] = os.path.realpath(elf.interp)
+            for name in elf.needed:
+                if name in found:
+                    continue
+                found.add(name)
+                library = self.resolver.find(name, elf)
+                self.add_library(library)
+                queue.append(library)
+        return sorted(found | set(self.libraries))
+
+    def collect(self):
+        '''
+        Fills `files`, returns dict describing image
+        '''
+        info = self.query()
+        prefix = info['prefix']
+
+        def target_of(path):
+            relative = os.path.relpath(path, prefix)
+            if relative.startswith('..'):
+                return None
+            return relative
+
+        stdlib = target_of(info['stdlib'])
+        if stdlib is None:
+            raise ValueError('Standard library {} is out of prefix {}'.format(info['stdlib'], prefix))
+
+        self.files = {}
+        self.files['bin/python'] = info['executable']
+        self.add_tree(info['stdlib'], stdlib)
+        for entry in info['path']:
+            # Extension modules can be out of stdlib
+            if os.path.basename(entry) == 'lib-dynload' and target_of(entry):
+                self.add_tree(entry, target_of(entry))
+
+        for name, locations in sorted(info['modules'].items()):
+            if locations is None:
+                raise ImportError('Module {} not found'.format(name), name = name)
+            for location in locations:
+                # Out of prefix (like user site), it goes next to stdlib
+                target = target_of(location) or os.path.join(stdlib, os.path.basename(location))
+                if os.path.isdir(location):
+                    self.add_tree(location, target, exclude = False)
+                else:
+                    self.files[target] = location
+
+        if self.main:
+            self.files['bin/main.py'] = self.main
+
+        libraries = self.add_libraries(read_elf(info['executable']))
+        return dict(
+            python = info['version'],
+            libraries = libraries,
+        )
+
+    def write(self, path):
+        '''
+        Copies collected files in directory `path`, returns their size
+        '''
+        size = 0
+        for target, source in sorted(self.files.items()):
+            destination = os.path.join(path, target)
+            os.makedirs(os.path.dirname(destination), 0o755, exist_ok = True)
+            shutil.copy2(source, destination)
+            size += os.path.getsize(destination)
+        return size
+
+    def build(self, path, fs_type = None, compile_bytecode = False):
+        '''
+        Builds image in `path`: directory (which is created if it's missing),
+        or file of `fs_type` (`squashfs` or `erofs`).
+
+        With `compile_bytecode`, Python in image compiles it before it's
+        packed, see `sandboxed.bytecode` (as root only).
+
+        Returns dict describing image.
+        '''
+        if fs_type is not None and fs_type not in MKFS:
+            raise ValueError('Unknown filesystem type {}'.format(fs_type))
+        report = self.collect()
+        tree = path if fs_type is None else tempfile.mkdtemp()
+        try:
+            os.makedirs(tree, 0o755, exist_ok = True)
+            report.update(files = len(self.files), bytes = self.write(tree))
+            if compile_bytecode:
+                from .bytecode import prepare_image
+                prepare_image(tree, runs = 0)
+            if fs_type is not None:
+                subprocess.run(
+                    [arg.format(tree = tree, image = path) for arg in MKFS[fs_type]],
+                    stdout = subprocess.DEVNULL,
+                    check = True,
+                )
+                report.update(image_bytes = os.path.getsize(path))
+        finally:
+            if fs_type is not None:
+                shutil.rmtree(tree)
+        report.update(path = path, fs_type = fs_type)
+        return report
+
+def image_fs_type(path):
+    '''
+    Returns filesystem type of image file, `squashfs` or `erofs`
+    '''
+    with open(path, 'rb') as fp:
+        head = fp.read(EROFS_MAGIC_OFFSET + len(EROFS_MAGIC))
+    if head.startswith(SQUASHFS_MAGIC):
+        return 'squashfs'
+    if head[EROFS_MAGIC_OFFSET:] == EROFS_MAGIC:
+        return 'erofs'
+    raise ValueError('Unknown image format of {}'.format(path))
+
+def _configure_loop(fd, file_fd, flags, path):
+    info = LOOP_INFO.pack(0, 0, 0, 0, 0, 0, 0, 0, flags, os.fsencode(path)[:63], b'', b'', b'')
+    try:
+        fcntl.ioctl(fd, const.LOOP_CONFIGURE, LOOP_CONFIG.pack(file_fd, 0, info, b''))
+    except OSError as exc:
+        if exc.errno not in (errno.EINVAL, errno.ENOTTY):
+            raise
+        # Before Linux 5.8, device is set up in two steps
+        fcntl.ioctl(fd, const.LOOP_SET_FD, file_fd)
+        try:
+            fcntl.ioctl(fd, const.LOOP_SET_STATUS64, info)
+        except:
+            fcntl.ioctl(fd, const.LOOP_CLR_FD, 0)
+            raise
+
+def attach_loop(path, flags = const.LO_FLAGS_READ_ONLY | const.LO_FLAGS_AUTOCLEAR):
+    '''
+    Returns descriptor and path of free loop device set up to read file
+    in `path`. With LO_FLAGS_AUTOCLEAR, device is freed once it's closed
+    and unmounted.
+    '''
+    file_fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        control = os.open('/dev/loop-control', os.O_RDWR | os.O_CLOEXEC)
+        try:
+            while True:
+                device = '/dev/loop{}'.format(fcntl.ioctl(control, const.LOOP_CTL_GET_FREE))
+                fd = os.open(device, os.O_RDONLY | os.O_CLOEXEC)
+                try:
+                    _configure_loop(fd, file_fd, flags, path)
+                except OSError as exc:
+                    os.close(fd)
+                    if exc.errno == errno.EBUSY:
+                        # Someone else took it meanwhile
+                        continue
+                    raise
+                except:
+                    os.close(fd)
+                    raise
+                return fd, device
+        finally:
+            os.close(control)
+    finally:
+        os.close(file_fd)
+
+def mount_image(image, target, flags = IMAGE_FLAGS):
+    '''
+    Mounts image made by `ImageBuilder` in `target`, read-only. Directory
+    is bind mounted. Filesystem image is mounted right from file if its
+    filesystem can do it (erofs since Linux 6.12), otherwise from loop
+    device, which is freed once image is unmounted.
+    '''
+    flags |= const.MS_RDONLY
+    if os.path.isdir(image):
+        mount_bind_tree(image, target, flags, recursive = False)
+        return
+    fs_type = image_fs_type(image)
+    try:
+        lowlevel.mount(image, target, fs_type, flags)
+        return
+    except OSError as exc:
+        if exc.errno != errno.ENOTBLK:
+            raise
+    fd, device = attach_loop(image)
+    try:
+        lowlevel.mount(device, target, fs_type, flags)
+    finally:
+        os.close(fd)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Builds minimal image of Python distribution for jails')
+    parser.add_argument('output', help = 'directory, or image file with --fs-type')
+    parser.add_argument('--python', help = 'interpreter, this one by default')
+    parser.add_argument('--modules', default = '', help = 'comma separated modules and packages added to standard library')
+    parser.add_argument('--libraries', default = '', help = 'comma separated libraries added to needed ones')
+    parser.add_argument('--main', help = 'main script')
+    parser.add_argument('--fs-type', choices = sorted(MKFS))
+    parser.add_argument('--compile', action = 'store_true', help = 'compile bytecode, see sandboxed.bytecode')
+    args = parser.parse_args()
+
+    builder = ImageBuilder(
+        python = args.python,
+        modules = [name for name in args.modules.split(',') if name],
+        libraries = [name for name in args.libraries.split(',') if name],
+        main = args.main,
+    )
+    report = builder.build(args.output, args.fs_type, args.compile)
+    print(json.dumps(report, indent = 2, sort_keys = True))
+
+if __name__ == '__main__':
+    main()
@@ -6,33 +6,176 @@ Description of those calls is available in `man`.
 '''
 
 import ctypes as ct
+import os
 
 from . import const
-from .ccall import ccall, syscall
+from .ccall import c_path, ccall, pysyscall, syscall
 
 __all__ = (
     'getpid',
     'getppid',
     'pivot_root',
+    'py_after_fork_child',
+    'py_after_fork_parent',
+    'py_before_fork',
+    'clock_getcpuclockid',
     'clone',
+    'clone3',
+    'clone_args',
+    'fsconfig',
+    'fsmount',
+    'fsopen',
+    'fspick',
     'mount',
+    'mount_attr',
+    'mount_setattr',
+    'move_mount',
+    'open_tree',
     'umount',
     'umount2',
     'sethostname',
+    'setns',
     'gethostname',
+    'memfd_create',
+    'pidfd_open',
+    'pidfd_send_signal',
+    'rusage',
+    'siginfo_t',
+    'signalfd',
+    'splice',
+    'unshare',
+    'waitid',
 )
 
 # C Calls
 getpid = syscall(const.SYS_getpid)
 getppid = syscall(const.SYS_getppid)
-_pivot_root = ccall('pivot_root', True, ct.c_int, ct.c_char_p, ct.c_char_p)
-_clone = syscall(const.SYS_clone, ct.c_int, ct.c_void_p)
+_pivot_root = ccall('pivot_root', True, ct.c_int, c_path, c_path)
+# Forking calls keep the GIL, see `pysyscall`
+_clone = pysyscall(const.SYS_clone, ct.c_int, ct.c_void_p)
 #_clone = ccall('clone', True, ct.c_int, ct.c_void_p, ct.c_void_p, ct.c_int, ct.c_void_p)
-_mount = ccall('mount', True, ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_char_p, ct.c_ulong, ct.c_void_p)
-_umount = ccall('umount', True, ct.c_int, ct.c_char_p)
-_umount2 = ccall('umount2', True, ct.c_int, ct.c_char_p, ct.c_int)
-_sethostname = ccall('sethostname', True, ct.c_int, ct.c_char_p, ct.c_int)
+_mount = ccall('mount', True, ct.c_int, c_path, c_path, c_path, ct.c_ulong, c_path)
+_umount = ccall('umount', True, ct.c_int, c_path)
+_umount2 = ccall('umount2', True, ct.c_int, c_path, ct.c_int)
+_sethostname = ccall('sethostname', True, ct.c_int, c_path, ct.c_int)
 _gethostname = ccall('gethostname', True, ct.c_int, ct.c_char_p, ct.c_int)
+_splice = ccall('splice', True, ct.c_ssize_t, ct.c_int, ct.c_void_p, ct.c_int, ct.c_void_p, ct.c_size_t, ct.c_uint)
+unshare = ccall('unshare', True, ct.c_int, ct.c_int)
+setns = ccall('setns', True, ct.c_int, ct.c_int, ct.c_int)
+_clock_getcpuclockid = ccall('clock_getcpuclockid', False, ct.c_int, ct.c_int, ct.POINTER(ct.c_int))
+memfd_create = ccall('memfd_create', True, ct.c_int, c_path, ct.c_uint)
+
+# sigset_t of glibc, 1024 bits
+class sigset_t(ct.Structure):
+    _fields_ = [('val', ct.c_ulong * (1024 // (8 * ct.sizeof(ct.c_ulong))))]
+
+_signalfd = ccall('signalfd', True, ct.c_int, ct.c_int, ct.POINTER(sigset_t), ct.c_int)
+
+class timeval(ct.Structure):
+    _fields_ = [
+        ('tv_sec', ct.c_long),
+        ('tv_usec', ct.c_long),
+    ]
+
+class rusage(ct.Structure):
+    _fields_ = [
+        ('ru_utime', timeval),
+        ('ru_stime', timeval),
+        ('ru_maxrss', ct.c_long),
+        ('ru_ixrss', ct.c_long),
+        ('ru_idrss', ct.c_long),
+        ('ru_isrss', ct.c_long),
+        ('ru_minflt', ct.c_long),
+        ('ru_majflt', ct.c_long),
+        ('ru_nswap', ct.c_long),
+        ('ru_inblock', ct.c_long),
+        ('ru_oublock', ct.c_long),
+        ('ru_msgsnd', ct.c_long),
+        ('ru_msgrcv', ct.c_long),
+        ('ru_nsignals', ct.c_long),
+        ('ru_nvcsw', ct.c_long),
+        ('ru_nivcsw', ct.c_long),
+    ]
+
+class _sigchld_t(ct.Structure):
+    _fields_ = [
+        ('si_pid', ct.c_int),
+        ('si_uid', ct.c_uint),
+        ('si_status', ct.c_int),
+        ('si_utime', ct.c_long),
+        ('si_stime', ct.c_long),
+    ]
+
+# siginfo_t is always 128 bytes, fields after preamble are aligned to long
+_SI_PREAMBLE_SIZE = 16 if ct.sizeof(ct.c_long) == 8 else 12
+
+class _sifields_t(ct.Union):
+    _fields_ = [
+        ('_sigchld', _sigchld_t),
+        ('_pad', ct.c_int * ((128 - _SI_PREAMBLE_SIZE) // ct.sizeof(ct.c_int))),
+    ]
+
+class siginfo_t(ct.Structure):
+    _anonymous_ = ('_sifields',)
+    _fields_ = [
+        ('si_signo', ct.c_int),
+        ('si_errno', ct.c_int),
+        ('si_code', ct.c_int),
+        ('_sifields', _sifields_t),
+    ]
+
+    @property
+    def si_pid(self):
+        return self._sigchld.si_pid
+
+    @property
+    def si_status(self):
+        return self._sigchld.si_status
+
+class mount_attr(ct.Structure):
+    _fields_ = [
+        ('attr_set', ct.c_uint64),
+        ('attr_clr', ct.c_uint64),
+        ('propagation', ct.c_uint64),
+        ('userns_fd', ct.c_uint64),
+    ]
+
+class clone_args(ct.Structure):
+    _fields_ = [
+        ('flags', ct.c_uint64),
+        ('pidfd', ct.c_uint64),
+        ('child_tid', ct.c_uint64),
+        ('parent_tid', ct.c_uint64),
+        ('exit_signal', ct.c_uint64),
+        ('stack', ct.c_uint64),
+        ('stack_size', ct.c_uint64),
+        ('tls', ct.c_uint64),
+        ('set_tid', ct.c_uint64),
+        ('set_tid_size', ct.c_uint64),
+        ('cgroup', ct.c_uint64),
+    ]
+
+_open_tree = syscall(const.SYS_open_tree, ct.c_int, c_path, ct.c_uint)
+_move_mount = syscall(const.SYS_move_mount, ct.c_int, c_path, ct.c_int, c_path, ct.c_uint)
+_mount_setattr = syscall(const.SYS_mount_setattr, ct.c_int, c_path, ct.c_uint, ct.POINTER(mount_attr), ct.c_size_t)
+_fsopen = syscall(const.SYS_fsopen, c_path, ct.c_uint)
+_fspick = syscall(const.SYS_fspick, ct.c_int, c_path, ct.c_uint)
+_fsconfig = syscall(const.SYS_fsconfig, ct.c_int, ct.c_uint, c_path, c_path, ct.c_int)
+_fsmount = syscall(const.SYS_fsmount, ct.c_int, ct.c_uint, ct.c_uint)
+# What os.fork does around fork, so interpreter (locks, threads,
+# os.register_at_fork hooks) is in order after raw clone too
+py_before_fork = ct.pythonapi.PyOS_BeforeFork
+py_before_fork.restype = None
+py_after_fork_parent = ct.pythonapi.PyOS_AfterFork_Parent
+py_after_fork_parent.restype = None
+py_after_fork_child = ct.pythonapi.PyOS_AfterFork_Child
+py_after_fork_child.restype = None
+
+_clone3 = pysyscall(const.SYS_clone3, ct.POINTER(clone_args), ct.c_size_t)
+_pidfd_open = syscall(const.SYS_pidfd_open, ct.c_int, ct.c_uint)
+_pidfd_send_signal = syscall(const.SYS_pidfd_send_signal, ct.c_int, ct.c_int, ct.c_void_p, ct.c_uint)
+# Raw syscall, unlike libc function it can return rusage
+_waitid = syscall(const.SYS_waitid, ct.c_int, ct.c_int, ct.POINTER(siginfo_t), ct.c_int, ct.POINTER(rusage))
 
 #_CLONE_CALLBACK = ct.CFUNCTYPE(ct.c_int, ct.c_void_p)
 #_CLONE_STACK_SIZE = 65535
@@ -42,6 +185,26 @@ _gethostname = ccall('gethostname', True, ct.c_int, ct.c_char_p, ct.c_int)
 def clone(flags):
     return _clone(flags, None)
 
+def clone3(flags, exit_signal = 0, cgroup_fd = None):
+    '''
+    Like `clone`, child gets copy of our stack, so it works as fork.
+    Returns 2tuple: pid (0 in child) and, with CLONE_PIDFD, pidfd of child
+    (None in child or without the flag).
+    With `cgroup_fd` (cgroup directory descriptor) child starts in that
+    cgroup (CLONE_INTO_CGROUP, Linux 5.7).
+    '''
+    args = clone_args(flags = flags, exit_signal = exit_signal)
+    pidfd = ct.c_int(-1)
+    if flags & const.CLONE_PIDFD:
+        args.pidfd = ct.addressof(pidfd)
+    if cgroup_fd is not None:
+        args.flags |= const.CLONE_INTO_CGROUP
+        args.cgroup = cgroup_fd
+    pid = _clone3(ct.byref(args), ct.sizeof(args))
+    if pid and flags & const.CLONE_PIDFD:
+        return pid, pidfd.value
+    return pid, None
+
 #def clone(callback, flags):
 #    callback = lambda x: callback() or 0
 #    callback_p = _CLONE_CALLBACK(callback)
@@ -51,7 +214,8 @@ def clone(flags):
 #    os.waitpid(pid, 0)
 
 def sethostname(hostname):
-    _sethostname(hostname.encode(), len(hostname))
+    hostname = os.fsencode(hostname)
+    _sethostname(hostname, len(hostname))
 
 def gethostname():
     buf = ct.create_string_buffer(256)
@@ -59,31 +223,99 @@ def gethostname():
     return buf.value.decode()
 
 def mount(source, target, fs_type, flags = 0, data = None):
-    if isinstance(source, str):
-        source = source.encode()
-    if isinstance(target, str):
-        target = target.encode()
-    if isinstance(fs_type, str):
-        fs_type = fs_type.encode()
-    if isinstance(data, str):
-        data = data.encode()
-    data = data or None
-    return _mount(source, target, fs_type, flags, data)
-
-def umount(target):
-    if isinstance(target, str):
-        target = target.encode()
-    return _umount(target)
-
-def umount2(target, flags):
-    if isinstance(target, str):
-        target = target.encode()
-    return _umount2(target, flags)
-
-def pivot_root(new_root, put_old):
-    if isinstance(new_root, str):
-        new_root = new_root.encode()
-    if isinstance(put_old, str):
-        put_old = put_old.encode()
-    return _pivot_root(new_root, put_old)
+    '''
+    Paths and `data` can be bytes, str or path-like objects
+    '''
+    return _mount(source, target, fs_type, flags, data or None)
+
+umount = _umount
+umount2 = _umount2
+pivot_root = _pivot_root
+
+def splice(fd_in, off_in, fd_out, off_out, length, flags = 0):
+    '''
+    Offsets are None (use and update file position) or ints.
+    Returns number of bytes moved, 0 means EOF.
+    '''
+    if off_in is not None:
+        off_in = ct.byref(ct.c_longlong(off_in))
+    if off_out is not None:
+        off_out = ct.byref(ct.c_longlong(off_out))
+    return _splice(fd_in, off_in, fd_out, off_out, length, flags)
+
+def signalfd(signals, fd = -1, flags = 0):
+    '''
+    Creates (or updates, if `fd` is given) descriptor receiving `signals`.
+    They have to be blocked, see `signal.pthread_sigmask`.
+    '''
+    mask = sigset_t()
+    bits = 8 * ct.sizeof(ct.c_ulong)
+    for signum in signals:
+        mask.val[(signum - 1) // bits] |= 1 << ((signum - 1) % bits)
+    return _signalfd(fd, ct.byref(mask), flags)
+
+def clock_getcpuclockid(pid):
+    '''
+    Returns id of clock measuring CPU time of process `pid`, for
+    `time.clock_gettime`
+    '''
+    clock = ct.c_int()
+    result = _clock_getcpuclockid(pid, ct.byref(clock))
+    if result:
+        # Error number is returned, errno is not set
+        raise OSError(result, os.strerror(result))
+    return clock.value
+
+def pidfd_open(pid, flags = 0):
+    return _pidfd_open(pid, flags)
+
+def pidfd_send_signal(pidfd, sig, flags = 0):
+    return _pidfd_send_signal(pidfd, sig, None, flags)
+
+def waitid(idtype, id_, options):
+    '''
+    Returns 2tuple of `siginfo_t` and `rusage` structures.
+    With WNOHANG, `si_pid` is 0 if no child has changed state.
+    '''
+    info = siginfo_t()
+    usage = rusage()
+    _waitid(idtype, id_, ct.byref(info), options, ct.byref(usage))
+    return info, usage
+
+def open_tree(dfd, path, flags = 0):
+    '''
+    Returns descriptor of mount in `path`, with OPEN_TREE_CLONE of its
+    detached copy (with AT_RECURSIVE, of whole subtree)
+    '''
+    return _open_tree(dfd, path, flags)
+
+def move_mount(from_dfd, from_path, to_dfd, to_path, flags = 0):
+    return _move_mount(from_dfd, from_path, to_dfd, to_path, flags)
+
+def mount_setattr(dfd, path, flags, attr_set = 0, attr_clr = 0, propagation = 0, userns_fd = 0):
+    '''
+    Changes mount attributes (MOUNT_ATTR_*); with AT_RECURSIVE, of whole
+    subtree at once
+    '''
+    attr = mount_attr(attr_set, attr_clr, propagation, userns_fd)
+    return _mount_setattr(dfd, path, flags, ct.byref(attr), ct.sizeof(attr))
+
+def fsopen(fs_name, flags = 0):
+    '''
+    Returns filesystem context descriptor, to be configured with
+    `fsconfig` and mounted with `fsmount`
+    '''
+    return _fsopen(fs_name, flags)
+
+def fspick(dfd, path, flags = 0):
+    return _fspick(dfd, path, flags)
+
+def fsconfig(fd, cmd, key = None, value = None, aux = 0):
+    return _fsconfig(fd, cmd, key, value, aux)
 
+def fsmount(fs_fd, flags = 0, attr_flags = 0):
+    '''
+    Returns descriptor of new detached mount, which can be attached
+    with `move_mount`
+    '''
+    return _fsmount(fs_fd, flags, attr_flags)
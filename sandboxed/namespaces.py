@@ -0,0 +1,238 @@
+#coding:utf8
+
+'''
+Pool of prepared namespaces.
+
+Creating namespaces, and network namespace especially, takes a while, and
+kernel does it one at a time. `NamespacePool` makes UTS, IPC and network
+namespaces ahead of time (in background thread, if started) and keeps them
+alive by bind mounting their `/proc/thread-self/ns/*` files. Jail cloned
+with only the remaining flags (new PID and mount namespaces are always
+fresh) enters them with `setns`, see `Namespaces.enter`.
+
+Each set is given out once: jail can leave anything behind in them (IPC
+objects, network configuration, hostname), so they are thrown away
+together with the jail.
+
+Process running the refill thread can still clone jails, with
+`sandboxed.utils.clone_child` (it keeps the GIL, and runs fork hooks), or
+`os.fork`. Pool in child has no thread: its lock is reset, and refilling
+is left to parent.
+'''
+
+import collections
+import itertools
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import weakref
+
+from . import const
+from . import lowlevel
+from .utils import mount_bind
+
+__all__ = (
+    'NamespacePool',
+    'Namespaces',
+    'pin_namespaces',
+)
+
+# Namespaces which can be prepared, and their clone/setns flags
+KINDS = {
+    'ipc': const.CLONE_NEWIPC,
+    'net': const.CLONE_NEWNET,
+    'uts': const.CLONE_NEWUTS,
+}
+
+def _ns_flags(kinds):
+    flags = 0
+    for kind in kinds:
+        flags |= KINDS[kind]
+    return flags
+
+class Namespaces:
+    '''
+    Namespaces of `kinds` pinned in `path` directory, one file per kind.
+    '''
+    def __init__(self, path, kinds):
+        self.path = path
+        self.kinds = tuple(kinds)
+
+    @property
+    def flags(self):
+        '''
+        CLONE_NEW* flags not needed anymore when entering these
+        '''
+        return _ns_flags(self.kinds)
+
+    def enter(self):
+        '''
+        Moves calling thread (child we cloned, usually) to these namespaces
+        '''
+        for kind in self.kinds:
+            fd = os.open(os.path.join(self.path, kind), os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                lowlevel.setns(fd, KINDS[kind])
+            finally:
+                os.close(fd)
+
+    def discard(self):
+        '''
+        Unpins namespaces. They are gone once nothing is in them anymore.
+        '''
+        for kind in self.kinds:
+            target = os.path.join(self.path, kind)
+            lowlevel.umount2(target, const.MNT_DETACH)
+            os.remove(target)
+        os.rmdir(self.path)
+
+def pin_namespaces(path, kinds = ('ipc', 'net', 'uts'), hostname = None):
+    '''
+    Creates namespaces of `kinds`, with `hostname` set if new UTS namespace
+    is one of them, and pins them in new `path` directory.
+    Returns `Namespaces`.
+
+    Only calling thread enters them for a moment, so it's safe to do it in
+    a thread.
+    '''
+    os.mkdir(path, 0o700)
+    # Where we go back afterwards
+    own = [
+        (os.open('/proc/thread-self/ns/' + kind, os.O_RDONLY | os.O_CLOEXEC), kind)
+        for kind in kinds
+    ]
+    try:
+        lowlevel.unshare(_ns_flags(kinds))
+        try:
+            if hostname and 'uts' in kinds:
+                lowlevel.sethostname(hostname)
+            for kind in kinds:
+                target = os.path.join(path, kind)
+                # Bind mount needs existing file to mount on
+                os.close(os.open(target, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600))
+                mount_bind('/proc/thread-self/ns/' + kind, target)
+        finally:
+            for fd, kind in own:
+                lowlevel.setns(fd, KINDS[kind])
+    finally:
+        for fd, _ in own:
+            os.close(fd)
+    return Namespaces(path, kinds)
+
+class NamespacePool:
+    '''
+    Keeps `size` sets of namespaces of `kinds` ready for jails, pinned in
+    `path` (new temporary directory by default). `hostname` is set in new
+    UTS namespaces.
+
+    Pool is refilled by background thread after `start`; otherwise
+    call `fill` from time to time.
+    '''
+    def __init__(self, size = 4, kinds = ('ipc', 'net', 'uts'), path = None, hostname = None):
+        for kind in kinds:
+            if kind not in KINDS:
+                raise ValueError('Namespace "{}" can not be pooled'.format(kind))
+        self.size = size
+        self.kinds = tuple(kinds)
+        self.hostname = hostname
+        self.own_path = path is None
+        self.path = tempfile.mkdtemp() if path is None else path
+        self.ready = collections.deque()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.wanted = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+        # Pool mustn't be kept alive by the hook
+        ref = weakref.ref(self)
+        os.register_at_fork(after_in_child = lambda: ref() and ref()._forked())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def flags(self):
+        '''
+        CLONE_NEW* flags jails don't need if they enter pooled namespaces
+        '''
+        return _ns_flags(self.kinds)
+
+    def make(self):
+        '''
+        Returns new `Namespaces`, bypassing the pool
+        '''
+        path = os.path.join(self.path, str(next(self.counter)))
+        return pin_namespaces(path, self.kinds, self.hostname)
+
+    def fill(self):
+        '''
+        Makes namespaces until pool is full
+        '''
+        while len(self.ready) < self.size:
+            namespaces = self.make()
+            with self.lock:
+                self.ready.append(namespaces)
+
+    def take(self):
+        '''
+        Returns `Namespaces` for one jail, made right away if pool is
+        empty. Pass them to `Namespaces.discard` when jail quits.
+        '''
+        with self.lock:
+            if self.ready:
+                self.wanted.notify()
+                return self.ready.popleft()
+        return self.make()
+
+    def start(self):
+        '''
+        Starts thread which keeps pool full
+        '''
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target = self.refill, name = 'namespace-pool', daemon = True)
+        self.thread.start()
+
+    def refill(self):
+        try:
+            while True:
+                with self.lock:
+                    while self.running and len(self.ready) >= self.size:
+                        self.wanted.wait()
+                    if not self.running:
+                        return
+                namespaces = self.make()
+                with self.lock:
+                    self.ready.append(namespaces)
+        except:
+            # `take` still works, just without the head start
+            sys.excepthook(*sys.exc_info())
+
+    def _forked(self):
+        # Thread could hold the lock when we were forked
+        self.lock = threading.Lock()
+        self.wanted = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+    def close(self):
+        '''
+        Stops refilling and discards unused namespaces
+        '''
+        with self.lock:
+            self.running = False
+            self.wanted.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        while self.ready:
+            self.ready.popleft().discard()
+        if self.own_path:
+            os.rmdir(self.path)
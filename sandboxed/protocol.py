@@ -0,0 +1,145 @@
+#coding:utf8
+
+'''
+Framed protocol of remote executor.
+
+Client starts connection with `MAGIC` and server answers with `MAGIC`.
+Then both sides send frames: `HEADER` (frame type and payload length)
+followed by payload.
+
+For each execution client sends any number of STDIN frames and one EOF
+frame. They can be preceded by LIMITS frame: JSON object with `time_ms`
+(wall clock) and `cpu_ms` limits of this execution, in milliseconds.
+Server can only lower its own limits this way. Server answers with STDOUT and STDERR frames, and ends with STATUS
+frame: JSON object with exit status and resource usage, and `error`
+message if execution was cut short.
+
+Executions are run one by one, in order, so client doesn't have to wait
+for STATUS before sending next one.
+
+Server with admission control can answer new connection with MAGIC and
+STATUS with `error` and `rejected` reason right away, and close it.
+
+Connections which don't start with `MAGIC` use legacy protocol: input ends
+with nullchar, output (stdout and stderr mixed) ends with nullchar, and
+connection is closed after one execution.
+
+This module depends on standard library only.
+'''
+
+import json
+import struct
+
+__all__ = (
+    'EOF',
+    'FrameReader',
+    'HEADER',
+    'LIMITS',
+    'MAGIC',
+    'MAX_PAYLOAD',
+    'ProtocolError',
+    'STATUS',
+    'STDERR',
+    'STDIN',
+    'STDOUT',
+    'pack_frame',
+    'pack_limits',
+    'pack_status',
+    'unpack_limits',
+    'unpack_status',
+)
+
+# Contains no nullchar, so no complete legacy request is its prefix
+MAGIC = b'SBX\x01'
+
+HEADER = struct.Struct('!BI')
+
+# Client to server
+STDIN = 1
+EOF = 2
+LIMITS = 6
+# Server to client
+STDOUT = 3
+STDERR = 4
+STATUS = 5
+
+MAX_PAYLOAD = 1024 * 1024
+
+class ProtocolError(ValueError):
+    pass
+
+def pack_frame(kind, payload = b''):
+    return HEADER.pack(kind, len(payload)) + payload
+
+def pack_status(report):
+    return pack_frame(STATUS, json.dumps(report, sort_keys = True).encode())
+
+def unpack_status(payload):
+    return json.loads(payload.decode())
+
+def pack_limits(time_ms = None, cpu_ms = None):
+    limits = {}
+    if time_ms is not None:
+        limits['time_ms'] = time_ms
+    if cpu_ms is not None:
+        limits['cpu_ms'] = cpu_ms
+    return pack_frame(LIMITS, json.dumps(limits, sort_keys = True).encode())
+
+def unpack_limits(payload):
+    '''
+    Returns 2tuple of time and CPU limits in milliseconds, None if not
+    given
+    '''
+    try:
+        limits = json.loads(payload.decode())
+        time_ms = limits.get('time_ms')
+        cpu_ms = limits.get('cpu_ms')
+    except (ValueError, AttributeError):
+        raise ProtocolError('Malformed limits')
+    for value in (time_ms, cpu_ms):
+        if value is not None and (not isinstance(value, int) or value <= 0):
+            raise ProtocolError('Limits have to be positive integers')
+    return time_ms, cpu_ms
+
+class FrameReader:
+    '''
+    Splits received bytes into frames.
+    '''
+    def __init__(self, max_payload = MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+    def header(self):
+        '''
+        Returns type and length of next frame, or None if we don't have
+        its header yet.
+        '''
+        if len(self.buf) < HEADER.size:
+            return None
+        kind, length = HEADER.unpack_from(self.buf)
+        if length > self.max_payload:
+            raise ProtocolError('Frame of {} bytes is too long'.format(length))
+        return kind, length
+
+    def ready(self):
+        '''
+        Returns True if whole frame is buffered
+        '''
+        header = self.header()
+        return header is not None and len(self.buf) >= HEADER.size + header[1]
+
+    def next_frame(self):
+        '''
+        Returns 2tuple: type and payload of next frame, or None if it's
+        not complete yet.
+        '''
+        if not self.ready():
+            return None
+        kind, length = self.header()
+        end = HEADER.size + length
+        payload = bytes(self.buf[HEADER.size:end])
+        del self.buf[:end]
+        return kind, payload
@@ -0,0 +1,217 @@
+#coding:utf8
+
+'''
+Jail root filesystems built from shared template.
+
+`RootfsTemplate` is assembled once: small tmpfs with directories, symlinks
+and files, plus list of directories bind mounted (read-only by default)
+from host. After it's sealed (remounted read-only), `new_root` hands out
+`Root`s: overlayfs with template as lower layer and its own tmpfs as
+upper, with template's binds mounted in it. Root is writable, changes stay
+in its upper layer, and `discard` throws it away at once, no matter how
+much was written there.
+
+Bind mounts can't be part of the template tree itself, because overlayfs
+doesn't show mounts of its lower layer, so they are repeated in each root.
+'''
+
+import errno
+import os
+import os.path
+import shutil
+import tempfile
+
+from . import const
+from . import lowlevel
+from .utils import attach_mount, create_tmpfs, mount_bind_tree, mount_tmpfs
+
+__all__ = (
+    'Root',
+    'RootfsTemplate',
+    'remount_readonly',
+)
+
+BIND_FLAGS = const.MS_NODEV | const.MS_NOSUID | const.MS_NOATIME
+# Overlay of root, like tmpfs root of jail used to be
+ROOT_FLAGS = const.MS_NODEV | const.MS_NOEXEC | const.MS_NOSUID
+
+# statvfs flags of mount, and MS_* flags to keep them
+_MOUNT_FLAGS = (
+    (os.ST_NOSUID, const.MS_NOSUID),
+    (os.ST_NODEV, const.MS_NODEV),
+    (os.ST_NOEXEC, const.MS_NOEXEC),
+    (os.ST_NOATIME, const.MS_NOATIME),
+    (os.ST_NODIRATIME, const.MS_NODIRATIME),
+    (os.ST_RELATIME, const.MS_RELATIME),
+)
+
+def remount_readonly(path):
+    '''
+    Makes mount in `path` read-only, whatever filesystem it is. Its
+    other flags are kept: remount replaces all of them.
+    '''
+    flags = const.MS_REMOUNT | const.MS_BIND | const.MS_RDONLY
+    current = os.statvfs(path).f_flag
+    for st_flag, ms_flag in _MOUNT_FLAGS:
+        if current & st_flag:
+            flags |= ms_flag
+    lowlevel.mount(None, path, None, flags)
+
+class RootfsTemplate:
+    '''
+    Read-only base of jail roots, `size` is in kilobytes.
+
+    Paths given to methods are relative to template root.
+    '''
+    def __init__(self, size = 2000, path = None):
+        self.size = size
+        self.own_path = path is None
+        self.path = tempfile.mkdtemp() if path is None else path
+        try:
+            # Root directory of roots gets the same mode, see `Root`
+            mount_tmpfs(size, self.path, mode = 0o755)
+        except:
+            if self.own_path:
+                os.rmdir(self.path)
+            raise
+        # (source, target, flags, read only)
+        self.binds = []
+        self.sealed = False
+        # Where roots have template itself mounted, see `expose`
+        self.exposed = None
+
+    def join(self, name):
+        return os.path.join(self.path, name.lstrip('/'))
+
+    def mkdir(self, name, mode = 0o755):
+        os.makedirs(self.join(name), mode, exist_ok = True)
+
+    def symlink(self, target, name):
+        os.symlink(target, self.join(name))
+
+    def copy(self, source, name):
+        shutil.copyfile(source, self.join(name))
+
+    def bind(self, source, name, flags = BIND_FLAGS, readonly = True):
+        '''
+        Makes every root have `source` directory of host mounted in `name`
+        '''
+        self.mkdir(name)
+        self.binds.append((source, name.lstrip('/'), flags, readonly))
+
+    def expose(self, name = '.template'):
+        '''
+        Makes every root have template mounted in `name`, so more roots
+        can be made from inside of it, see `inside`.
+        '''
+        self.bind(self.path, name)
+        self.exposed = name.lstrip('/')
+
+    def inside(self):
+        '''
+        Returns template as seen from inside of root made from it (after
+        `pivot_root`), if it was exposed there.
+        '''
+        template = RootfsTemplate.__new__(RootfsTemplate)
+        template.size = self.size
+        template.own_path = False
+        template.path = '/' + self.exposed
+        template.binds = [
+            ('/' + name, name, flags, readonly)
+            for _, name, flags, readonly in self.binds
+            if name != self.exposed
+        ]
+        template.sealed = True
+        template.exposed = None
+        return template
+
+    def seal(self):
+        '''
+        Makes template read-only. Overlayfs doesn't allow changing lower
+        layer while it's in use, so it's done before first root is made.
+        '''
+        if not self.sealed:
+            mount_tmpfs(self.size, self.path, const.MS_REMOUNT | const.MS_RDONLY)
+            self.sealed = True
+
+    def new_root(self, size = 1000, path = None):
+        '''
+        Returns new `Root`, with `size` kilobytes for changes. It's made
+        in `path` (which has to be empty directory), or in new temporary
+        directory.
+        '''
+        self.seal()
+        return Root(self, size, path)
+
+    def close(self):
+        lowlevel.umount2(self.path, const.MNT_DETACH)
+        if self.own_path:
+            os.rmdir(self.path)
+
+class Root:
+    '''
+    Writable root made from `RootfsTemplate`, see `RootfsTemplate.new_root`.
+    `path` is where it's mounted.
+    '''
+    def __init__(self, template, size, path = None):
+        self.own_path = path is None
+        self.layer = tempfile.mkdtemp() if path is None else path
+        try:
+            self.mount(template, size)
+        except:
+            if self.own_path:
+                os.rmdir(self.layer)
+            raise
+
+    def mount(self, template, size):
+        # Layer is filled while it's detached, and attached ready to use
+        try:
+            fd = create_tmpfs(size)
+            detached = True
+        except OSError as exc:
+            if exc.errno != errno.ENOSYS:
+                raise
+            # Before Linux 5.2 it's filled where it's mounted
+            mount_tmpfs(size, self.layer)
+            detached = False
+        try:
+            if not detached:
+                fd = os.open(self.layer, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+            try:
+                for name in ('upper', 'work', 'root'):
+                    os.mkdir(name, dir_fd = fd)
+                # Root directory of overlay takes its mode from upper layer
+                os.chmod('upper', os.stat(template.path).st_mode & 0o7777, dir_fd = fd)
+                if detached:
+                    attach_mount(fd, self.layer)
+            finally:
+                os.close(fd)
+        except:
+            if not detached:
+                lowlevel.umount2(self.layer, const.MNT_DETACH)
+            raise
+        try:
+            upper = os.path.join(self.layer, 'upper')
+            work = os.path.join(self.layer, 'work')
+            self.path = os.path.join(self.layer, 'root')
+            lowlevel.mount('overlay', self.path, 'overlay', ROOT_FLAGS, 'lowerdir={},upperdir={},workdir={}'.format(
+                template.path, upper, work,
+            ))
+            for source, name, flags, readonly in template.binds:
+                if readonly:
+                    flags |= const.MS_RDONLY
+                mount_bind_tree(source, os.path.join(self.path, name), flags, recursive = False)
+        except:
+            lowlevel.umount2(self.layer, const.MNT_DETACH)
+            raise
+
+    def discard(self):
+        '''
+        Unmounts root with everything mounted in it, and its upper layer.
+        Lazy unmount doesn't have to wait for anything, and frees memory
+        once nothing uses root anymore.
+        '''
+        lowlevel.umount2(self.path, const.MNT_DETACH)
+        lowlevel.umount2(self.layer, const.MNT_DETACH)
+        if self.own_path:
+            os.rmdir(self.layer)
@@ -0,0 +1,248 @@
+#coding:utf8
+
+'''
+Tracing spans of jail lifecycle.
+
+Span is a named, timed step, stored as dict:
+
+    name        what was done, eg. `pivot_root` or `request`
+    ts          when it started, seconds since epoch
+    duration    in seconds (0 for events)
+    pid         process which did it
+    attrs       anything else worth knowing, eg. exit status
+
+`Tracer` keeps finished spans in a ring buffer: it has fixed capacity and
+oldest spans are dropped, so recording never blocks nor grows memory.
+`hooks` are called with each span in process which made it.
+
+Forked processes (workers) don't keep spans. After `forked` they send
+them to parent as datagrams, which parent reads with `receive` when its
+`fileno()` is readable. Send never blocks either; if parent lags behind,
+spans are dropped and counted in `dropped`.
+
+`export` writes spans as JSON lines.
+
+`NullTracer` records nothing; it's used when tracing is off, so traced
+code doesn't need to check.
+
+This module depends on standard library only.
+'''
+
+import collections
+import json
+import os
+import socket
+import time
+
+__all__ = (
+    'NullTracer',
+    'Tracer',
+)
+
+# Max size of one span sent by forked process
+MAX_DATAGRAM = 64 * 1024
+
+class Span:
+    '''
+    Context manager returned by `Tracer.span`. Span is recorded on exit,
+    with name of exception (as `error` attribute) if there was one.
+    '''
+    __slots__ = ('tracer', 'name', 'attrs', 'started')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.started = None
+
+    def set(self, **attrs):
+        '''
+        Adds attributes known only once span is running
+        '''
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.add(self.name, self.started, **self.attrs)
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class NullTracer:
+    '''
+    Tracer which records nothing
+    '''
+    enabled = False
+    dropped = 0
+
+    def span(self, name, **attrs):
+        return _NULL_SPAN
+
+    def add(self, name, started, finished = None, **attrs):
+        pass
+
+    def event(self, name, **attrs):
+        pass
+
+    def listen(self):
+        pass
+
+    def forked(self):
+        pass
+
+    def fileno(self):
+        return None
+
+    def receive(self):
+        return 0
+
+    def drain(self):
+        return []
+
+    def extend(self, spans):
+        pass
+
+    def export(self, fd):
+        return 0
+
+class Tracer:
+    '''
+    Records spans in ring buffer of `capacity` spans, see module
+    documentation. `hooks` are callables taking span dict.
+    '''
+    enabled = True
+
+    def __init__(self, capacity = 4096, hooks = ()):
+        self.spans = collections.deque(maxlen = capacity)
+        self.hooks = list(hooks)
+        # Spans sent by forked processes are received here...
+        self.source = None
+        # ...and they send them through this, after `forked`
+        self.sink_end = None
+        self.sink = None
+        self.dropped = 0
+        # Monotonic time is used for durations, it's converted to wall
+        # time only for `ts`
+        self.offset = time.time() - time.monotonic()
+
+    def span(self, name, **attrs):
+        '''
+        Returns context manager recording span around its block
+        '''
+        return Span(self, name, attrs)
+
+    def add(self, name, started, finished = None, **attrs):
+        '''
+        Records span which already happened, `started` and `finished`
+        (now by default) are `time.monotonic()` values.
+        '''
+        if finished is None:
+            finished = time.monotonic()
+        span = dict(
+            name = name,
+            ts = round(started + self.offset, 6),
+            duration = round(finished - started, 6),
+            pid = os.getpid(),
+            attrs = attrs,
+        )
+        for hook in self.hooks:
+            hook(span)
+        if self.sink is None:
+            self.spans.append(span)
+            return
+        try:
+            self.sink.send(json.dumps(span).encode())
+        except OSError:
+            # Parent is full or gone, we won't wait for it
+            self.dropped += 1
+
+    def event(self, name, **attrs):
+        '''
+        Records moment, span with no duration
+        '''
+        now = time.monotonic()
+        self.add(name, now, now, **attrs)
+
+    def listen(self):
+        '''
+        Prepares for receiving spans from processes forked later
+        '''
+        if self.source is None:
+            self.source, self.sink_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.source.setblocking(False)
+            self.sink_end.setblocking(False)
+
+    def forked(self):
+        '''
+        Called in forked process: from now on spans go to parent
+        '''
+        self.spans.clear()
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+            self.sink = self.sink_end
+
+    def fileno(self):
+        '''
+        Descriptor readable when forked processes sent spans
+        '''
+        return self.source.fileno() if self.source is not None else None
+
+    def receive(self):
+        '''
+        Takes spans sent by forked processes, without blocking.
+        Returns how many were received.
+        '''
+        count = 0
+        while self.source is not None:
+            try:
+                data = self.source.recv(MAX_DATAGRAM)
+            except BlockingIOError:
+                break
+            try:
+                self.spans.append(json.loads(data.decode()))
+            except ValueError:
+                continue
+            count += 1
+        return count
+
+    def drain(self):
+        '''
+        Returns and forgets recorded spans, oldest first
+        '''
+        spans = list(self.spans)
+        self.spans.clear()
+        return spans
+
+    def extend(self, spans):
+        self.spans.extend(spans)
+
+    def export(self, fd):
+        '''
+        Writes recorded spans to descriptor `fd` as JSON lines, and
+        forgets them. Returns number of spans written.
+        '''
+        self.receive()
+        spans = self.drain()
+        if spans:
+            data = ''.join(json.dumps(span, sort_keys = True) + '\n' for span in spans).encode()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        return len(spans)
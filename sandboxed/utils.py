@@ -4,12 +4,18 @@
 Convenience utilities
 '''
 
+import array
 import distutils.sysconfig
 import errno
+import math
 import os
 import os.path
+import re
+import select
 import signal
+import socket
 import stat
+import struct
 import sys
 import time
 
@@ -17,8 +23,18 @@ from . import lowlevel
 from . import const
 
 __all__ = (
+    'ChildWatcher',
+    'Mount',
+    'MountTable',
+    'attach_mount',
     'clone_and_wait',
+    'clone_child',
+    'clone_tree',
+    'create_tmpfs',
+    'detach',
+    'mount_attrs',
     'mount_bind',
+    'mount_bind_tree',
     'mount_cgroup',
     'mount_proc',
     'mount_python_lib',
@@ -26,6 +42,10 @@ __all__ = (
     'mount_tmpfs',
     'patient_terminate',
     'read_mounts',
+    'read_mountinfo',
+    'read_signals',
+    'recv_fds',
+    'send_fds',
     'try_kill',
     'try_mkdir',
     'umount_all',
@@ -43,14 +63,18 @@ def try_mkdir(path):
         if exc.errno != errno.EEXIST:
             raise
 
-def mount_tmpfs(size, path, flags = 0):
+def mount_tmpfs(size, path, flags = 0, mode = None):
     '''
     Mount tmpfs filesystem with size of `size` kilobytes in given path.
     NODEV, NOEXEC, NOSUID and NOATIME flags are added by default.
+    `mode` is permissions of its root directory (1777 by default).
     '''
     size = int(size)
     flags |= const.MS_NODEV | const.MS_NOEXEC | const.MS_NOSUID | const.MS_NOATIME
-    lowlevel.mount('tmpfs', path, 'tmpfs', flags, 'size={}K'.format(size))
+    data = 'size={}K'.format(size)
+    if mode is not None:
+        data += ',mode={:o}'.format(mode)
+    lowlevel.mount('tmpfs', path, 'tmpfs', flags, data)
 
 def mount_bind(source, destination, flags = 0):
     '''
@@ -59,6 +83,104 @@ def mount_bind(source, destination, flags = 0):
     flags |= const.MS_BIND
     lowlevel.mount(source, destination, 'none', flags, None)
 
+# MS_* flags which have MOUNT_ATTR_* counterpart
+_MOUNT_ATTRS = (
+    (const.MS_RDONLY, const.MOUNT_ATTR_RDONLY),
+    (const.MS_NOSUID, const.MOUNT_ATTR_NOSUID),
+    (const.MS_NODEV, const.MOUNT_ATTR_NODEV),
+    (const.MS_NOEXEC, const.MOUNT_ATTR_NOEXEC),
+    (const.MS_NOATIME, const.MOUNT_ATTR_NOATIME),
+)
+
+def mount_attrs(flags):
+    '''
+    Translates MS_* flags to MOUNT_ATTR_* ones
+    '''
+    attrs = 0
+    for ms_flag, attr in _MOUNT_ATTRS:
+        if flags & ms_flag:
+            attrs |= attr
+    return attrs
+
+def clone_tree(source, recursive = True, attr_set = 0, attr_clr = 0):
+    '''
+    Returns descriptor of detached copy of mount in `source` (with
+    `recursive`, of whole subtree), with attributes already changed, so it
+    can be attached with `attach_mount` at once.
+
+    Raises OSError with ENOSYS before Linux 5.12.
+    '''
+    flags = const.OPEN_TREE_CLONE | const.OPEN_TREE_CLOEXEC
+    if recursive:
+        flags |= const.AT_RECURSIVE
+    fd = lowlevel.open_tree(const.AT_FDCWD, source, flags)
+    try:
+        if attr_set or attr_clr:
+            if attr_set & const.MOUNT_ATTR__ATIME:
+                # Access time modes are not flags, old one has to be cleared
+                attr_clr |= const.MOUNT_ATTR__ATIME
+            flags = const.AT_EMPTY_PATH
+            if recursive:
+                flags |= const.AT_RECURSIVE
+            lowlevel.mount_setattr(fd, '', flags, attr_set, attr_clr)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def attach_mount(fd, target):
+    '''
+    Attaches detached mount (see `clone_tree` and `create_tmpfs`) in `target`
+    '''
+    lowlevel.move_mount(fd, '', const.AT_FDCWD, target, const.MOVE_MOUNT_F_EMPTY_PATH)
+
+def mount_bind_tree(source, destination, flags = 0, recursive = True):
+    '''
+    Mountbinds `source` in `destination` with MS_RDONLY, MS_NOSUID,
+    MS_NODEV, MS_NOEXEC and MS_NOATIME from `flags` applied before it
+    becomes visible (with `recursive`, to all mounts under `source` too).
+
+    Before Linux 5.12 falls back to `mount_bind` and remount, which leaves
+    bind writable for a moment and changes only the top mount.
+    '''
+    try:
+        fd = clone_tree(source, recursive, mount_attrs(flags))
+    except OSError as exc:
+        if exc.errno != errno.ENOSYS:
+            raise
+        if recursive:
+            flags |= const.MS_REC
+        mount_bind(source, destination, flags & ~const.MS_RDONLY)
+        if flags & const.MS_RDONLY:
+            mount_bind(source, destination, flags | const.MS_REMOUNT)
+        return
+    try:
+        attach_mount(fd, destination)
+    finally:
+        os.close(fd)
+
+def create_tmpfs(size, flags = 0, mode = None):
+    '''
+    Returns descriptor of new detached tmpfs with size of `size` kilobytes.
+    It can be filled using `dir_fd` arguments, and attached with
+    `attach_mount` once it's ready.
+
+    Like in `mount_tmpfs`, NODEV, NOEXEC, NOSUID and NOATIME flags are
+    added to `flags` (MS_*). `mode` is permissions of its root directory.
+
+    Raises OSError with ENOSYS before Linux 5.2.
+    '''
+    flags |= const.MS_NODEV | const.MS_NOEXEC | const.MS_NOSUID | const.MS_NOATIME
+    fs_fd = lowlevel.fsopen('tmpfs', const.FSOPEN_CLOEXEC)
+    try:
+        lowlevel.fsconfig(fs_fd, const.FSCONFIG_SET_STRING, 'size', '{}K'.format(int(size)))
+        if mode is not None:
+            lowlevel.fsconfig(fs_fd, const.FSCONFIG_SET_STRING, 'mode', '{:o}'.format(mode))
+        lowlevel.fsconfig(fs_fd, const.FSCONFIG_CMD_CREATE)
+        return lowlevel.fsmount(fs_fd, const.FSMOUNT_CLOEXEC, mount_attrs(flags))
+    finally:
+        os.close(fs_fd)
+
 def mount_proc(path = '/proc'):
     '''
     Creates mountpoint and mounts proc fs in it
@@ -105,57 +227,207 @@ def mount_python_lib(path, no_exec = False):
     flags = const.MS_NODEV | const.MS_NOSUID | const.MS_NOATIME
     if no_exec:
         flags |= const.MS_NOEXEC
-    mount_bind(pylib, pylib_mount, flags)
-    # Binds can be made read-only only after remount, not on first mount...
-    flags |= const.MS_REMOUNT | const.MS_RDONLY
-    mount_bind(pylib, pylib_mount, flags)
+    mount_bind_tree(pylib, pylib_mount, flags | const.MS_RDONLY, recursive = False)
 
     return (pylib, pylib_mount)
 
+def _unescape(field):
+    '''
+    Decodes octal escapes (like `\\040` for space) used in mount tables
+    '''
+    if '\\' not in field:
+        return field
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
 def read_mounts():
     '''
     Read and split lines from /proc/mounts
     '''
     with open('/proc/mounts', 'r') as fp:
         return [
-            line.split(' ')
+            [_unescape(field) for field in line.rstrip('\n').split(' ')]
             for line in fp.readlines()
         ]
 
+class Mount:
+    '''
+    One line of mountinfo, see proc(5).
+    `children` are mounts made on top of this one.
+    '''
+    def __init__(self, line):
+        fields = line.rstrip('\n').split(' ')
+        separator = fields.index('-', 6)
+        self.id = int(fields[0])
+        self.parent_id = int(fields[1])
+        self.device = fields[2]
+        self.root = _unescape(fields[3])
+        self.mount_point = _unescape(fields[4])
+        self.options = fields[5]
+        # Like shared:1 or master:2
+        self.tags = fields[6:separator]
+        self.fs_type = fields[separator + 1]
+        self.source = _unescape(fields[separator + 2])
+        self.super_options = fields[separator + 3]
+        self.parent = None
+        self.children = []
+
+    def __repr__(self):
+        return '<Mount {} {} {}>'.format(self.id, self.mount_point, self.fs_type)
+
+class MountTable:
+    '''
+    Mounts read from mountinfo, indexed by id and mount point, linked
+    with parents and children.
+    '''
+    def __init__(self, lines):
+        self.mounts = [Mount(line) for line in lines if line.strip()]
+        self.by_id = {mount.id: mount for mount in self.mounts}
+        # mount point => mounts, last one is on top
+        self.by_point = {}
+        # Mounts whose parents are outside of our namespace or root
+        self.roots = []
+        for mount in self.mounts:
+            self.by_point.setdefault(mount.mount_point, []).append(mount)
+            parent = self.by_id.get(mount.parent_id)
+            if parent is None or parent is mount:
+                self.roots.append(mount)
+            else:
+                mount.parent = parent
+                parent.children.append(mount)
+
+    def __iter__(self):
+        return iter(self.mounts)
+
+    def __len__(self):
+        return len(self.mounts)
+
+    def find(self, mount_point):
+        '''
+        Returns mount visible in `mount_point`, or None
+        '''
+        mounts = self.by_point.get(mount_point)
+        return mounts[-1] if mounts else None
+
+    def subtree(self, mount):
+        '''
+        Yields `mount` and all mounts below it
+        '''
+        stack = [mount]
+        while stack:
+            mount = stack.pop()
+            yield mount
+            stack.extend(mount.children)
+
+def read_mountinfo(path = '/proc/self/mountinfo'):
+    '''
+    Reads mountinfo of our mount namespace into `MountTable`
+    '''
+    with open(path, 'r') as fp:
+        return MountTable(fp.readlines())
+
+def detach(mount_point):
+    '''
+    Lazily unmounts `mount_point` with everything mounted below it.
+    Mounts are made private first, so unmounting doesn't propagate to
+    mount namespaces we share them with.
+    '''
+    lowlevel.mount(None, mount_point, None, const.MS_REC | const.MS_PRIVATE)
+    lowlevel.umount2(mount_point, const.MNT_DETACH)
+
 def umount_all(except_mounts=None, tries=5):
     '''
     Umount all filesystems we can, except mountpoints listed
     in `except_mounts`.
-    `tries` argument set how many times we try to umount one
-    filesystem.
+
+    Mount tree is walked once from the root: each mount which neither is
+    excepted nor has excepted mounts below it is detached with its whole
+    subtree (see `detach`), so after `pivot_root` old root goes away in
+    one call, however many mounts it has.
+    `tries` argument set how many times we read mount table again, if
+    something couldn't be unmounted.
     '''
     except_mounts = set(except_mounts or [])
-    unmounted = 1
-    while tries and unmounted:
-        tries -= 0
-        unmounted = 0
-
-        mounts = sorted(
-            (
-                line[1]
-                for line in read_mounts()
-                if line[1] not in except_mounts
-            ),
-            key = lambda x: -len(x)
-        )
-
-        for mount in mounts:
-            try:
-                lowlevel.umount(mount)
-            except OSError:
-                unmounted += 1
+    while tries:
+        tries -= 1
+        table = read_mountinfo()
+        # Mounts which have to stay: excepted ones and their ancestors
+        keep = set()
+        for mount_point in except_mounts:
+            for mount in table.by_point.get(mount_point, ()):
+                while mount is not None and mount.id not in keep:
+                    keep.add(mount.id)
+                    mount = mount.parent
 
-    if unmounted:
+        failed = 0
+        stack = list(table.roots)
+        while stack:
+            mount = stack.pop()
+            if mount.id in keep:
+                stack.extend(mount.children)
+                continue
+            # Mounts made on the same mount point later cover this one,
+            # each detach takes the topmost
+            stacked = table.by_point[mount.mount_point]
+            for _ in stacked[stacked.index(mount):]:
+                try:
+                    detach(mount.mount_point)
+                except OSError:
+                    failed += 1
+        if not failed:
+            return
         time.sleep(0.05)
 
-def clone_and_wait(callback, flags):
-    pid = lowlevel.clone(flags)
-    assert pid is not None
+def clone_child(flags = 0, cgroup_fd = None, exit_signal = signal.SIGCHLD):
+    '''
+    Forks child using clone3, in new namespaces from `flags` and, with
+    `cgroup_fd` (cgroup directory descriptor), already in that cgroup.
+    Returns 2tuple: pid and pidfd of child, (0, None) in child.
+
+    Kernels without clone3 (or without CLONE_INTO_CGROUP, before 5.7) get
+    `clone`; then pidfd is None, and child moves itself to cgroup, so for
+    a moment it runs outside of it.
+    '''
+    attach = False
+    lowlevel.py_before_fork()
+    try:
+        try:
+            pid, pidfd = lowlevel.clone3(flags | const.CLONE_PIDFD, exit_signal, cgroup_fd)
+        except OSError as exc:
+            # E2BIG: kernel doesn't know clone_args.cgroup yet,
+            # EINVAL: or CLONE_INTO_CGROUP
+            if exc.errno not in (errno.ENOSYS, errno.E2BIG, errno.EINVAL):
+                raise
+            if exc.errno == errno.EINVAL and cgroup_fd is None:
+                raise
+            pid, pidfd = lowlevel.clone(flags | exit_signal), None
+            attach = cgroup_fd is not None
+    except:
+        lowlevel.py_after_fork_parent()
+        raise
+    if pid:
+        lowlevel.py_after_fork_parent()
+        return pid, pidfd
+
+    lowlevel.py_after_fork_child()
+    if attach:
+        try:
+            procs = os.open('cgroup.procs', os.O_WRONLY, dir_fd = cgroup_fd)
+            try:
+                os.write(procs, b'0')
+            finally:
+                os.close(procs)
+        except:
+            sys.excepthook(*sys.exc_info())
+            os._exit(1)
+    return 0, None
+
+def clone_and_wait(callback, flags, cgroup_fd = None):
+    '''
+    Runs `callback` in child cloned with `flags` (and in cgroup
+    `cgroup_fd`, see `clone_child`) and waits for it to quit.
+    Child exits with status returned by callback.
+    '''
+    pid, pidfd = clone_child(flags, cgroup_fd, exit_signal = 0)
     if pid:
         def handle_signal(signum, frame):
             patient_terminate(pid, wait_flags = const.WALL)
@@ -165,7 +437,14 @@ def clone_and_wait(callback, flags):
         signal.signal(signal.SIGTERM, handle_signal)
         signal.signal(signal.SIGINT, handle_signal)
 
-        wait_for_pid(pid, flags = const.WALL)
+        if pidfd is None:
+            wait_for_pid(pid, flags = const.WALL)
+        else:
+            watcher = ChildWatcher(pid, const.WALL, pidfd)
+            try:
+                watcher.wait()
+            finally:
+                watcher.close()
 
         signal.signal(signal.SIGTERM, old_term)
         signal.signal(signal.SIGINT, old_int)
@@ -180,7 +459,7 @@ def clone_and_wait(callback, flags):
             sys.excepthook(*sys.exc_info())
         finally:
             os._exit(status)
-        
+
 def wait_for_pid(pid, tries = 0, sleep = 0.1, flags = 0):
     '''
     Waits for child pid
@@ -192,9 +471,25 @@ def wait_for_pid(pid, tries = 0, sleep = 0.1, flags = 0):
     `tries` sets count of times we try to wait for child.
     `sleep` sets time we spend sleeping between waiting for child.
     If `tries` is zero, we wait forever, until child quits.
+
+    If kernel supports pidfd, with `tries` we don't sleep, but wait
+    for child at most `tries * sleep` seconds and return as soon as
+    it quits.
     '''
     hang = not tries
     if not hang:
+        try:
+            watcher = ChildWatcher(pid, flags)
+        except OSError as exc:
+            if exc.errno == errno.ESRCH:
+                return True
+            if exc.errno != errno.ENOSYS:
+                raise
+        else:
+            try:
+                return watcher.wait(tries * sleep)
+            finally:
+                watcher.close()
         flags |= os.WNOHANG
     while hang or tries:
         try:
@@ -214,16 +509,22 @@ def wait_for_pid(pid, tries = 0, sleep = 0.1, flags = 0):
             tries -= 1
     return False
 
-def try_kill(pid, signal):
+def try_kill(pid, signal, pidfd = None):
     '''
     Tries to kill child.
     Returns True if child does not exist.
     Returns False otherwise.
+
+    If `pidfd` of the child is given, signal is sent through it, so
+    we can't kill other process which got the same pid.
     '''
     try:
-        os.kill(pid, signal)
+        if pidfd is None:
+            os.kill(pid, signal)
+        else:
+            lowlevel.pidfd_send_signal(pidfd, signal)
     except OSError as exc:
-        if exc.errno == errno.ECHILD:
+        if exc.errno in (errno.ECHILD, errno.ESRCH):
             return True
         raise
     return False
@@ -232,6 +533,19 @@ def patient_terminate(pid, wait_flags = 0):
     '''
     Sends SIGTERM, waits a second, sends SKIGKILL
     '''
+    try:
+        watcher = ChildWatcher(pid, wait_flags)
+    except OSError as exc:
+        if exc.errno == errno.ESRCH:
+            return
+        if exc.errno != errno.ENOSYS:
+            raise
+    else:
+        try:
+            return watcher.terminate()
+        finally:
+            watcher.close()
+
     if wait_for_pid(pid, 1, flags = wait_flags):
         return
     try_kill(pid, signal.SIGTERM)
@@ -240,3 +554,140 @@ def patient_terminate(pid, wait_flags = 0):
     try_kill(pid, signal.SIGKILL)
     wait_for_pid(pid, flags = wait_flags)
 
+def _wait_status(info):
+    '''
+    Converts `siginfo_t` from waitid into status returned by `os.waitpid`
+    '''
+    if info.si_code == const.CLD_EXITED:
+        return (info.si_status & 0xff) << 8
+    if info.si_code == const.CLD_DUMPED:
+        return info.si_status | 0x80
+    return info.si_status
+
+class ChildWatcher:
+    '''
+    Watches process through pidfd, so we can wait for its exit using
+    poll/epoll with precise timeout, and send signals to it without
+    racing with pid reuse. Needs Linux 5.4.
+
+    `fileno()` becomes readable when process exits. If it's our child,
+    `poll` and `wait` reap it and set `status` (as returned by
+    `os.waitpid`) and `rusage`.
+    If it's not our child, they only tell it exited and `status` is -1.
+
+    `wait_flags` are added to waitid options, eg. WALL for children
+    cloned without exit signal.
+    '''
+    def __init__(self, pid, wait_flags = 0, pidfd = None):
+        self.pid = pid
+        self.wait_flags = wait_flags
+        if pidfd is None:
+            pidfd = lowlevel.pidfd_open(pid)
+        self.pidfd = pidfd
+        self.status = None
+        self.rusage = None
+
+    def fileno(self):
+        return self.pidfd
+
+    def poll(self):
+        '''
+        Returns True if process exited. Never blocks.
+        '''
+        if self.status is not None:
+            return True
+        try:
+            info, usage = lowlevel.waitid(
+                const.P_PIDFD,
+                self.pidfd,
+                const.WEXITED | const.WNOHANG | self.wait_flags,
+            )
+        except ChildProcessError:
+            # Not our child, or already reaped by somebody else
+            if not select.select([self.pidfd], [], [], 0)[0]:
+                return False
+            self.status = -1
+            return True
+        if not info.si_pid:
+            return False
+        self.status = _wait_status(info)
+        self.rusage = usage
+        return True
+
+    def wait(self, timeout = None):
+        '''
+        Waits at most `timeout` seconds (forever if None) for process
+        to exit. Returns True if it did.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        poller = select.poll()
+        poller.register(self.pidfd, select.POLLIN)
+        while not self.poll():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                remaining = math.ceil(remaining * 1000)
+            poller.poll(remaining)
+        return True
+
+    def kill(self, signum):
+        '''
+        Same as `try_kill`
+        '''
+        return try_kill(self.pid, signum, self.pidfd)
+
+    def terminate(self, grace = 1.0):
+        '''
+        Gives process a moment to quit, sends SIGTERM, waits `grace`
+        seconds, sends SIGKILL.
+        '''
+        if self.wait(0.1):
+            return
+        self.kill(signal.SIGTERM)
+        if self.wait(grace):
+            return
+        self.kill(signal.SIGKILL)
+        self.wait()
+
+    def close(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+def send_fds(sock, fds, data = b'\0'):
+    '''
+    Sends file descriptors `fds` over unix socket `sock` (SCM_RIGHTS)
+    along with `data`, which can't be empty.
+    '''
+    fds = array.array('i', fds)
+    return sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+def recv_fds(sock, maxfds = 1, bufsize = 1):
+    '''
+    Receives up to `maxfds` file descriptors sent by `send_fds`.
+    Returns 2tuple: received data and list of descriptors.
+    Empty data means other side closed the socket.
+    '''
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_SPACE(maxfds * fds.itemsize))
+    for level, type_, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+    return data, list(fds)
+
+def read_signals(fd):
+    '''
+    Reads signal numbers from non-blocking signalfd descriptor
+    until there is nothing left.
+    '''
+    signals = []
+    while True:
+        try:
+            # struct signalfd_siginfo is 128 bytes, ssi_signo goes first
+            data = os.read(fd, 128 * 16)
+        except BlockingIOError:
+            return signals
+        for offset in range(0, len(data), 128):
+            signals.append(struct.unpack_from('=I', data, offset)[0])
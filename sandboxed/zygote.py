@@ -0,0 +1,281 @@
+#coding:utf8
+
+'''
+Zygote process for remote executor.
+
+It is not used by the host side directly: `remote_exec.Jail` copies this
+file into jail root and runs it with jailed Python. Zygote imports listed
+modules and top level of main script once, then forks a child per request.
+Child drops privileges, sets limits and calls entry function with its
+stdin/stdout/stderr redirected to descriptors sent by the worker.
+If worker sends also directory descriptor of a cgroup, child moves itself
+there and leaves limits to it, instead of setting rlimits.
+
+Because of that, this module has to depend on standard library only.
+
+Main script is run with `__name__` set to `__zygote__`, so code guarded by
+`if __name__ == '__main__'` is not executed.
+
+Protocol, over SOCK_SEQPACKET socket per worker:
+
+    worker -> zygote: FORK, with stdin, stdout and stderr descriptors
+                      and optionally cgroup directory
+    zygote -> worker: STARTED, pid of forked child, and its pidfd
+                      if our Python can open it
+    zygote -> worker: EXITED, pid, wait status and resource usage,
+                      when child quits
+
+Sockets to workers are passed by master over control socket.
+'''
+
+import argparse
+import array
+import errno
+import fcntl
+import importlib
+import os
+import resource
+import runpy
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+FORK = b'F'
+STARTED = b'S'
+EXITED = b'X'
+
+_pid_struct = struct.Struct('=ci')
+_exit_struct = struct.Struct('=ciiddqqq')
+
+def pack_started(pid):
+    return _pid_struct.pack(STARTED, pid)
+
+def unpack_started(msg):
+    _, pid = _pid_struct.unpack(msg)
+    return pid
+
+def pack_exited(pid, status, rusage):
+    return _exit_struct.pack(
+        EXITED, pid, status,
+        rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+        rusage.ru_nvcsw, rusage.ru_nivcsw,
+    )
+
+def unpack_exited(msg):
+    '''
+    Returns pid, wait status and dict of resource usage
+    '''
+    _, pid, status, utime, stime, maxrss, nvcsw, nivcsw = _exit_struct.unpack(msg)
+    usage = dict(
+        utime = round(utime, 6),
+        stime = round(stime, 6),
+        maxrss = maxrss,
+        nvcsw = nvcsw,
+        nivcsw = nivcsw,
+    )
+    return pid, status, usage
+
+def _send_fds(sock, fds, data):
+    fds = array.array('i', fds)
+    return sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+def _recv_fds(sock, maxfds, bufsize):
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_SPACE(maxfds * fds.itemsize))
+    for level, type_, cdata in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+    return data, list(fds)
+
+class Zygote:
+    def __init__(self, control, entry, uid, gid, mem_bytes):
+        self.control = control
+        self.entry = entry
+        self.uid = uid
+        self.gid = gid
+        self.mem_bytes = mem_bytes
+
+        # fd => worker socket
+        self.workers = {}
+        # child pid => worker socket
+        self.children = {}
+
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    def run(self):
+        poll = select.poll()
+        poll.register(self.control, select.POLLIN)
+        poll.register(self.wakeup_r, select.POLLIN)
+
+        while True:
+            for fd, _ in poll.poll():
+                if fd == self.wakeup_r:
+                    self.drain_wakeup()
+                    self.reap()
+                elif fd == self.control.fileno():
+                    _, fds = _recv_fds(self.control, 1, 1)
+                    if not fds:
+                        # Master is gone
+                        return
+                    worker = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, 0, fds[0])
+                    self.workers[fds[0]] = worker
+                    poll.register(worker, select.POLLIN)
+                else:
+                    worker = self.workers[fd]
+                    if not self.handle(worker):
+                        poll.unregister(fd)
+                        self.drop(worker)
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 512):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def reap(self):
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            worker = self.children.pop(pid, None)
+            if worker is not None:
+                try:
+                    worker.send(pack_exited(pid, status, rusage))
+                except OSError:
+                    pass
+
+    def handle(self, worker):
+        '''
+        Handles message from worker. Returns False if worker is gone.
+        '''
+        try:
+            data, fds = _recv_fds(worker, 4, 16)
+        except OSError:
+            return False
+        if not data:
+            return False
+        try:
+            if data != FORK or len(fds) not in (3, 4):
+                return False
+            pid = os.fork()
+            if not pid:
+                self.child(fds)
+            self.children[pid] = worker
+            # Child can't be reaped before we get back to poll loop,
+            # so pid still belongs to it
+            if hasattr(os, 'pidfd_open'):
+                pidfd = os.pidfd_open(pid)
+                try:
+                    _send_fds(worker, [pidfd], pack_started(pid))
+                finally:
+                    os.close(pidfd)
+            else:
+                worker.send(pack_started(pid))
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return True
+
+    def drop(self, worker):
+        '''
+        Forgets worker, killing children it left behind.
+        '''
+        del self.workers[worker.fileno()]
+        for pid, owner in list(self.children.items()):
+            if owner is worker:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError as exc:
+                    if exc.errno != errno.ESRCH:
+                        raise
+        worker.close()
+
+    def child(self, fds):
+        '''
+        Code run in forked child. Never returns.
+        '''
+        status = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # Prisoner must not be able to talk to zygote
+            self.control.close()
+            for worker in self.workers.values():
+                worker.close()
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+
+            cgroup_fd = fds[3] if len(fds) > 3 else None
+            if cgroup_fd is not None:
+                procs = os.open('cgroup.procs', os.O_WRONLY, dir_fd = cgroup_fd)
+                os.write(procs, b'0')
+                os.close(procs)
+
+            for target, fd in enumerate(fds[:3]):
+                os.dup2(fd, target)
+            for fd in fds:
+                if fd > 2:
+                    os.close(fd)
+
+            os.setgid(self.gid)
+            os.setuid(self.uid)
+            if cgroup_fd is None:
+                resource.setrlimit(resource.RLIMIT_AS, (self.mem_bytes, self.mem_bytes))
+                resource.setrlimit(resource.RLIMIT_NPROC, (1,1))
+
+            try:
+                status = self.entry()
+            except SystemExit as exc:
+                status = exc.code
+            if status is not None and not isinstance(status, int):
+                sys.stderr.write('{}\n'.format(status))
+                status = 1
+            status = status or 0
+        except:
+            traceback.print_exc()
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except:
+                    pass
+            os._exit(status)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Forks prepared children for remote executor')
+    parser.add_argument('--control-fd', type = int, required = True)
+    parser.add_argument('--uid', type = int, required = True)
+    parser.add_argument('--gid', type = int, required = True)
+    parser.add_argument('--mem-bytes', type = int, required = True)
+    parser.add_argument('--preload', default = '', help = 'comma separated list of modules')
+    parser.add_argument('--entry', default = 'main')
+    parser.add_argument('main', help = 'path to main script')
+    args = parser.parse_args()
+
+    for name in args.preload.split(','):
+        if name:
+            importlib.import_module(name)
+
+    sys.argv = [args.main]
+    namespace = runpy.run_path(args.main, run_name = '__zygote__')
+    entry = namespace[args.entry]
+
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, 0, args.control_fd)
+    Zygote(control, entry, args.uid, args.gid, args.mem_bytes).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#coding:utf8
+
+'''
+Admission control of `remote_exec.Jail`. Needs root.
+'''
+
+import collections
+import grp
+import os
+import pwd
+import signal
+import socket as socketlib
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sandboxed.client.sync import Client
+from sandboxed.image import ImageBuilder
+
+# Sleeps as long as its input says
+MAIN = '''
+import sys, time
+time.sleep(float(sys.stdin.read() or 0))
+print('done')
+'''
+
+SERVER = '''
+import remote_exec
+remote_exec.Jail({socket!r}, gname = {gname!r}, uname = 'nobody', usr_path = {usr_path!r}, pool_size = 2, queue_size = 3).start()
+'''
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0, reason = 'needs root')
+
+@pytest.fixture(scope = 'module')
+def server(tmp_path_factory):
+    path = tmp_path_factory.mktemp('admission')
+    main = path / 'main.py'
+    main.write_text(MAIN)
+    usr_path = str(path / 'usr')
+    ImageBuilder(main = str(main)).build(usr_path)
+    socket = str(path / 'socket')
+    gname = grp.getgrgid(pwd.getpwnam('nobody').pw_gid).gr_name
+
+    process = subprocess.Popen(
+        (sys.executable, '-c', SERVER.format(socket = socket, gname = gname, usr_path = usr_path)),
+        cwd = ROOT,
+        start_new_session = True,
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket):
+            assert process.poll() is None and time.monotonic() < deadline
+            time.sleep(0.05)
+        yield socket
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+class LateClient(Client):
+    '''
+    Client which sends its first bytes a while after connecting, when
+    server could have rejected it already
+    '''
+    def connect(self, deadline = None):
+        sock = super().connect(deadline)
+        time.sleep(0.05)
+        return sock
+
+def test_framed_clients_flooding_queue(server):
+    outcomes = collections.Counter()
+    lock = threading.Lock()
+
+    def run():
+        with LateClient(server, timeout = 20) as client:
+            try:
+                result = client.run(b'0.5')
+                outcome = result.rejected or result.stdout
+            except Exception as exc:
+                outcome = repr(exc)
+        with lock:
+            outcomes[outcome] += 1
+
+    threads = [threading.Thread(target = run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert set(outcomes) == {b'done\n', 'overloaded'}, outcomes
+    # Two are served right away and three wait in queue
+    assert outcomes[b'done\n'] >= 5, outcomes
+
+def test_legacy_clients_get_eof_with_their_answer(server):
+    # Workers forked while connections wait in queue or for their first
+    # bytes mustn't keep them open
+    results = {}
+
+    def run(name, data, delay = 0):
+        with socketlib.socket(socketlib.AF_UNIX) as sock:
+            sock.connect(server)
+            time.sleep(delay)
+            sock.sendall(data + b'\0')
+            answer = b''
+            while b'\0' not in answer:
+                chunk = sock.recv(4096)
+                assert chunk, answer
+                answer += chunk
+            answered = time.monotonic()
+            while sock.recv(4096):
+                pass
+            results[name] = answer, time.monotonic() - answered
+
+    # About two served right away, three queued, three rejected once they send
+    # their input, while first two workers get replaced
+    clients = [('served%d' % i, b'0.2', 0) for i in range(2)]
+    clients += [('queued%d' % i, b'1', 0) for i in range(3)]
+    clients += [('rejected%d' % i, b'0', 0.4) for i in range(3)]
+    threads = []
+    for args in clients:
+        threads.append(threading.Thread(target = run, args = args))
+        threads[-1].start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == len(clients), results
+    answers = collections.Counter(answer for answer, _ in results.values())
+    assert set(answers) == {b'done\n\0', b'Server overloaded, try again later\0'}, answers
+    for name, (_, eof_wait) in results.items():
+        assert eof_wait < 0.3, (name, eof_wait)
@@ -0,0 +1,135 @@
+#coding:utf8
+
+'''
+`sandboxed.cache.ResultCache`, and which results `remote_exec.Jail` stores
+in it.
+'''
+
+import os
+import signal
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import remote_exec
+from sandboxed.cache import ResultCache
+
+key = ResultCache.key
+
+@pytest.fixture
+def cache():
+    with ResultCache(size = 1000, slots = 4, max_entry = 400) as cache:
+        yield cache
+
+def test_key_keeps_parts_apart():
+    assert key(b'ab', b'c') != key(b'a', b'bc')
+    assert key(b'ab', b'c') == key(b'ab', b'c')
+
+def test_hits_and_misses(cache):
+    assert cache.get(key(b'a')) is None
+    assert cache.put(key(b'a'), b'first')
+    assert cache.get(key(b'a')) == b'first'
+    assert cache.get(key(b'b')) is None
+    # Stored key keeps its value
+    assert cache.put(key(b'a'), b'second')
+    assert cache.get(key(b'a')) == b'first'
+    assert cache.stats() == dict(hits = 2, misses = 2, stores = 1, evictions = 0, entries = 1, bytes = 5)
+
+def test_too_long_value_is_not_stored(cache):
+    assert not cache.put(key(b'a'), bytes(401))
+    assert cache.get(key(b'a')) is None
+    assert cache.put(key(b'a'), bytes(400))
+
+def test_least_recently_used_value_makes_room(cache):
+    for name in (b'a', b'b'):
+        assert cache.put(key(name), name * 400)
+    cache.get(key(b'a'))
+    # Data is full, b is older
+    assert cache.put(key(b'c'), b'c' * 300)
+    assert cache.get(key(b'a')) == b'a' * 400
+    assert cache.get(key(b'b')) is None
+    assert cache.get(key(b'c')) == b'c' * 300
+    assert cache.stats()['evictions'] == 1
+
+def test_least_recently_used_value_frees_its_slot(cache):
+    names = (b'a', b'b', b'c', b'd')
+    for name in names:
+        assert cache.put(key(name), name)
+    cache.get(key(b'a'))
+    # Index is full, b is oldest
+    assert cache.put(key(b'e'), b'e')
+    assert [cache.get(key(name)) for name in names + (b'e',)] == [b'a', None, b'c', b'd', b'e']
+    assert cache.stats()['entries'] == 4
+
+def test_forked_processes_share_values(cache):
+    pid = os.fork()
+    if not pid:
+        status = 1
+        try:
+            status = 0 if cache.put(key(b'child'), b'value') else 1
+        finally:
+            os._exit(status)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert cache.get(key(b'child')) == b'value'
+
+def test_file_survives_reopening(tmp_path):
+    path = str(tmp_path / 'cache')
+    with ResultCache(size = 1000, path = path, slots = 4) as cache:
+        cache.put(key(b'a'), b'kept')
+    with ResultCache(size = 1000, path = path, slots = 4) as cache:
+        assert cache.get(key(b'a')) == b'kept'
+        assert cache.stats()['stores'] == 1
+
+def test_file_of_other_layout_is_cleared(tmp_path):
+    path = str(tmp_path / 'cache')
+    with ResultCache(size = 1000, path = path, slots = 4) as cache:
+        cache.put(key(b'a'), b'lost')
+    with ResultCache(size = 2000, path = path, slots = 4) as cache:
+        assert cache.get(key(b'a')) is None
+        assert cache.stats()['stores'] == 0
+
+def finished(status, timed_out = False, cpu_exceeded = False):
+    '''
+    Returns prisoner which finished with wait `status`, whose output was
+    captured
+    '''
+    prisoner = remote_exec.Prisoner(types.SimpleNamespace(pid = 0), None, None, None)
+    prisoner.status = status
+    prisoner.time_limit = prisoner.cpu_limit = 1
+    prisoner.timed_out = timed_out
+    prisoner.cpu_exceeded = cpu_exceeded
+    prisoner.captured = bytearray(b'output')
+    return prisoner
+
+@pytest.mark.parametrize('prisoner, stored', [
+    (finished(0), True),
+    (finished(1 << 8), True),
+    (finished(signal.SIGKILL), False),
+    (finished(signal.SIGKILL, timed_out = True), False),
+    (finished(signal.SIGXCPU, cpu_exceeded = True), False),
+    # Exited by itself, but just as it was being killed
+    (finished(0, timed_out = True), False),
+    (finished(-1), False),
+    (finished(None), False),
+])
+def test_only_results_of_prisoners_which_exited_are_stored(cache, prisoner, stored):
+    jail = remote_exec.Jail.__new__(remote_exec.Jail)
+    jail.cache = cache
+    jail.cache_result(key(b'input'), prisoner, dict(status = 0))
+    value = cache.get(key(b'input'))
+    if stored:
+        assert value == b'{"status": 0}\noutput'
+    else:
+        assert value is None
+
+def test_uncaptured_result_is_not_stored(cache):
+    prisoner = finished(0)
+    prisoner.captured = None
+    jail = remote_exec.Jail.__new__(remote_exec.Jail)
+    jail.cache = cache
+    jail.cache_result(key(b'input'), prisoner, dict(status = 0))
+    assert cache.get(key(b'input')) is None
@@ -0,0 +1,119 @@
+#coding:utf8
+
+'''
+Requests and response parsing of `sandboxed.client`.
+'''
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sandboxed import protocol
+from sandboxed.client import Result
+from sandboxed.client.common import Response, encode_request
+
+STATUS = dict(exit_code = 0, wall_time = 0.1)
+ANSWER = b''.join((
+    protocol.pack_frame(protocol.STDOUT, b'out'),
+    protocol.pack_frame(protocol.STDERR, b'err'),
+    protocol.pack_frame(protocol.STDOUT, b'put'),
+    protocol.pack_status(STATUS),
+))
+
+def read_request(data):
+    reader = protocol.FrameReader()
+    reader.feed(data)
+    frames = []
+    while True:
+        frame = reader.next_frame()
+        if frame is None:
+            assert not reader.buf
+            return frames
+        frames.append(frame)
+
+def test_request():
+    assert read_request(encode_request('input')) == [(protocol.STDIN, b'input'), (protocol.EOF, b'')]
+    assert read_request(encode_request(b'')) == [(protocol.EOF, b'')]
+
+def test_first_request_starts_with_magic():
+    request = encode_request(b'input', magic = True)
+    assert request.startswith(protocol.MAGIC)
+    assert read_request(request[len(protocol.MAGIC):]) == [(protocol.STDIN, b'input'), (protocol.EOF, b'')]
+
+def test_long_input_is_split_into_frames():
+    data = bytes(protocol.MAX_PAYLOAD * 2 + 1)
+    frames = read_request(encode_request(data))
+    assert [len(payload) for _, payload in frames] == [protocol.MAX_PAYLOAD, protocol.MAX_PAYLOAD, 1, 0]
+
+def test_request_with_limits():
+    frames = read_request(encode_request(b'', time_limit = 0.25, cpu_limit = 0.0001))
+    assert frames[0][0] == protocol.LIMITS
+    # Limits are rounded to milliseconds, but never to zero
+    assert protocol.unpack_limits(frames[0][1]) == (250, 1)
+    assert frames[1:] == [(protocol.EOF, b'')]
+
+@pytest.mark.parametrize('magic', [False, True])
+@pytest.mark.parametrize('chunk', [1, 3, 4, 7, 1000])
+def test_response_split_between_reads(magic, chunk):
+    data = (protocol.MAGIC if magic else b'') + ANSWER
+    response = Response(magic = magic)
+    output = []
+    for pos in range(0, len(data), chunk):
+        assert not response.done
+        output += response.feed(data[pos:pos + chunk])
+    assert response.done
+    assert response.status == STATUS
+    assert output == [(protocol.STDOUT, b'out'), (protocol.STDERR, b'err'), (protocol.STDOUT, b'put')]
+
+def test_response_rejecting_connection():
+    status = dict(error = 'Server overloaded, try again later', rejected = 'overloaded')
+    response = Response(magic = True)
+    assert response.feed(protocol.MAGIC + protocol.pack_status(status)) == []
+    result = Result(b'', b'', response.status)
+    assert result.rejected == 'overloaded'
+    assert not result.ok
+
+@pytest.mark.parametrize('data', [
+    # Legacy server answers with output and nullchar
+    b'Traceback\0',
+    b'SBX\x02',
+    # Wrong byte can come in later read
+    b'SB',
+])
+def test_response_with_bad_magic(data):
+    response = Response(magic = True)
+    with pytest.raises(protocol.ProtocolError):
+        response.feed(data)
+        response.feed(b'Y\x01')
+
+def test_response_with_client_frame():
+    response = Response()
+    with pytest.raises(protocol.ProtocolError):
+        response.feed(protocol.pack_frame(protocol.STDIN, b'input'))
+
+def test_response_with_data_after_status():
+    response = Response()
+    with pytest.raises(protocol.ProtocolError):
+        response.feed(ANSWER + protocol.pack_frame(protocol.STDOUT, b'more'))
+
+def test_response_with_oversize_frame():
+    response = Response()
+    with pytest.raises(protocol.ProtocolError):
+        response.feed(protocol.HEADER.pack(protocol.STDOUT, protocol.MAX_PAYLOAD + 1))
+
+@pytest.mark.parametrize('status, ok', [
+    (dict(exit_code = 0), True),
+    (dict(exit_code = 1), False),
+    (dict(exit_code = None, signal = 9), False),
+    (dict(exit_code = 0, timed_out = True), False),
+    (dict(exit_code = 0, cpu_exceeded = True), False),
+])
+def test_result(status, ok):
+    result = Result(b'out', b'', status)
+    assert result.ok is ok
+    assert result.timed_out is bool(status.get('timed_out'))
+    assert result.signal == status.get('signal')
@@ -0,0 +1,84 @@
+#coding:utf8
+
+'''
+Cloning while other thread runs Python code. Needs root.
+'''
+
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Child which inherited locked GIL hangs, and parent waiting for it
+SPINNING = '''
+import threading
+from sandboxed import const
+from sandboxed.utils import clone_and_wait
+
+stop = False
+def spin():
+    count = 0
+    while not stop:
+        count += 1
+
+threading.Thread(target = spin, daemon = True).start()
+for _ in range({clones}):
+    clone_and_wait(lambda: 0, const.CLONE_NEWPID)
+stop = True
+'''
+
+POOLED = '''
+import socket
+from sandboxed import const
+from sandboxed.namespaces import NamespacePool
+from sandboxed.utils import clone_and_wait
+
+def jail():
+    namespaces.enter()
+    assert socket.gethostname() == 'pooled'
+    with pool.lock:
+        pass
+
+with NamespacePool(size = 2, hostname = 'pooled') as pool:
+    pool.start()
+    for _ in range({clones}):
+        namespaces = pool.take()
+        try:
+            clone_and_wait(jail, (const.CLONE_NEWPID | const.CLONE_NEWNS) & ~namespaces.flags)
+        finally:
+            namespaces.discard()
+'''
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0, reason = 'needs root')
+
+def run(script, timeout = 60):
+    '''
+    Runs `script`, returns its exit status and stderr, where children
+    report their errors too
+    '''
+    process = subprocess.Popen(
+        (sys.executable, '-c', script),
+        cwd = ROOT,
+        stderr = subprocess.PIPE,
+        start_new_session = True,
+    )
+    try:
+        _, stderr = process.communicate(timeout = timeout)
+        return process.returncode, stderr.decode()
+    finally:
+        # Hung children too, they're in the same process group
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+def test_clone_and_wait_with_spinning_thread():
+    assert run(SPINNING.format(clones = 1000)) == (0, '')
+
+def test_clone_and_wait_with_namespace_pool():
+    assert run(POOLED.format(clones = 200)) == (0, '')
@@ -0,0 +1,104 @@
+#coding:utf8
+
+'''
+Shared library closure of `sandboxed.image`, resolved on host's Python.
+'''
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sandboxed.image import ImageBuilder, LibraryResolver, jail_path, read_elf, read_ld_conf
+
+PYTHON = '/usr/bin/python3'
+
+needs_python = pytest.mark.skipif(not os.path.exists(PYTHON), reason = 'needs ' + PYTHON)
+
+def ldd(path):
+    '''
+    Returns dict of libraries of `path` listed by ldd: name => real path
+    '''
+    output = subprocess.run(('ldd', path), stdout = subprocess.PIPE, check = True).stdout.decode()
+    return {
+        match.group(1): os.path.realpath(match.group(2))
+        for match in re.finditer(r'^\s*(\S+) => (/\S+)', output, re.M)
+    }
+
+@needs_python
+def test_read_elf():
+    elf = read_elf(PYTHON)
+    assert elf.path == PYTHON
+    assert elf.interp and os.path.isabs(elf.interp)
+    assert any(name.startswith('libc.so') for name in elf.needed)
+
+def test_read_elf_of_other_files(tmp_path):
+    empty = tmp_path / 'empty'
+    empty.write_bytes(b'')
+    script = tmp_path / 'script'
+    script.write_text('#!/bin/sh\n')
+    assert read_elf(str(empty)) is None
+    assert read_elf(str(script)) is None
+
+@needs_python
+@pytest.mark.skipif(not shutil.which('ldd'), reason = 'needs ldd')
+def test_closure_of_python_is_what_loader_loads():
+    builder = ImageBuilder(python = PYTHON)
+    python = read_elf(PYTHON)
+    loaded = ldd(PYTHON)
+    # libc needs loader by name too, ldd lists it by path only
+    assert builder.add_libraries(python) == sorted(set(loaded) | {os.path.basename(python.interp)})
+    # Libraries and loader, where jail's loader looks for them
+    expected = set(loaded.values()) | {os.path.realpath(python.interp)}
+    assert set(builder.files.values()) == expected
+    for target in builder.files:
+        assert target.startswith('lib/')
+    assert builder.files[jail_path(python.interp)] == os.path.realpath(python.interp)
+
+@needs_python
+def test_missing_library(tmp_path):
+    resolver = LibraryResolver(dirs = [str(tmp_path)])
+    with pytest.raises(FileNotFoundError) as info:
+        ImageBuilder(python = PYTHON, resolver = resolver).add_libraries(read_elf(PYTHON))
+    message = str(info.value)
+    assert 'needed by {} not found'.format(PYTHON) in message
+    assert re.search(r'Library lib\S+\.so\.\d+ needed', message), message
+
+@needs_python
+def test_missing_extra_library():
+    builder = ImageBuilder(python = PYTHON, libraries = ('libsandboxed-missing.so.1',))
+    with pytest.raises(FileNotFoundError, match = 'Library libsandboxed-missing.so.1 needed by'):
+        builder.add_libraries(read_elf(PYTHON))
+
+@needs_python
+def test_library_which_is_not_elf_is_skipped(tmp_path):
+    python = read_elf(PYTHON)
+    name = python.needed[0]
+    library = LibraryResolver().find(name, python)
+    (tmp_path / name).write_text('not a library\n')
+    resolver = LibraryResolver(dirs = [str(tmp_path), os.path.dirname(library.path)])
+    assert resolver.find(name, python).path == library.path
+
+@pytest.mark.parametrize('path, target', [
+    ('/usr/lib/x86_64-linux-gnu/libz.so.1', 'lib/x86_64-linux-gnu/libz.so.1'),
+    ('/lib/x86_64-linux-gnu/libc.so.6', 'lib/x86_64-linux-gnu/libc.so.6'),
+    ('/lib64/ld-linux-x86-64.so.2', 'lib/ld-linux-x86-64.so.2'),
+    ('/usr/bin/../lib/libm.so.6', 'lib/libm.so.6'),
+    ('/opt/python/lib/libpython3.so', None),
+])
+def test_jail_path(path, target):
+    assert jail_path(path) == target
+
+def test_read_ld_conf(tmp_path):
+    (tmp_path / 'conf.d').mkdir()
+    (tmp_path / 'conf.d' / 'b.conf').write_text('/opt/b\n')
+    (tmp_path / 'conf.d' / 'a.conf').write_text('# comment\n/opt/a # too\n\n')
+    (tmp_path / 'ld.so.conf').write_text('/first\ninclude conf.d/*.conf\nhwcap 0 nosegneg\n/last\n')
+    assert read_ld_conf(str(tmp_path / 'ld.so.conf')) == ['/first', '/opt/a', '/opt/b', '/last']
+    assert read_ld_conf(str(tmp_path / 'missing')) == []
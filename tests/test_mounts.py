@@ -0,0 +1,136 @@
+#coding:utf8
+
+'''
+Parsing of mountinfo in `sandboxed.utils`, and which mounts `umount_all`
+detaches.
+'''
+
+import errno
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sandboxed import utils
+from sandboxed.utils import MountTable, _unescape, read_mountinfo
+
+# Jail after pivot_root: new root with old one in /root. /root/tmp has two
+# mounts stacked, the one on top has mounts of its own.
+MOUNTINFO = r'''
+100 90 0:50 / / rw,relatime - overlay overlay rw,lowerdir=/.template
+101 100 0:5 / /proc rw,nosuid,nodev,noexec - proc proc rw
+102 100 8:1 / /root rw,relatime shared:1 - ext4 /dev/sda1 rw
+103 102 0:22 / /root/sys rw,nosuid shared:2 master:7 - sysfs sysfs rw
+104 103 0:23 / /root/sys/fs/cgroup rw - cgroup2 cgroup2 rw,nsdelegate
+105 102 0:24 / /root/tmp rw - tmpfs tmpfs rw,size=1024k
+106 105 0:25 / /root/tmp rw - tmpfs tmpfs rw,size=2048k
+107 106 0:26 / /root/tmp/with\040space rw - tmpfs my\011tmpfs rw
+108 100 7:0 / /usr ro,nodev - squashfs /dev/loop0 ro
+109 100 8:1 /srv/jail\134template /.template ro - ext4 /dev/sda1 rw
+'''.lstrip('\n')
+
+@pytest.fixture
+def table():
+    return MountTable(MOUNTINFO.splitlines(True))
+
+@pytest.mark.parametrize('field, unescaped', [
+    ('/plain/path', '/plain/path'),
+    (r'/with\040space', '/with space'),
+    (r'tab\011and\012newline', 'tab\tand\nnewline'),
+    (r'back\134slash', 'back\\slash'),
+    (r'\040\040', '  '),
+    # Not an escape
+    (r'\04', r'\04'),
+    (r'\x20', r'\x20'),
+    (r'\8', r'\8'),
+])
+def test_unescape(field, unescaped):
+    assert _unescape(field) == unescaped
+
+@pytest.mark.parametrize('mount_id, parent_id, root, mount_point, tags, fs_type, source, options', [
+    (100, 90, '/', '/', [], 'overlay', 'overlay', 'rw,relatime'),
+    (102, 100, '/', '/root', ['shared:1'], 'ext4', '/dev/sda1', 'rw,relatime'),
+    (103, 102, '/', '/root/sys', ['shared:2', 'master:7'], 'sysfs', 'sysfs', 'rw,nosuid'),
+    (107, 106, '/', '/root/tmp/with space', [], 'tmpfs', 'my\ttmpfs', 'rw'),
+    (109, 100, '/srv/jail\\template', '/.template', [], 'ext4', '/dev/sda1', 'ro'),
+])
+def test_fields(table, mount_id, parent_id, root, mount_point, tags, fs_type, source, options):
+    mount = table.by_id[mount_id]
+    assert (mount.id, mount.parent_id, mount.root, mount.mount_point) == (mount_id, parent_id, root, mount_point)
+    assert (mount.tags, mount.fs_type, mount.source, mount.options) == (tags, fs_type, source, options)
+
+def test_super_options(table):
+    assert table.by_id[104].super_options == 'rw,nsdelegate'
+
+def test_tree(table):
+    assert len(table) == 10
+    # Parent of root is outside of jail
+    assert table.roots == [table.by_id[100]]
+    assert table.by_id[100].parent is None
+    assert [mount.id for mount in table.by_id[100].children] == [101, 102, 108, 109]
+    assert table.by_id[107].parent is table.by_id[106]
+    assert sorted(mount.id for mount in table.subtree(table.by_id[102])) == [102, 103, 104, 105, 106, 107]
+    assert [mount.id for mount in table.subtree(table.by_id[108])] == [108]
+
+def test_find(table):
+    # Later of stacked mounts is visible
+    assert [mount.id for mount in table.by_point['/root/tmp']] == [105, 106]
+    assert table.find('/root/tmp').id == 106
+    assert table.find('/root/tmp/with space').id == 107
+    assert table.find('/root/with space') is None
+
+def test_mount_on_itself_is_root():
+    table = MountTable(['1 1 0:1 / / rw - rootfs rootfs rw\n', '\n'])
+    assert len(table) == 1
+    assert table.roots == [table.by_id[1]]
+    assert table.by_id[1].children == []
+
+def test_read_mountinfo(tmp_path):
+    path = tmp_path / 'mountinfo'
+    path.write_text(MOUNTINFO)
+    table = read_mountinfo(str(path))
+    assert [mount.id for mount in table] == list(range(100, 110))
+
+def test_read_own_mountinfo():
+    table = read_mountinfo()
+    assert table.find('/') is not None
+    assert table.roots
+
+@pytest.fixture
+def detached(monkeypatch):
+    '''
+    Makes `umount_all` see MOUNTINFO, and record mount points it detaches
+    instead of detaching them
+    '''
+    calls = []
+    monkeypatch.setattr(utils, 'read_mountinfo', lambda: MountTable(MOUNTINFO.splitlines(True)))
+    monkeypatch.setattr(utils, 'detach', calls.append)
+    return calls
+
+@pytest.mark.parametrize('except_mounts, points', [
+    # Each subtree goes in one call
+    (['/proc', '/usr', '/.template'], ['/root']),
+    # Stacked mounts one by one
+    (['/proc', '/root/sys/fs/cgroup'], ['/.template', '/usr', '/root/tmp', '/root/tmp']),
+    # Mounts under excepted one are detached
+    (['/proc', '/usr', '/.template', '/root/tmp'], ['/root/tmp/with space', '/root/sys']),
+    # So is everything under excepted root
+    (['/'], ['/.template', '/usr', '/root', '/proc']),
+])
+def test_umount_all_detaches_subtrees(detached, except_mounts, points):
+    utils.umount_all(except_mounts)
+    assert detached == points
+
+def test_umount_all_tries_again(detached, monkeypatch):
+    failures = [errno.EBUSY]
+    def detach(mount_point):
+        if mount_point == '/usr' and failures:
+            raise OSError(failures.pop(), 'busy')
+        detached.append(mount_point)
+    monkeypatch.setattr(utils, 'detach', detach)
+    utils.umount_all(['/'])
+    # Table is read again, and everything in it detached again
+    assert detached == ['/.template', '/root', '/proc'] + ['/.template', '/usr', '/root', '/proc']
@@ -0,0 +1,155 @@
+#coding:utf8
+
+'''
+Framing of `sandboxed.protocol`, and how server tells it from legacy
+protocol.
+'''
+
+import os
+import socket
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from remote_exec import peek_framing
+from sandboxed import protocol
+
+FRAMES = [
+    (protocol.STDIN, b'input'),
+    (protocol.STDIN, b''),
+    (protocol.STDOUT, bytes(range(256))),
+    (protocol.EOF, b''),
+]
+STREAM = b''.join(protocol.pack_frame(kind, payload) for kind, payload in FRAMES)
+
+def read_frames(reader):
+    frames = []
+    while True:
+        frame = reader.next_frame()
+        if frame is None:
+            return frames
+        frames.append(frame)
+
+def test_frame_header():
+    assert protocol.pack_frame(protocol.STDIN, b'abc') == b'\x01\x00\x00\x00\x03abc'
+    assert protocol.pack_frame(protocol.EOF) == b'\x02\x00\x00\x00\x00'
+
+def test_frames_fed_at_once():
+    reader = protocol.FrameReader()
+    reader.feed(STREAM)
+    assert read_frames(reader) == FRAMES
+    assert not reader.buf
+
+@pytest.mark.parametrize('chunk', [1, 2, 3, 5, 7, 64])
+def test_frames_split_between_reads(chunk):
+    reader = protocol.FrameReader()
+    frames = []
+    for pos in range(0, len(STREAM), chunk):
+        reader.feed(STREAM[pos:pos + chunk])
+        frames += read_frames(reader)
+    assert frames == FRAMES
+
+def test_partial_frame_waits():
+    reader = protocol.FrameReader()
+    frame = protocol.pack_frame(protocol.STDIN, b'abc')
+    reader.feed(frame[:3])
+    assert reader.header() is None
+    assert not reader.ready()
+    reader.feed(frame[3:-1])
+    assert reader.header() == (protocol.STDIN, 3)
+    assert not reader.ready()
+    assert reader.next_frame() is None
+    reader.feed(frame[-1:])
+    assert reader.ready()
+    assert reader.next_frame() == (protocol.STDIN, b'abc')
+
+def test_oversize_frame():
+    reader = protocol.FrameReader(max_payload = 10)
+    reader.feed(protocol.pack_frame(protocol.STDIN, bytes(10)))
+    assert reader.next_frame() == (protocol.STDIN, bytes(10))
+    # Rejected by header alone, before payload comes
+    reader.feed(protocol.HEADER.pack(protocol.STDIN, 11))
+    with pytest.raises(protocol.ProtocolError):
+        reader.next_frame()
+
+def test_default_limit_of_payload():
+    reader = protocol.FrameReader()
+    reader.feed(protocol.HEADER.pack(protocol.STDIN, protocol.MAX_PAYLOAD + 1))
+    with pytest.raises(protocol.ProtocolError):
+        reader.ready()
+
+def test_status_round_trip():
+    report = dict(exit_code = 0, error = None, wall_time = 0.5)
+    reader = protocol.FrameReader()
+    reader.feed(protocol.pack_status(report))
+    kind, payload = reader.next_frame()
+    assert kind == protocol.STATUS
+    assert protocol.unpack_status(payload) == report
+
+@pytest.mark.parametrize('time_ms, cpu_ms', [
+    (None, None),
+    (100, None),
+    (None, 1),
+    (6000, 250),
+])
+def test_limits_round_trip(time_ms, cpu_ms):
+    reader = protocol.FrameReader()
+    reader.feed(protocol.pack_limits(time_ms, cpu_ms))
+    kind, payload = reader.next_frame()
+    assert kind == protocol.LIMITS
+    assert protocol.unpack_limits(payload) == (time_ms, cpu_ms)
+
+@pytest.mark.parametrize('payload', [
+    b'',
+    b'not json',
+    b'\xff',
+    b'[100]',
+    b'{"time_ms": 0}',
+    b'{"time_ms": -5}',
+    b'{"cpu_ms": 1.5}',
+    b'{"cpu_ms": "100"}',
+])
+def test_malformed_limits(payload):
+    with pytest.raises(protocol.ProtocolError):
+        protocol.unpack_limits(payload)
+
+def test_unknown_limits_are_ignored():
+    assert protocol.unpack_limits(b'{"time_ms": 5, "memory": 1}') == (5, None)
+
+@pytest.mark.parametrize('sent, framed', [
+    (protocol.MAGIC + STREAM, True),
+    (protocol.MAGIC, True),
+    (b'print(1)\0', False),
+    # Bad magic
+    (b'SBX\x02' + STREAM, False),
+    (b'SBY', False),
+    (b'\0', False),
+    # Split magic, rest may still come
+    (b'SB', None),
+    (b'', None),
+])
+def test_peek_framing(sent, framed):
+    server, client = socket.socketpair()
+    with server, client:
+        client.sendall(sent)
+        assert peek_framing(server) is framed
+        # Nothing is consumed
+        if sent:
+            assert server.recv(len(sent), socket.MSG_DONTWAIT) == sent
+
+def test_peek_framing_of_split_magic():
+    server, client = socket.socketpair()
+    with server, client:
+        client.sendall(protocol.MAGIC[:2])
+        assert peek_framing(server) is None
+        client.sendall(protocol.MAGIC[2:])
+        assert peek_framing(server) is True
+
+def test_peek_framing_of_disconnected_client():
+    server, client = socket.socketpair()
+    with server:
+        client.close()
+        assert peek_framing(server) is False